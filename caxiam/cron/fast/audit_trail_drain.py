@@ -0,0 +1,6 @@
+from caxiam.velocity.audit import AuditTrailSink
+
+# write the audit trail entries spooled by "async" event
+# types to SQL, in large batches
+
+AuditTrailSink.drain()
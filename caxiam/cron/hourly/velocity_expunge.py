@@ -0,0 +1,9 @@
+from caxiam.velocity.models import VelocityType
+import os
+
+# remove velocity events older than their type's
+# expunge_after, along with their index entries
+
+types = [ vt for vt in VelocityType.objects.all() if vt.expunge_after != None ]
+expunged_count = VelocityType.expunge_types(types)
+print "[pid:%d]" % os.getpid(), "expunged %d velocity events of %d types" % (expunged_count, len(types))
@@ -1,5 +1,6 @@
 from django.conf import settings
 from django.db import connection
+from caxiam.redis_instrumentation import RedisShadowInstrumentation
 import datetime
 
 # debugging middleware which is extremely useful
@@ -7,13 +8,24 @@ import datetime
 # settings:
 #
 #   CAXIAM_DUMP_SQL     whether to dump data on all SQL queries made during a request, as well as request timing
+#   CAXIAM_DUMP_REDIS   whether to dump the redis shadow traffic of a request, per model
+#
+# NOTE: this also collects the redis shadow statistics of
+# each request and view, if ILCLOUD_REDIS_SHADOW_INSTRUMENT
+# is enabled (see caxiam.redis_instrumentation)
 
 class CaxiamDebugMiddleware(object):
 
     date_request_started = None
+    view_name = None
 
     def process_request(self, request):
         self.date_request_started = datetime.datetime.utcnow()
+        self.view_name = None
+        RedisShadowInstrumentation.start_request()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        self.view_name = '%s.%s' % (view_func.__module__, getattr(view_func, '__name__', view_func.__class__.__name__))
 
     def process_response(self, request, response):
         if settings.CAXIAM_DUMP_SQL or settings.CAXIAM_DUMP_SESSION or settings.CAXIAM_DUMP_REQUESTS:
@@ -37,4 +49,15 @@ class CaxiamDebugMiddleware(object):
             print json.dumps(request.session._session)
             print '====================='
 
+        redis_stats = RedisShadowInstrumentation.finish_request(self.view_name)
+        if getattr(settings, 'CAXIAM_DUMP_REDIS', False) and redis_stats != None:
+            print '==== REDIS SHADOW ==='
+            print '%d round trips (%d pipelines), %d commands, %.3fs' % (redis_stats.round_trips,
+                redis_stats.pipelines, redis_stats.command_count(), redis_stats.time)
+            for name in sorted(redis_stats.models.keys()):
+                m = redis_stats.models[name]
+                print '%-24s %4d trips %8d out %8d in %.3fs  %s' % (name, m['round_trips'], m['bytes_out'],
+                    m['bytes_in'], m['time'], ' '.join([ '%s:%d' % c for c in sorted(m['commands'].items()) ]))
+            print '====================='
+
         return response
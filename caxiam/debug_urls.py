@@ -0,0 +1,11 @@
+from django.conf.urls import patterns, url
+
+from caxiam.redis_instrumentation import redis_stats_view
+
+# debugging endpoints; include these in your project by
+# adding this to your urlpatterns:
+#    url(r'^debug/', include('caxiam.debug_urls')),
+
+urlpatterns = patterns('',
+    url(r'^redis-stats/$', redis_stats_view),
+)
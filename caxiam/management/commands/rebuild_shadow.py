@@ -0,0 +1,96 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from caxiam.redis_shadow import RedisShadow
+from optparse import make_option
+import time
+
+# repopulate the redis shadow of a model from SQL
+#
+# rows are streamed in pk order, a chunk at a time, and
+# each chunk's records and index entries are written in a
+# single pipeline (one per shard, for a sharded model);
+# the last pk written is checkpointed in redis after each
+# chunk, so an interrupted rebuild can pick up where it
+# left off with --resume
+#
+#   ./manage rebuild_shadow app_label.ModelName --batch-size 1000 --flush
+#   ./manage rebuild_shadow app_label.ModelName --resume
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = 'Rebuild the redis shadow of a RedisShadow model from SQL'
+    option_list = BaseCommand.option_list + (
+            make_option('--batch-size', type = 'int', default = 1000, help = 'number of rows to write per pipeline'),
+            make_option('--start-after', type = 'int', default = None, help = 'only rebuild rows with a pk greater than this'),
+            make_option('--resume', action = 'store_true', default = False, help = 'continue from the last checkpoint recorded in redis'),
+            make_option('--flush', action = 'store_true', default = False, help = 'flush all indices before rebuilding'),
+            make_option('--select-related', default = '', help = 'comma-separated related fields to join (for indices that use __ lookups)'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('specify a model as app_label.ModelName')
+        cls = get_model(*args[0].split('.', 1))
+        if cls == None or not issubclass(cls, RedisShadow):
+            raise CommandError('%s is not a RedisShadow model' % args[0])
+
+        rd = cls.redis_connection()
+        checkpoint_key = 'dbshadow_rebuild:%s' % (cls.__name__,)
+
+        # figure out where to start
+        last_pk = options['start_after']
+        if options['resume']:
+            if last_pk != None:
+                raise CommandError('--resume and --start-after are mutually exclusive')
+            last_pk = rd.get(checkpoint_key)
+            if last_pk == None:
+                raise CommandError('no checkpoint recorded for %s' % cls.__name__)
+            last_pk = int(last_pk)
+            self.stdout.write('resuming %s after pk %d' % (cls.__name__, last_pk))
+
+        if options['flush']:
+            if last_pk != None:
+                raise CommandError('refusing to flush indices for a partial rebuild')
+            self.stdout.write('flushed %d index keys' % cls.redis_flush_all_indices())
+
+        qs = cls.objects.order_by('pk')
+        if options['select_related']:
+            qs = qs.select_related(*options['select_related'].split(','))
+
+        started = time.time()
+        total = 0
+        while True:
+            chunk_qs = qs
+            if last_pk != None:
+                chunk_qs = chunk_qs.filter(pk__gt = last_pk)
+            chunk_started = time.time()
+
+            # NOTE: we don't need a MULTI/EXEC here, just
+            # the round trip savings; a sharded model needs
+            # one pipeline per shard
+            pipes = {}
+            count = 0
+            for r in chunk_qs[:options['batch_size']].iterator():
+                pool_index = r.redis_record_pool_index()
+                if pool_index not in pipes:
+                    pipes[pool_index] = cls.redis_connection(pool_index).pipeline(transaction = False)
+                r.redis_forget_index_entries()      # the entries may be missing, so write them all
+                r.redis_set(pipes[pool_index])
+                last_pk = r.pk
+                count += 1
+            if count == 0:
+                break
+            for pipe in pipes.values():
+                pipe.execute()
+            rd.set(checkpoint_key, last_pk)
+
+            total += count
+            elapsed = time.time() - started
+            self.stdout.write('%d rows (%.0f rows/s, %.0f rows/s overall), checkpoint pk %d' % (
+                    total, count / max(time.time() - chunk_started, 0.001),
+                    total / max(elapsed, 0.001), last_pk))
+
+        rd.delete(checkpoint_key)
+        elapsed = time.time() - started
+        self.stdout.write('rebuilt %d %s records in %.1fs (%.0f rows/s)' % (
+                total, cls.__name__, elapsed, total / max(elapsed, 0.001)))
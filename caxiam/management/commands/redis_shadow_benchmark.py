@@ -0,0 +1,94 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+from django.db.models import get_model
+from django.utils import timezone
+from caxiam.redis_shadow import RedisShadow
+from optparse import make_option
+import datetime
+import time
+
+# micro-benchmark for the RedisShadow codec: compares the
+# compiled per-model codec against the generic redis_out/
+# redis_in code it replaces, using either a real record
+# from redis or a synthesized one
+#
+#   ./manage redis_shadow_benchmark app_label.ModelName --iterations 10000
+#   ./manage redis_shadow_benchmark app_label.ModelName --pk -1234
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = 'Compare the compiled RedisShadow codec against the generic encoder/decoder'
+    option_list = BaseCommand.option_list + (
+            make_option('--iterations', type = 'int', default = 10000, help = 'number of records to encode/decode per run'),
+            make_option('--pk', type = 'int', default = None, help = 'benchmark a real record fetched from redis'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('specify a model as app_label.ModelName')
+        cls = get_model(*args[0].split('.', 1))
+        if cls == None or not issubclass(cls, RedisShadow):
+            raise CommandError('%s is not a RedisShadow model' % args[0])
+
+        if options['pk'] != None:
+            # the stored record may be in any format, and a
+            # sharded model's records may be in any of its
+            # pools; redis_mget finds it and redis_in reads
+            # every format, then we re-encode it as json for
+            # the generic code
+            d = cls.redis_mget([ options['pk'] ], primary = True)[0]
+            if d == None:
+                raise CommandError('no record %s:%d in redis' % (cls.__name__, options['pk']))
+            record = cls.redis_in(d)
+            d = record.redis_out_generic()
+        else:
+            record = self.synthesize(cls)
+            d = record.redis_out_generic()
+
+        # make sure the two paths actually agree before we
+        # bother timing them
+        if cls.redis_decode(d) != cls.redis_decode_generic(d):
+            raise CommandError('compiled codec does not match generic decoder for this record')
+
+        # the compiled codec writes in the model's own
+        # REDIS_SHADOW_FORMAT, which may be more compact
+        codec = cls.redis_codec()
+        d_compiled = record.redis_out()
+
+        n = options['iterations']
+        self.stdout.write('%s: %d iterations' % (cls.__name__, n))
+        self.stdout.write('  record size: %d bytes (generic json), %d bytes (%s)' % (len(d), len(d_compiled), codec.format))
+        self.report('encode (generic)', n, lambda: record.redis_out_generic())
+        self.report('encode (compiled)', n, lambda: record.redis_out())
+        self.report('decode (generic)', n, lambda: cls.redis_in_generic(d))
+        self.report('decode (compiled)', n, lambda: cls.redis_in(d_compiled))
+
+    def report(self, label, n, fn):
+        started = time.time()
+        for i in xrange(n):
+            fn()
+        elapsed = time.time() - started
+        self.stdout.write('  %-20s %8.3fs %10.1f us/record' % (label, elapsed, elapsed * 1000000 / n))
+
+    # build a record with a plausible value in every field
+    def synthesize(self, cls):
+        values = {}
+        for f in cls._meta.local_fields:
+            if isinstance(f, models.AutoField):
+                v = -1
+            elif isinstance(f, models.ForeignKey):
+                v = 1
+            elif isinstance(f, models.DateTimeField):
+                v = timezone.now()
+            elif isinstance(f, models.DateField):
+                v = datetime.date.today()
+            elif isinstance(f, models.BooleanField):
+                v = True
+            elif isinstance(f, (models.IntegerField, models.FloatField)):
+                v = 1
+            elif isinstance(f, (models.CharField, models.TextField)):
+                v = u'benchmark'
+            else:
+                v = f.get_default()
+            values[f.attname] = v
+        return cls(**values)
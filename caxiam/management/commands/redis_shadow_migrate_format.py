@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from caxiam.redis_shadow import RedisShadow, replace_record_script
+from optparse import make_option
+import time
+
+# rewrite every shadowed record of a model in the model's
+# current REDIS_SHADOW_FORMAT; records are read with SCAN
+# (so redis is never blocked) and each record is only
+# replaced if it hasn't changed since it was read
+#
+#   ./manage redis_shadow_migrate_format app_label.ModelName --batch-size 500
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = 'Rewrite the redis shadow records of a model in its current REDIS_SHADOW_FORMAT'
+    option_list = BaseCommand.option_list + (
+            make_option('--batch-size', type = 'int', default = 500, help = 'number of records to read and rewrite per round trip'),
+            make_option('--dry-run', action = 'store_true', default = False, help = 'report what would be rewritten without writing anything'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('specify a model as app_label.ModelName')
+        cls = get_model(*args[0].split('.', 1))
+        if cls == None or not issubclass(cls, RedisShadow):
+            raise CommandError('%s is not a RedisShadow model' % args[0])
+
+        codec = cls.redis_codec()
+        codec.register_schema(cls.redis_connection())
+        batch_size = options['batch_size']
+
+        self.stdout.write('migrating %s records to %s format' % (cls.__name__, codec.format))
+        started = time.time()
+        seen = 0
+        rewritten = 0
+        bytes_before = 0
+        bytes_after = 0
+        for pool_index in cls.redis_pool_indices():
+            rd = cls.redis_connection(pool_index)
+            batch = []
+            for k in rd.scan_iter(match = cls.redis_key_prefix() + '*', count = batch_size):
+                batch.append(k)
+                if len(batch) >= batch_size:
+                    counts = self.migrate_batch(cls, rd, batch, options['dry_run'])
+                    seen += len(batch)
+                    rewritten += counts[0]
+                    bytes_before += counts[1]
+                    bytes_after += counts[2]
+                    batch = []
+            if len(batch) > 0:
+                counts = self.migrate_batch(cls, rd, batch, options['dry_run'])
+                seen += len(batch)
+                rewritten += counts[0]
+                bytes_before += counts[1]
+                bytes_after += counts[2]
+
+        self.stdout.write('%d records seen, %d %s in %.1fs; %d bytes -> %d bytes' % (
+                seen, rewritten, 'would be rewritten' if options['dry_run'] else 'rewritten',
+                time.time() - started, bytes_before, bytes_after))
+
+    # re-encode one batch of records
+    # returns (rewritten, bytes before, bytes after)
+    def migrate_batch(self, cls, rd, keys, dry_run):
+        codec = cls.redis_codec()
+        dlist = rd.mget(keys)
+        pipe = rd.pipeline(transaction = False)
+        rewritten = 0
+        bytes_before = 0
+        bytes_after = 0
+        for k, d in zip(keys, dlist):
+            if d == None:
+                continue        # deleted since the scan
+            new_d = codec.encode(codec.instance(cls, codec.decode(d)))
+            bytes_before += len(d)
+            bytes_after += len(new_d)
+            if new_d != d:
+                rewritten += 1
+                if not dry_run:
+                    replace_record_script(keys = [ k ], args = [ d, new_d ], client = pipe)
+        if rewritten > 0 and not dry_run:
+            pipe.execute()
+        return rewritten, bytes_before, bytes_after
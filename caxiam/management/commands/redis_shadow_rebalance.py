@@ -0,0 +1,112 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from caxiam.redis_shadow import RedisShadow, RedisShadowHashRing
+from optparse import make_option
+import time
+
+# move the records of a sharded model (see
+# REDIS_SHADOW_SHARDS) to where a new list of shards
+# would put them; records are read with SCAN, and each
+# record that the new hash ring places on another shard
+# is written there along with its index entries
+#
+# adding a shard is done in three steps:
+#
+#   1. copy the records that will move, while the site
+#      still runs with the old list of shards:
+#
+#       ./manage redis_shadow_rebalance app_label.ModelName --from 1,2 --to 1,2,3
+#
+#   2. deploy REDIS_SHADOW_SHARDS = [ 1, 2, 3 ]
+#
+#   3. remove the old copies (and their index entries)
+#      from the shards that no longer own them:
+#
+#       ./manage redis_shadow_rebalance app_label.ModelName --from 1,2 --to 1,2,3 --cleanup
+#
+# NOTE: a moved record written between steps 1 and 2
+# will be stale on its new shard; run rebuild_shadow
+# (or step 1 again, before the deploy) if that matters
+#
+# NOTE: the first shard holds the id counter and the
+# locks, so it must stay first
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = 'Move the redis shadow records of a sharded model onto a new list of shards'
+    option_list = BaseCommand.option_list + (
+            make_option('--from', dest = 'from_shards', default = None, help = 'comma-separated pool indices the records are on now'),
+            make_option('--to', dest = 'to_shards', default = None, help = 'comma-separated pool indices the records should be on'),
+            make_option('--cleanup', action = 'store_true', default = False, help = 'delete records from shards that no longer own them, rather than copying'),
+            make_option('--batch-size', type = 'int', default = 500, help = 'number of records to read and move per round trip'),
+            make_option('--dry-run', action = 'store_true', default = False, help = 'report what would be moved without writing anything'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('specify a model as app_label.ModelName')
+        cls = get_model(*args[0].split('.', 1))
+        if cls == None or not issubclass(cls, RedisShadow):
+            raise CommandError('%s is not a RedisShadow model' % args[0])
+        if options['from_shards'] == None or options['to_shards'] == None:
+            raise CommandError('specify both --from and --to')
+
+        from_shards = [ int(i) for i in options['from_shards'].split(',') ]
+        to_shards = [ int(i) for i in options['to_shards'].split(',') ]
+        if from_shards[0] != to_shards[0]:
+            raise CommandError('the first shard must stay the same')
+        to_ring = RedisShadowHashRing(to_shards)
+        batch_size = options['batch_size']
+
+        started = time.time()
+        seen = 0
+        moved = 0
+        for pool_index in from_shards:
+            rd = cls.redis_connection(pool_index)
+            batch = []
+            for k in rd.scan_iter(match = cls.redis_key_prefix() + '*', count = batch_size):
+                batch.append(k)
+                if len(batch) >= batch_size:
+                    moved += self.move_batch(cls, pool_index, to_ring, batch, options)
+                    seen += len(batch)
+                    batch = []
+            if len(batch) > 0:
+                moved += self.move_batch(cls, pool_index, to_ring, batch, options)
+                seen += len(batch)
+
+        self.stdout.write('%d records seen, %d %s in %.1fs' % (
+                seen, moved,
+                ('would be ' if options['dry_run'] else '') + ('removed' if options['cleanup'] else 'copied'),
+                time.time() - started))
+
+    # copy (or clean up) one batch of records found on a
+    # particular shard
+    # returns the number of records that don't belong there
+    def move_batch(self, cls, pool_index, to_ring, keys, options):
+        dlist = cls.redis_connection(pool_index).mget(keys)
+        pipes = {}
+        moved = 0
+        for d in dlist:
+            if d == None:
+                continue        # deleted since the scan
+            r = cls.redis_in(d)
+            new_pool_index = to_ring.node(r.redis_route())
+            if new_pool_index == pool_index:
+                continue
+            moved += 1
+            if options['dry_run']:
+                continue
+
+            # copying goes to the new shard, cleaning up
+            # happens where we found the record
+            target = pool_index if options['cleanup'] else new_pool_index
+            if target not in pipes:
+                pipes[target] = cls.redis_connection(target).pipeline(transaction = False)
+            if options['cleanup']:
+                r.redis_del_commands(pipes[target])
+            else:
+                r.redis_forget_index_entries()      # none of its entries are on the new shard yet
+                r.redis_set_commands(pipes[target])
+        for pipe in pipes.values():
+            pipe.execute()
+        return moved
@@ -0,0 +1,85 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from caxiam.redis_shadow import RedisShadowSpool, redis_connection, redis_load_scripts
+from optparse import make_option
+import redis
+import time
+
+# drain one list of the RedisShadow write-behind spool,
+# replaying the spooled commands against the shadow
+#
+# entries are moved atomically from the spool list to a
+# processing list before they are applied, and are only
+# removed from there once the shadow has accepted them;
+# a worker that dies (or a shadow node that goes down)
+# therefore loses nothing, and the next run replays the
+# processing list before taking anything new
+#
+# NOTE: run exactly one worker per spool list, or
+# writes to the same record may be applied out of order
+#
+#   ./manage redis_shadow_spool_worker --shard 0
+#   ./manage redis_shadow_spool_worker --shard 0 --once
+
+class Command(BaseCommand):
+    help = 'Replay the RedisShadow write-behind spool against the shadow servers'
+    option_list = BaseCommand.option_list + (
+            make_option('--shard', type = 'int', default = 0, help = 'which spool list to drain'),
+            make_option('--batch-size', type = 'int', default = 100, help = 'maximum number of entries to apply per round trip'),
+            make_option('--retry-delay', type = 'float', default = 1.0, help = 'seconds to wait before retrying after a connection error'),
+            make_option('--once', action = 'store_true', default = False, help = 'exit as soon as the spool is empty'),
+        )
+
+    def handle(self, *args, **options):
+        if not RedisShadowSpool.enabled():
+            raise CommandError('ILCLOUD_REDIS_SHADOW_SPOOL is not configured')
+        shard = options['shard']
+        if shard < 0 or shard >= RedisShadowSpool.shards():
+            raise CommandError('shard must be between 0 and %d' % (RedisShadowSpool.shards() - 1))
+
+        spool = RedisShadowSpool.connection()
+        spool_key = RedisShadowSpool.spool_key(shard)
+        processing_key = RedisShadowSpool.processing_key(shard)
+        scripts_loaded = False
+        applied = 0
+
+        while True:
+            try:
+                # spooled commands may include EVALSHA, so the
+                # shadow servers need our scripts loaded
+                if not scripts_loaded:
+                    for ci in range(len(settings.ILCLOUD_REDIS_SHADOW)):
+                        redis_load_scripts(redis_connection(ci))
+                    scripts_loaded = True
+
+                # anything already in the processing list was
+                # never confirmed; replay it first
+                entries = spool.lrange(processing_key, 0, -1)
+                if len(entries) == 0:
+                    entry = spool.brpoplpush(spool_key, processing_key, timeout = 1)
+                    if entry == None:
+                        if options['once']:
+                            break
+                        continue
+
+                    # grab whatever else is waiting, up to a batch
+                    pipe = spool.pipeline(transaction = False)
+                    for i in range(options['batch_size'] - 1):
+                        pipe.rpoplpush(spool_key, processing_key)
+                    entries = [ entry ] + [ e for e in pipe.execute() if e != None ]
+                else:
+                    # the processing list is newest-first
+                    entries.reverse()
+
+                for e in RedisShadowSpool.apply(entries):
+                    self.stderr.write('spooled command failed: %s' % (e,))
+                spool.delete(processing_key)
+                applied += len(entries)
+                self.stdout.write('%d entries applied (%d total)' % (len(entries), applied))
+
+            except redis.ConnectionError, e:
+                # leave everything in the processing list; it
+                # will be replayed once we can reconnect
+                self.stderr.write('connection error, retrying: %s' % (e,))
+                scripts_loaded = False
+                time.sleep(options['retry_delay'])
@@ -0,0 +1,162 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from caxiam.redis_shadow import RedisShadow, index_remove_script
+from optparse import make_option
+import datetime
+import time
+
+# check every index, mindex and zindex entry of a model
+# against the records it points at, and optionally repair
+# what is wrong; entries are read with HSCAN/SSCAN/ZSCAN
+# (so redis is never blocked), a batch at a time
+#
+# an entry is orphaned if its record is gone, or if the
+# record's current values no longer put it there (e.g.
+# it was re-saved before redis_set removed old entries);
+# a zindex member with the wrong score is also reported
+# (scores from datetimes only have to agree to the second,
+# since records are stored with whole seconds)
+#
+#   ./manage redis_shadow_verify_indices app_label.ModelName
+#   ./manage redis_shadow_verify_indices app_label.ModelName --repair
+#
+# NOTE: records missing from an index are not detected;
+# use rebuild_shadow for that
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = 'Find (and optionally remove) orphaned index entries of a RedisShadow model'
+    option_list = BaseCommand.option_list + (
+            make_option('--repair', action = 'store_true', default = False, help = 'remove orphaned entries and fix wrong scores'),
+            make_option('--batch-size', type = 'int', default = 500, help = 'number of entries to check per round trip'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('specify a model as app_label.ModelName')
+        cls = get_model(*args[0].split('.', 1))
+        if cls == None or not issubclass(cls, RedisShadow):
+            raise CommandError('%s is not a RedisShadow model' % args[0])
+
+        self.cls = cls
+        self.repair = options['repair']
+        self.batch_size = options['batch_size']
+        self.counts = { 'checked': 0, 'orphaned': 0, 'rescored': 0 }
+        self.datetime_slots = {}
+        started = time.time()
+
+        for pool_index in cls.redis_pool_indices():
+            rd = cls.redis_connection(pool_index)
+
+            idxs = getattr(cls, 'REDIS_SHADOW_INDEX', [])
+            for slot in range(len(idxs)):
+                if idxs[slot] != None:
+                    self.verify_key(rd, 'index', slot, cls.redis_index_key(slot))
+
+            for kind, attr in ( ( 'mindex', 'REDIS_SHADOW_MINDEX' ), ( 'zindex', 'REDIS_SHADOW_ZINDEX' ) ):
+                idxs = getattr(cls, attr, [])
+                for slot in range(len(idxs)):
+                    if idxs[slot] != None:
+                        for k in cls.redis_iter_index_keys(kind, slot, self.batch_size, pool_index):
+                            self.verify_key(rd, kind, slot, k)
+
+        self.stdout.write('%d entries checked, %d orphaned, %d with the wrong score%s in %.1fs' % (
+                self.counts['checked'], self.counts['orphaned'], self.counts['rescored'],
+                ' (repaired)' if self.repair else '', time.time() - started))
+
+    # walk one index key a batch at a time
+    def verify_key(self, rd, kind, slot, k):
+        if kind == 'index':
+            members = rd.hscan_iter(k, count = self.batch_size)
+        elif kind == 'mindex':
+            members = rd.sscan_iter(k, count = self.batch_size)
+        else:
+            members = rd.zscan_iter(k, count = self.batch_size)
+        batch = []
+        for m in members:
+            batch.append(m)
+            if len(batch) >= self.batch_size:
+                self.verify_batch(rd, kind, slot, k, batch)
+                batch = []
+        if len(batch) > 0:
+            self.verify_batch(rd, kind, slot, k, batch)
+
+    # check one batch of entries of an index key; members
+    # are pks, except for index (field, pk) and zindex
+    # (pk, score) pairs
+    def verify_batch(self, rd, kind, slot, k, batch):
+        cls = self.cls
+        if kind == 'index':
+            pks = [ m[1] for m in batch ]
+        elif kind == 'mindex':
+            pks = batch
+        else:
+            pks = [ m[0] for m in batch ]
+
+        # fetch the records, and work out the entries each
+        # of them should have in this slot
+        records = {}
+        valid_pks = []
+        for pk in set(pks):
+            try:
+                valid_pks.append(int(pk))
+            except ValueError:
+                pass            # not a pk at all, so certainly an orphan
+        if len(valid_pks) > 0:
+            for pk, d in zip(valid_pks, rd.mget([ cls.redis_key(pk) for pk in valid_pks ])):
+                if d != None:
+                    records[str(pk)] = cls.redis_in(d)
+        indexer = cls.redis_indexer()
+        entries = {}
+        for pk, r in records.iteritems():
+            entries[pk] = indexer.entries(r, [ (kind, slot) ])
+
+        pipe = rd.pipeline(transaction = False)
+        for m, pk in zip(batch, pks):
+            self.counts['checked'] += 1
+            expected = entries.get(pk)
+            if kind == 'index':
+                ok = expected != None and ( 'index', k, m[0] ) in expected
+            elif kind == 'mindex':
+                ok = expected != None and ( 'mindex', slot, k ) in expected
+            else:
+                ok = False
+                for e in (expected or []):
+                    if e[2] == k:
+                        ok = True
+                        if not self.score_matches(slot, records[pk], e[3], m[1]):
+                            self.counts['rescored'] += 1
+                            if self.repair:
+                                pipe.zadd(k, e[3], pk)
+            if ok:
+                continue
+
+            self.counts['orphaned'] += 1
+            if self.repair:
+                if kind == 'index':
+                    index_remove_script(keys = [ k ], args = [ m[0], pk ], client = pipe)
+                elif kind == 'mindex':
+                    pipe.srem(k, pk)
+                else:
+                    pipe.zrem(k, pk)
+        if len(pipe.command_stack) > 0:
+            pipe.execute()
+
+    # does a zindex member's score agree with the one its
+    # record gives it?
+    # NOTE: a datetime score keeps the microseconds it was
+    # written with, but records are stored with whole
+    # seconds (see ilcommon.to_json), so the score worked
+    # out from a decoded record is usually a little lower
+    def score_matches(self, slot, record, expected, actual):
+        if slot not in self.datetime_slots:
+            indexer = self.cls.redis_indexer()
+            for kind, s, fields, paths, score_path in indexer.slots:
+                if kind == 'zindex' and s == slot:
+                    v = indexer.value(record, score_path, {})
+                    if v == None:
+                        return float(expected) == actual     # can't tell yet
+                    self.datetime_slots[slot] = isinstance(v, datetime.datetime)
+        if self.datetime_slots[slot]:
+            return long(expected) // 1000000 == long(actual) // 1000000
+        return float(expected) == actual
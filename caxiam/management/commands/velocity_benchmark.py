@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from caxiam.velocity.models import VelocityEvent, VelocityType
+from optparse import make_option
+import datetime
+import random
+import time
+
+# micro-benchmark for velocity rule evaluation: compares
+# VelocityType.rule_weights (sorted arrays, prefix sums and
+# bisection) against the event-by-event scan it replaces,
+# using a synthesized type and events (nothing touches
+# redis or the database)
+#
+#   ./manage velocity_benchmark
+#   ./manage velocity_benchmark --events 10000 --rules 20 --iterations 10
+
+class Command(BaseCommand):
+    help = 'Compare prefix-sum velocity rule evaluation against the generic scan'
+    option_list = BaseCommand.option_list + (
+            make_option('--events', type = 'int', default = 10000, help = 'number of events in the window'),
+            make_option('--rules', type = 'int', default = 20, help = 'number of rules in the type'),
+            make_option('--iterations', type = 'int', default = 10, help = 'number of evaluations per run'),
+            make_option('--seed', type = 'int', default = 1, help = 'random seed for the synthesized events'),
+        )
+
+    def handle(self, *args, **options):
+        if options['events'] < 1 or options['rules'] < 1 or options['iterations'] < 1:
+            raise CommandError('--events, --rules and --iterations must be at least 1')
+        random.seed(options['seed'])
+
+        # rules from a minute up to 30 days
+        n_rules = options['rules']
+        longest = 30 * 86400
+        rules = []
+        for i in range(n_rules):
+            rules.append({
+                    'timespan': int(60 * (longest / 60.0) ** (float(i) / max(n_rules - 1, 1))),
+                    'limit': random.randint(1, options['events']),
+                    'trigger': random.choice([ 'equal', 'above' ]),
+                    'action': None,
+                    'params': { 'rule': i },
+                })
+        vt = VelocityType(tag = 'benchmark', rules = rules)
+
+        # events spread over the longest timespan, in order
+        # (as get_events returns them)
+        now = timezone.now()
+        events = []
+        for i in range(options['events']):
+            events.append(VelocityEvent(
+                    weight = random.randint(1, 3),
+                    date_created = now - datetime.timedelta(0, random.uniform(0, longest)),
+                ))
+        events.sort(key = lambda ve: ve.date_created)
+
+        # make sure the two paths actually agree before we
+        # bother timing them
+        if vt.rule_weights(events, now) != vt.rule_weights_generic(events, now):
+            raise CommandError('rule_weights does not match the generic scan')
+
+        n = options['iterations']
+        self.stdout.write('%d events x %d rules: %d iterations' % (len(events), n_rules, n))
+        generic = self.report('generic scan', n, lambda: vt.rule_weights_generic(events, now))
+        compiled = self.report('prefix sums', n, lambda: vt.rule_weights(events, now))
+        self.stdout.write('  speedup: %.1fx' % (generic / max(compiled, 1e-9)))
+
+    def report(self, label, n, fn):
+        started = time.time()
+        for i in xrange(n):
+            fn()
+        elapsed = time.time() - started
+        self.stdout.write('  %-20s %8.3fs %10.1f ms/evaluation' % (label, elapsed, elapsed * 1000 / n))
+        return elapsed
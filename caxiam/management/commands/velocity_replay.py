@@ -0,0 +1,231 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from caxiam.common import parse_datetime
+from caxiam.velocity.models import AuditTrail, VelocityEvent, VelocityType, velocity_rule_fired
+from optparse import make_option
+import datetime
+import json
+import multiprocessing
+import pytz
+import time
+import zlib
+
+# replay the history of a velocity type through a
+# candidate set of rules (and its current ones, for
+# comparison) and report how often each rule would have
+# fired; this works like test_event(): each event is
+# checked against the events before it plus itself, and
+# no actions are done
+#
+# the history is either the recorded events (walking the
+# type's zindex keys) or the AuditTrail entries whose
+# event_type is the type's tag (each counting as weight 1)
+#
+#   ./manage velocity_replay some_tag --rules new_rules.json
+#   ./manage velocity_replay some_tag --rules new_rules.json --since 2014-06-01T00:00:00 --processes 8
+#   ./manage velocity_replay some_tag --source audit
+#
+# each index key (type, user, game, gamehistory, unique
+# ID) is replayed separately, in time order, a batch at a
+# time, keeping only the longest rule's window in memory;
+# the keys are shared out among the processes by hash
+#
+# the events from the longest rule's timespan before
+# --since are read too, so the windows are full when the
+# replay starts; they fill the windows but aren't counted
+#
+# NOTE: events that have been cancelled or expunged are
+# not in the zindex any more, so they are not replayed
+
+# slide each rule's window along one index key's events
+class RuleReplay(object):
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.counts = [ 0 ] * len(rules)
+        self.failures = 0       # events that a rule with no action would have refused
+        self.reset()
+
+    # start on a new index key
+    def reset(self):
+        self.entries = []
+        self.starts = [ 0 ] * len(self.rules)
+        self.sums = [ 0 ] * len(self.rules)
+
+    # add the next event (in time order) and count the
+    # rules it fires; with count = False, the event only
+    # fills the windows (for events before the replay)
+    def add(self, date_created, weight, count = True):
+        self.entries.append(( date_created, weight ))
+        failed = False
+        for i in range(len(self.rules)):
+            r = self.rules[i]
+            date_starting = date_created - datetime.timedelta(0, r['timespan'])
+            self.sums[i] += weight
+            while self.starts[i] < len(self.entries) and self.entries[self.starts[i]][0] <= date_starting:
+                self.sums[i] -= self.entries[self.starts[i]][1]
+                self.starts[i] += 1
+            if count and velocity_rule_fired(r, self.sums[i]):
+                self.counts[i] += 1
+                if r['action'] == None:
+                    failed = True
+        if failed:
+            self.failures += 1
+
+        # drop entries that have left every window
+        first = min(self.starts)
+        if first > 1000 and first * 2 > len(self.entries):
+            del self.entries[:first]
+            self.starts = [ s - first for s in self.starts ]
+
+# replay one partition of the history against each set of
+# rules; job is ( source, type id, type tag, index fields
+# required, rule sets, warmup, since, until, partition, number of
+# partitions, batch size, index keys )
+# returns ( events, keys, [ ( counts, failures ) per rule set ] )
+def replay_partition(job):
+    source, type_id, tag, required, rule_sets, warmup, since, until, partition, partitions, batch_size, keys = job
+    replays = [ RuleReplay(rules) for rules in rule_sets ]
+    events_count = 0
+    keys_count = 0
+
+    if source == 'events':
+        for vals in keys:
+            keys_count += 1
+            for replay in replays:
+                replay.reset()
+            cursor = None
+            while True:
+                events, cursor = VelocityEvent.redis_page_by_zindex(0, list(vals), batch_size, cursor, score_range = [ warmup, until ])
+                for ve in events:
+                    count = ve.date_created > since
+                    if count:
+                        events_count += 1
+                    for replay in replays:
+                        replay.add(ve.date_created, ve.weight, count)
+                if cursor == None:
+                    break
+
+    else:
+        # the audit trail only has a user and a unique ID
+        order = [ f for f in ( 'user_id', 'unique_id' ) if f in required ]
+        qs = AuditTrail.objects.filter(event_type = tag, date_created__gt = warmup, date_created__lte = until)
+        if partitions > 1:
+            qs = qs.extra(where = [ '(user_id IS NULL AND %s = 0) OR MOD(user_id, %s) = %s' ], params = [ partition, partitions, partition ])
+        last = None
+        for a in qs.order_by(*(order + [ 'date_created', 'id' ])).only(*(order + [ 'date_created' ])).iterator():
+            k = tuple([ getattr(a, f) for f in order ])
+            if k != last:
+                keys_count += 1
+                for replay in replays:
+                    replay.reset()
+                last = k
+            count = a.date_created > since
+            if count:
+                events_count += 1
+            for replay in replays:
+                replay.add(a.date_created, 1, count)
+
+    return events_count, keys_count, [ ( replay.counts, replay.failures ) for replay in replays ]
+
+class Command(BaseCommand):
+    args = '<type_tag>'
+    help = 'Report how often a candidate set of velocity rules would have fired on past events'
+    option_list = BaseCommand.option_list + (
+            make_option('--rules', default = None, help = 'JSON file holding the candidate rules (default: the current rules)'),
+            make_option('--source', default = 'events', help = 'replay the recorded events ("events") or the audit trail ("audit")'),
+            make_option('--since', default = None, help = 'replay from this UTC time, as YYYY-MM-DDTHH:MM:SS (default: 30 days ago)'),
+            make_option('--until', default = None, help = 'replay up to this UTC time (default: now)'),
+            make_option('--processes', type = 'int', default = multiprocessing.cpu_count(), help = 'number of processes to replay with'),
+            make_option('--batch-size', type = 'int', default = 1000, help = 'number of events to read per round trip'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('specify a velocity type tag')
+        vt = VelocityType.redis_get_by_index(0, [ args[0] ])
+        if vt == None:
+            raise CommandError('invalid velocity type tag %s' % args[0])
+        if options['source'] not in ( 'events', 'audit' ):
+            raise CommandError('--source must be "events" or "audit"')
+
+        rule_sets = [ vt.rules ]
+        labels = [ 'current' ]
+        if options['rules'] != None:
+            with open(options['rules']) as f:
+                rule_sets.insert(0, json.load(f))
+            labels.insert(0, 'candidate')
+
+        until = self.parse_date(options['until']) or timezone.now()
+        since = self.parse_date(options['since']) or until - datetime.timedelta(days = 30)
+
+        # read back far enough to fill the longest window
+        # before since
+        timespans = [ r['timespan'] for rules in rule_sets for r in rules ]
+        warmup = since - datetime.timedelta(0, max(timespans) if len(timespans) > 0 else 0)
+
+        # rules only see events from the same index key, so
+        # each process takes its own share of the keys
+        processes = max(options['processes'], 1)
+        required = [ f for f, r in (
+                ( 'user_id', vt.requires_user ),
+                ( 'game_id', vt.requires_game ),
+                ( 'gamehistory_id', vt.requires_gamehistory ),
+                ( 'unique_id', vt.requires_unique_id ),
+            ) if r ]
+        if options['source'] == 'audit' and 'user_id' not in required:
+            processes = 1       # the audit trail can only be shared out by user
+        partition_keys = [ [] for i in range(processes) ]
+        if options['source'] == 'events':
+            for vals in self.index_keys(vt, options['batch_size']):
+                partition_keys[zlib.crc32(':'.join(vals)) % processes].append(vals)
+        jobs = [ ( options['source'], vt.id, vt.tag, required, rule_sets, warmup, since, until, i, processes, options['batch_size'], partition_keys[i] ) for i in range(processes) ]
+
+        started = time.time()
+        if processes == 1:
+            results = [ replay_partition(jobs[0]) ]
+        else:
+            # each process opens its own database and redis
+            # connections
+            connection.close()
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(replay_partition, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+        events_count = sum([ r[0] for r in results ])
+        keys_count = sum([ r[1] for r in results ])
+        self.stdout.write('%s: %d events in %d index keys, %s to %s, replayed in %.1fs with %d processes' % (
+                vt.tag, events_count, keys_count, since.isoformat(), until.isoformat(), time.time() - started, processes))
+        for n in range(len(rule_sets)):
+            counts = [ 0 ] * len(rule_sets[n])
+            failures = 0
+            for r in results:
+                counts = [ a + b for a, b in zip(counts, r[2][n][0]) ]
+                failures += r[2][n][1]
+            self.stdout.write('%s rules: %d events refused' % (labels[n], failures))
+            for i in range(len(rule_sets[n])):
+                r = rule_sets[n][i]
+                self.stdout.write('  %2d  %8ds  %-5s %6s  %-20s %8d fired' % (i, r['timespan'], r['trigger'], r['limit'], r['action'], counts[i]))
+
+    def parse_date(self, v):
+        if v == None:
+            return None
+        d = parse_datetime(v)
+        if d == None:
+            raise CommandError('invalid time %s (use YYYY-MM-DDTHH:MM:SS)' % v)
+        return d.replace(tzinfo = pytz.utc)
+
+    # find the index values of each of a type's zindex
+    # keys, without KEYS (see redis_iter_index_keys)
+    def index_keys(self, vt, batch_size):
+        base = VelocityEvent.redis_zindex_key(0, [ vt.id ]) + ':'
+        seen = set()
+        for pool_index in VelocityEvent.redis_pool_indices():
+            for k in VelocityEvent.redis_iter_index_keys('zindex', 0, batch_size, pool_index):
+                if k.startswith(base) and k not in seen:
+                    seen.add(k)
+                    yield [ str(vt.id) ] + k[len(base):].split(':', 3)
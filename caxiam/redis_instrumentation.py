@@ -0,0 +1,301 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+import bisect
+import datetime
+import json
+import os
+import redis
+from redis.client import StrictPipeline
+import time
+
+# structured instrumentation for the redis shadow
+#
+# when enabled, every command sent through a shadow
+# connection (see redis_shadow.redis_client) is counted,
+# per model, along with the bytes sent and received and
+# the time spent; each round trip (a single command or a
+# whole pipeline) goes into a latency histogram, and each
+# pipeline into a size histogram
+#
+# totals are kept for the life of the process, for the
+# current request, and per view; CaxiamDebugMiddleware
+# reports each request's totals (CAXIAM_DUMP_REDIS) and
+# redis_stats_view serves the process totals as JSON
+#
+# settings:
+#
+#   ILCLOUD_REDIS_SHADOW_INSTRUMENT     True to enable (default False)
+#
+# NOTE: commands are attributed to a model by their
+# first key: dbshadow*:<Model>:... keys belong to that
+# model, anything else is filed under the part of the
+# key before the first colon (e.g. notification_queue)
+#
+# NOTE: stats are per process; with a prefork server
+# each worker only knows about its own requests
+
+# histogram bucket upper bounds; each histogram has one
+# more bucket for anything larger
+LATENCY_BUCKETS = ( 0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 1000 )     # milliseconds
+PIPELINE_SIZE_BUCKETS = ( 1, 2, 5, 10, 25, 50, 100, 250, 1000 )         # commands
+
+# find the histogram bucket for a value
+def histogram_bucket(buckets, v):
+    return bisect.bisect_left(buckets, v)
+
+# label each bucket of a histogram for reporting
+def histogram_labels(buckets):
+    return [ '<=%s' % (b,) for b in buckets ] + [ '>%s' % (buckets[-1],) ]
+
+# determine which model (or key family) a command is for
+def command_model(args):
+    if len(args) < 2:
+        return '-'
+    if str(args[0]).upper() in ( 'EVALSHA', 'EVAL' ):
+        if len(args) < 4 or int(args[2]) == 0:
+            return '-'
+        k = args[3]
+    else:
+        k = args[1]
+    if not isinstance(k, basestring):
+        return '-'
+    parts = k.split(':')
+    if parts[0].startswith('dbshadow') and len(parts) > 1:
+        return parts[1]
+    return parts[0]
+
+# approximate the size of a command or a response on
+# the wire (just the payload, not the protocol)
+def payload_size(v):
+    if v == None:
+        return 0
+    if isinstance(v, str):
+        return len(v)
+    if isinstance(v, unicode):
+        return len(v.encode('utf-8'))
+    if isinstance(v, (list, tuple, set)):
+        return sum([ payload_size(i) for i in v ])
+    if isinstance(v, dict):
+        return sum([ payload_size(k) + payload_size(i) for k, i in v.iteritems() ])
+    return len(str(v))
+
+# a set of counters for a process, a request or a view
+class RedisShadowStats(object):
+
+    def __init__(self):
+        self.date_started = datetime.datetime.utcnow()
+        self.requests = 0
+        self.round_trips = 0
+        self.pipelines = 0
+        self.time = 0.0
+        self.latency = [ 0 ] * (len(LATENCY_BUCKETS) + 1)
+        self.pipeline_sizes = [ 0 ] * (len(PIPELINE_SIZE_BUCKETS) + 1)
+        self.models = {}
+
+    def model(self, name):
+        m = self.models.get(name)
+        if m == None:
+            m = {
+                    'commands': {},
+                    'round_trips': 0,
+                    'bytes_out': 0,
+                    'bytes_in': 0,
+                    'time': 0.0,
+                    'latency': [ 0 ] * (len(LATENCY_BUCKETS) + 1),
+                }
+            self.models[name] = m
+        return m
+
+    # record a single round trip; commands is a list of
+    # argument tuples and responses the matching results
+    # NOTE: the time of a pipeline is shared out evenly
+    # among its commands, but each model involved counts
+    # the whole round trip in its latency histogram
+    def record(self, commands, responses, elapsed, pipeline):
+        if len(commands) == 0:
+            return
+        ms = elapsed * 1000
+        bucket = histogram_bucket(LATENCY_BUCKETS, ms)
+        self.round_trips += 1
+        self.time += elapsed
+        self.latency[bucket] += 1
+        if pipeline:
+            self.pipelines += 1
+            self.pipeline_sizes[histogram_bucket(PIPELINE_SIZE_BUCKETS, len(commands))] += 1
+
+        share = elapsed / len(commands)
+        models_seen = set()
+        for args, response in zip(commands, responses):
+            name = command_model(args)
+            m = self.model(name)
+            command = str(args[0]).upper()
+            m['commands'][command] = m['commands'].get(command, 0) + 1
+            m['bytes_out'] += payload_size(args)
+            m['bytes_in'] += payload_size(response)
+            m['time'] += share
+            if name not in models_seen:
+                models_seen.add(name)
+                m['round_trips'] += 1
+                m['latency'][bucket] += 1
+
+    # total number of commands sent
+    def command_count(self):
+        return sum([ sum(m['commands'].values()) for m in self.models.values() ])
+
+    # add another set of counters into this one
+    def merge(self, other):
+        self.requests += other.requests
+        self.round_trips += other.round_trips
+        self.pipelines += other.pipelines
+        self.time += other.time
+        self.latency = [ a + b for a, b in zip(self.latency, other.latency) ]
+        self.pipeline_sizes = [ a + b for a, b in zip(self.pipeline_sizes, other.pipeline_sizes) ]
+        for name, o in other.models.iteritems():
+            m = self.model(name)
+            for command, count in o['commands'].iteritems():
+                m['commands'][command] = m['commands'].get(command, 0) + count
+            for k in ( 'round_trips', 'bytes_out', 'bytes_in', 'time' ):
+                m[k] += o[k]
+            m['latency'] = [ a + b for a, b in zip(m['latency'], o['latency']) ]
+
+    # convert to something JSON-serializable
+    def as_dict(self):
+        latency_labels = histogram_labels(LATENCY_BUCKETS)
+        models = {}
+        for name, m in self.models.iteritems():
+            models[name] = {
+                    'commands': m['commands'],
+                    'round_trips': m['round_trips'],
+                    'bytes_out': m['bytes_out'],
+                    'bytes_in': m['bytes_in'],
+                    'time': round(m['time'], 6),
+                    'latency_ms': dict(zip(latency_labels, m['latency'])),
+                }
+        return {
+                'since': self.date_started.isoformat(),
+                'requests': self.requests,
+                'round_trips': self.round_trips,
+                'commands': self.command_count(),
+                'pipelines': self.pipelines,
+                'time': round(self.time, 6),
+                'latency_ms': dict(zip(latency_labels, self.latency)),
+                'pipeline_sizes': dict(zip(histogram_labels(PIPELINE_SIZE_BUCKETS), self.pipeline_sizes)),
+                'models': models,
+            }
+
+class RedisShadowInstrumentation(object):
+
+    # counters for the life of the process
+    process_stats = RedisShadowStats()
+
+    # counters for the current request, or None if we are
+    # not in a request (or not instrumenting)
+    request_stats = None
+
+    # counters for each view, keyed by view name
+    view_stats = {}
+
+    @classmethod
+    def enabled(cls):
+        return getattr(settings, 'ILCLOUD_REDIS_SHADOW_INSTRUMENT', False)
+
+    @classmethod
+    def record(cls, commands, responses, elapsed, pipeline = False):
+        if not cls.enabled():
+            return
+        cls.process_stats.record(commands, responses, elapsed, pipeline)
+        if cls.request_stats != None:
+            cls.request_stats.record(commands, responses, elapsed, pipeline)
+
+    @classmethod
+    def start_request(cls):
+        cls.request_stats = RedisShadowStats() if cls.enabled() else None
+
+    # finish off the current request, adding its counters
+    # to those for the view that handled it
+    # returns the request's counters (or None)
+    @classmethod
+    def finish_request(cls, view_name):
+        stats = cls.request_stats
+        cls.request_stats = None
+        if stats == None:
+            return None
+        stats.requests = 1
+        cls.process_stats.requests += 1
+        if view_name != None:
+            if view_name not in cls.view_stats:
+                cls.view_stats[view_name] = RedisShadowStats()
+            cls.view_stats[view_name].merge(stats)
+        return stats
+
+    @classmethod
+    def reset(cls):
+        cls.process_stats = RedisShadowStats()
+        cls.view_stats = {}
+
+    # everything we know, with the views that make the
+    # most round trips first
+    @classmethod
+    def report(cls):
+        views = []
+        for name, stats in cls.view_stats.iteritems():
+            views.append({
+                    'view': name,
+                    'requests': stats.requests,
+                    'round_trips': stats.round_trips,
+                    'round_trips_per_request': round(float(stats.round_trips) / max(stats.requests, 1), 2),
+                    'commands': stats.command_count(),
+                    'time': round(stats.time, 6),
+                    'models': sorted(stats.models.keys()),
+                })
+        views.sort(key = lambda v: v['round_trips'], reverse = True)
+        return {
+                'pid': os.getpid(),
+                'enabled': cls.enabled(),
+                'totals': cls.process_stats.as_dict(),
+                'views': views,
+            }
+
+# a redis pipeline that records each execution as a
+# single round trip
+class InstrumentedStrictPipeline(StrictPipeline):
+
+    def execute(self, *args, **kwargs):
+        commands = [ c[0] for c in self.command_stack ]
+        rv = None
+        started = time.time()
+        try:
+            rv = super(InstrumentedStrictPipeline, self).execute(*args, **kwargs)
+            return rv
+        finally:
+            RedisShadowInstrumentation.record(commands, rv if rv != None else [ None ] * len(commands), time.time() - started, True)
+
+# a redis client that records each command, and hands
+# out instrumented pipelines
+class InstrumentedStrictRedis(redis.StrictRedis):
+
+    def execute_command(self, *args, **kwargs):
+        rv = None
+        started = time.time()
+        try:
+            rv = super(InstrumentedStrictRedis, self).execute_command(*args, **kwargs)
+            return rv
+        finally:
+            RedisShadowInstrumentation.record([ args ], [ rv ], time.time() - started)
+
+    def pipeline(self, transaction = True, shard_hint = None):
+        return InstrumentedStrictPipeline(self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint)
+
+# serve this process's totals as JSON (staff only);
+# pass ?reset=1 to start counting again
+# NOTE: include caxiam.debug_urls to expose this
+def redis_stats_view(request):
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    report = RedisShadowInstrumentation.report()
+    if request.GET.get('reset'):
+        RedisShadowInstrumentation.reset()
+    return HttpResponse(json.dumps(report, indent = 2, sort_keys = True), content_type = 'application/json')
@@ -1,13 +1,29 @@
+from collections import OrderedDict
 from django.conf import settings
+from django.db import models
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import class_prepared
+from caxiam.redis_instrumentation import InstrumentedStrictPipeline, InstrumentedStrictRedis, RedisShadowInstrumentation
 from ilarcade import ilcommon
+import base64
+import bisect
+import copy
 import datetime
+import hashlib
 import json
 import os
 import pytz
 import random
 import redis
-from redis.client import StrictPipeline
 import time
+import zlib
+
+# msgpack is optional; it is only needed by models
+# which ask for REDIS_SHADOW_FORMAT = 'msgpack'
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # exception classes
 class RedisShadowException(Exception): pass
@@ -15,7 +31,9 @@ class RedisShadowUnknownFieldException(RedisShadowException): pass
 class RedisShadowLockException(RedisShadowException): pass
 
 # a debugging wrapper for redis pipelines
-class DebugStrictPipeline(StrictPipeline):
+# NOTE: also instrumented, if that is enabled (see
+# caxiam.redis_instrumentation)
+class DebugStrictPipeline(InstrumentedStrictPipeline):
 
     def execute(self, *args, **kwargs):
         print "[pid:%d]" % os.getpid(), 'REDIS PIPELINE END'
@@ -30,7 +48,7 @@ class DebugStrictPipeline(StrictPipeline):
         return rv
 
 # a debugging wrapper for redis clients
-class DebugStrictRedis(redis.StrictRedis):
+class DebugStrictRedis(InstrumentedStrictRedis):
 
     def execute_command(self, *args, **kwargs):
         print "[pid:%d]" % os.getpid(), 'REDIS COMMAND:', repr(args), repr(kwargs)
@@ -52,15 +70,125 @@ class DebugStrictRedis(redis.StrictRedis):
 # storage because we are running a prefork
 # server model and uwsgi will silently fail
 # on threading-related calls
-redis_pools = [ redis.ConnectionPool(host = h, port = p, db = db) for h,p,db in settings.ILCLOUD_REDIS_SHADOW ]
+redis_pools = [ redis.ConnectionPool(host = e[0], port = e[1], db = e[2]) for e in settings.ILCLOUD_REDIS_SHADOW ]
+
+# each entry in ILCLOUD_REDIS_SHADOW may list read
+# replicas of its server as a fourth item, e.g.
+#
+#   ( 'shadow1', 6379, 0, [ ( 'shadow1-r1', 6379, 0 ), ( 'shadow1-r2', 6379, 0 ) ] )
+#
+# these get their own pools; pure reads are spread over
+# them round-robin (see redis_read_connection)
+redis_replica_pools = [
+        [ redis.ConnectionPool(host = h, port = p, db = db) for h,p,db in (e[3] if len(e) > 3 else []) ]
+        for e in settings.ILCLOUD_REDIS_SHADOW
+    ]
+redis_replica_next = [ 0 ] * len(redis_pools)
 
 # fetch a connection from a pool (mostly for
 # code not part of a Model)
 def redis_connection(idx):
+    return redis_client(redis_pools[idx])
+
+# fetch a connection for reading from a pool; this is
+# one of the pool's replicas, if it has any, unless
+# this request has pinned the pool's reads to the
+# primary (see redis_pin_primary)
+# NOTE: replicas lag behind the primary, so only use
+# this for reads that can stand to be slightly stale
+def redis_read_connection(idx):
+    replicas = redis_replica_pools[idx]
+    if len(replicas) == 0 or idx in RedisShadowMiddleware.primary_pins:
+        return redis_connection(idx)
+    i = redis_replica_next[idx] % len(replicas)
+    redis_replica_next[idx] = i + 1
+    return redis_client(replicas[i])
+
+def redis_client(pool):
     if settings.ILCLOUD_REDIS_SHADOW_DUMP_REQUESTS:
-        return DebugStrictRedis(connection_pool = redis_pools[idx])
+        return DebugStrictRedis(connection_pool = pool)
+    elif RedisShadowInstrumentation.enabled():
+        return InstrumentedStrictRedis(connection_pool = pool)
     else:
-        return redis.StrictRedis(connection_pool = redis_pools[idx])
+        return redis.StrictRedis(connection_pool = pool)
+
+# send all further reads from a pool to its primary,
+# for the rest of the request, so that we read our own
+# writes; called whenever we write or lock something
+# NOTE: set ILCLOUD_REDIS_SHADOW_READ_YOUR_WRITES to
+# False to keep reading from the replicas regardless
+def redis_pin_primary(idx):
+    if getattr(settings, 'ILCLOUD_REDIS_SHADOW_READ_YOUR_WRITES', True):
+        RedisShadowMiddleware.primary_pins.add(idx)
+
+# pin every pool's reads to its primary; called when we
+# take a lock, since a lock guards whatever the caller
+# reads under it, which is often in other models' pools
+# (e.g. the velocity locks guard VelocityEvent windows)
+def redis_pin_all_primaries():
+    for idx in range(len(redis_pools)):
+        redis_pin_primary(idx)
+
+# a consistent hash ring over a set of pools, used to
+# spread the records of a sharded model across several
+# redis servers (see REDIS_SHADOW_SHARDS)
+# NOTE: each pool is placed on the ring many times by
+# hashing its host:port:db rather than its index, so
+# adding a pool to the list (wherever it goes) only moves
+# about 1/n of the records, and only onto the new pool
+class RedisShadowHashRing(object):
+
+    REPLICAS = 160
+
+    def __init__(self, pool_indices, replicas = REPLICAS):
+        self.pool_indices = list(pool_indices)
+        points = []
+        for pool_index in self.pool_indices:
+            label = '%s:%s:%s' % tuple(settings.ILCLOUD_REDIS_SHADOW[pool_index][:3])
+            for i in range(replicas):
+                points.append(( self.hash('%s-%d' % (label, i)), pool_index ))
+        points.sort()
+        self.hashes = [ p[0] for p in points ]
+        self.nodes = [ p[1] for p in points ]
+
+    @staticmethod
+    def hash(s):
+        return long(hashlib.md5(s).hexdigest()[:8], 16)
+
+    # find the pool index responsible for a routing value
+    def node(self, route):
+        if isinstance(route, unicode):
+            route = route.encode('utf-8')
+        else:
+            route = str(route)
+        i = bisect.bisect(self.hashes, self.hash(route))
+        if i == len(self.hashes):
+            i = 0
+        return self.nodes[i]
+
+# fetch a list of keys, each of which may be found in any
+# of a list of pools, using one MGET per pool; requests
+# is a list of (pool indices, key) tuples, and the values
+# come back in the same order, with None for anything
+# that wasn't found
+# NOTE: a pool is only asked for the keys that haven't
+# already turned up in an earlier pool
+# NOTE: reads go to a replica unless primary is True
+def redis_mget_routed(requests, primary = False):
+    by_pool = OrderedDict()
+    for i in range(len(requests)):
+        for pool_index in requests[i][0]:
+            by_pool.setdefault(pool_index, []).append(i)
+    rv = [ None ] * len(requests)
+    for pool_index, positions in by_pool.iteritems():
+        positions = [ i for i in positions if rv[i] == None ]
+        if len(positions) == 0:
+            continue
+        rd = redis_connection(pool_index) if primary else redis_read_connection(pool_index)
+        dlist = rd.mget([ requests[i][1] for i in positions ])
+        for i, d in zip(positions, dlist):
+            rv[i] = d
+    return rv
 
 # unlocking requires us to inspect the contents
 # of the lock to make sure it belongs to our pid,
@@ -68,6 +196,22 @@ def redis_connection(idx):
 # atomic operation; a script is thus required.
 # see http://redis.io/commands/set for details
 rd = redis.StrictRedis(connection_pool = redis_pools[0])    # doesn't matter if it's debug
+
+# every script we use is registered through here, so
+# that anything replaying raw EVALSHA commands (see
+# RedisShadowSpool) can make sure they are all loaded
+redis_scripts = []
+
+def redis_register_script(lua):
+    script = rd.register_script(lua)
+    redis_scripts.append(script)
+    return script
+
+# load every registered script into a server
+def redis_load_scripts(client):
+    for script in redis_scripts:
+        client.script_load(script.script)
+
 lua = '''
 if redis.call("get",KEYS[1]) == ARGV[1]
 then
@@ -76,13 +220,850 @@ else
     return 0
 end
 '''
-unlock_script = rd.register_script(lua)
+unlock_script = redis_register_script(lua)
+
+# as above, but also leave a wake-up token on the lock's
+# wake list so that a waiter blocked in BLPOP can try
+# again right away; only one token is kept (we only hand
+# the lock to one waiter) and it expires after ARGV[2]
+# milliseconds in case nobody is waiting. KEYS[1] is the
+# lock key and KEYS[2] is the wake list
+lua = '''
+if redis.call("get",KEYS[1]) == ARGV[1]
+then
+    redis.call("del",KEYS[1])
+    redis.call("lpush",KEYS[2],1)
+    redis.call("ltrim",KEYS[2],0,0)
+    redis.call("pexpire",KEYS[2],ARGV[2])
+    return 1
+else
+    return 0
+end
+'''
+unlock_notify_script = redis_register_script(lua)
+
+# take a whole set of locks at once, or none of them;
+# KEYS are the lock keys (in locking order), ARGV[1] is
+# our pid and ARGV[2] the lock duration in seconds.
+# returns 0 on success, or the (1-based) position of the
+# first lock that someone else already holds
+lua = '''
+for i = 1, #KEYS do
+    if not redis.call("set",KEYS[i],ARGV[1],"EX",ARGV[2],"NX") then
+        for j = 1, i - 1 do
+            redis.call("del",KEYS[j])
+        end
+        return i
+    end
+end
+return 0
+'''
+lock_many_script = redis_register_script(lua)
+
+# release a whole set of locks at once, skipping any
+# that no longer belong to us; the first half of KEYS are
+# the lock keys and the second half their wake lists,
+# ARGV[1] is our pid, ARGV[2] is "1" to leave wake-up
+# tokens (see unlock_notify_script) and ARGV[3] is the
+# token expiry in milliseconds. returns the number of
+# locks released
+lua = '''
+local n = #KEYS / 2
+local released = 0
+for i = 1, n do
+    if redis.call("get",KEYS[i]) == ARGV[1] then
+        redis.call("del",KEYS[i])
+        if ARGV[2] == "1" then
+            redis.call("lpush",KEYS[n + i],1)
+            redis.call("ltrim",KEYS[n + i],0,0)
+            redis.call("pexpire",KEYS[n + i],ARGV[3])
+        end
+        released = released + 1
+    end
+end
+return released
+'''
+unlock_many_script = redis_register_script(lua)
+
+# deliver state messages to notification queues, but only
+# to queues that exist (have listening sessions); the
+# existence check and the pushes happen atomically, so no
+# queue can appear or vanish part way through. KEYS come
+# in pairs, one pair per queue: the session offset zset
+# and the queue list. ARGV also comes in pairs: the
+# (1-based) queue number and the message payload. returns
+# { delivered, dropped }
+lua = '''
+local valid = {}
+for i = 1, #KEYS / 2 do
+    valid[i] = redis.call("zcard",KEYS[2 * i - 1]) > 0
+end
+local delivered = 0
+local dropped = 0
+for j = 1, #ARGV, 2 do
+    local i = tonumber(ARGV[j])
+    if valid[i] then
+        redis.call("rpush",KEYS[2 * i],ARGV[j + 1])
+        delivered = delivered + 1
+    else
+        dropped = dropped + 1
+    end
+end
+return { delivered, dropped }
+'''
+deliver_messages_script = redis_register_script(lua)
+
+# looking up a record by a unique index requires
+# fetching the pk from the index hash and then the
+# record itself; doing both server-side saves a
+# round trip. KEYS[1] is the index hash, ARGV[1] is
+# the record key prefix and ARGV[2] is the hash field
+lua = '''
+local pk = redis.call("hget", KEYS[1], ARGV[2])
+if not pk then
+    return false
+end
+return redis.call("get", ARGV[1] .. pk)
+'''
+index_get_script = redis_register_script(lua)
+
+# as above, but for many hash fields in the same index
+# at once; returns a list of records (or nil) in the
+# same order as the fields requested
+lua = '''
+local pks = redis.call("hmget", KEYS[1], unpack(ARGV, 2))
+local rv = {}
+for i = 1, #pks do
+    if pks[i] then
+        rv[i] = redis.call("get", ARGV[1] .. pks[i])
+    else
+        rv[i] = false
+    end
+end
+return rv
+'''
+index_mget_script = redis_register_script(lua)
+
+# Lua's unpack() is limited by the size of the C stack,
+# so any script taking a variable number of arguments
+# must be called in chunks no larger than this
+REDIS_SCRIPT_MAX_ARGS = 1000
+
+# shared Lua helper: given a record key prefix and a
+# list of pks, fetch all the records in chunked MGETs
+# (to stay within the unpack() limit); missing records
+# come back as nil, just like a plain MGET
+lua_mget_records = '''
+local function mget_records(prefix, ids)
+    local rv = {}
+    for i = 1, #ids, 1000 do
+        local ks = {}
+        for j = i, math.min(i + 999, #ids) do
+            ks[#ks + 1] = prefix .. ids[j]
+        end
+        local ds = redis.call("mget", unpack(ks))
+        for j = 1, #ds do
+            rv[#rv + 1] = ds[j]
+        end
+    end
+    return rv
+end
+'''
+
+# fetch all the records in a mindex, or in the
+# intersection of several mindexes, in one round trip;
+# KEYS are the mindex keys and ARGV[1] is the record
+# key prefix
+lua = lua_mget_records + '''
+local ids
+if #KEYS == 1 then
+    ids = redis.call("smembers", KEYS[1])
+else
+    ids = redis.call("sinter", unpack(KEYS))
+end
+return mget_records(ARGV[1], ids)
+'''
+mindex_get_script = redis_register_script(lua)
+
+# fetch all the records in a zindex within a score
+# range, in score order, in one round trip; KEYS[1] is
+# the zindex key and ARGV is:
+#   1   record key prefix
+#   2   minimum score
+#   3   maximum score
+#   4   "1" to fetch in reverse (descending) order
+#   5   offset
+#   6   limit (negative for no limit)
+#   7   "1" to return { records, { id, score, id, score... } }
+#       instead of just the records (for merging results
+#       from several shards)
+lua = lua_mget_records + '''
+local range
+if ARGV[4] == "1" then
+    range = redis.call("zrevrangebyscore", KEYS[1], ARGV[3], ARGV[2], "withscores", "limit", ARGV[5], ARGV[6])
+else
+    range = redis.call("zrangebyscore", KEYS[1], ARGV[2], ARGV[3], "withscores", "limit", ARGV[5], ARGV[6])
+end
+local ids = {}
+for i = 1, #range, 2 do
+    ids[#ids + 1] = range[i]
+end
+if ARGV[7] == "1" then
+    return { mget_records(ARGV[1], ids), range }
+end
+return mget_records(ARGV[1], ids)
+'''
+zindex_get_script = redis_register_script(lua)
+
+# fetch one page of the records in a zindex, starting
+# just after a cursor (the score and member of the last
+# record of the previous page), in one round trip; KEYS[1]
+# is the zindex key and ARGV is:
+#   1   record key prefix
+#   2   minimum score
+#   3   maximum score
+#   4   "1" to fetch in reverse (descending) order
+#   5   page size
+#   6   cursor score ("" for the first page)
+#   7   cursor member
+# returns { records, { id, score, id, score... } }
+# NOTE: members sharing the cursor's score are ordered
+# by member, as redis does, so nothing is skipped or
+# repeated even if many records have the same score
+lua = lua_mget_records + '''
+local lo, hi = ARGV[2], ARGV[3]
+local reverse = ARGV[4] == "1"
+local limit = tonumber(ARGV[5])
+local cscore = ARGV[6]
+local cmember = ARGV[7]
+if cscore ~= "" then
+    if reverse then
+        hi = cscore
+    else
+        lo = cscore
+    end
+end
+local ids = {}
+local range_out = {}
+local offset = 0
+while #ids < limit do
+    local range
+    if reverse then
+        range = redis.call("zrevrangebyscore", KEYS[1], hi, lo, "withscores", "limit", offset, limit)
+    else
+        range = redis.call("zrangebyscore", KEYS[1], lo, hi, "withscores", "limit", offset, limit)
+    end
+    if #range == 0 then
+        break
+    end
+    for i = 1, #range, 2 do
+        local skip = false
+        if cscore ~= "" and tonumber(range[i + 1]) == tonumber(cscore) then
+            if reverse then
+                skip = range[i] >= cmember
+            else
+                skip = range[i] <= cmember
+            end
+        end
+        if not skip and #ids < limit then
+            ids[#ids + 1] = range[i]
+            range_out[#range_out + 1] = range[i]
+            range_out[#range_out + 1] = range[i + 1]
+        end
+    end
+    offset = offset + limit
+end
+return { mget_records(ARGV[1], ids), range_out }
+'''
+zindex_page_script = redis_register_script(lua)
+
+# rewrite a record in a different format, but only if
+# nobody has changed it since we read it; any expiry
+# time on the record is preserved. KEYS[1] is the
+# record key, ARGV[1] the old value, ARGV[2] the new
+lua = '''
+if redis.call("get", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+local ttl = redis.call("pttl", KEYS[1])
+redis.call("set", KEYS[1], ARGV[2])
+if ttl > 0 then
+    redis.call("pexpire", KEYS[1], ttl)
+end
+return 1
+'''
+replace_record_script = redis_register_script(lua)
+
+# remove an entry from a unique index, but only if it
+# still points at our record (another record may have
+# taken the value over since). KEYS[1] is the index
+# key, ARGV[1] the hash field and ARGV[2] the pk
+lua = '''
+if redis.call("hget", KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call("hdel", KEYS[1], ARGV[1])
+end
+return 0
+'''
+index_remove_script = redis_register_script(lua)
 
 # datetime objects used as indices will be
 # converted to a float value of seconds since
 # this date (with microsecond accuracy)
 ZINDEX_DATETIME_EPOCH = datetime.datetime(2014, 1, 1, tzinfo = pytz.utc)
 
+# field values of these types are written to JSON as-is
+REDIS_CODEC_SCALAR_TYPES = ( int, long, float, bool, unicode, str, )
+
+# these field types hold values that JSON hands back to
+# us already in the right Python type, so to_python()
+# can be skipped unless something unusual turns up
+# NOTE: these are exact type matches; subclasses may
+# have their own ideas about to_python()
+REDIS_CODEC_INTEGER_FIELDS = ( models.AutoField, models.IntegerField, models.BigIntegerField,
+        models.SmallIntegerField, models.PositiveIntegerField, models.PositiveSmallIntegerField, )
+REDIS_CODEC_STRING_FIELDS = ( models.CharField, models.TextField, models.SlugField, models.EmailField, )
+REDIS_CODEC_BOOLEAN_FIELDS = ( models.BooleanField, models.NullBooleanField, )
+
+# the storage formats a model can choose with
+# REDIS_SHADOW_FORMAT:
+#
+#   json        a JSON dict keyed by attname (the default)
+#   array       a JSON array: the schema version followed
+#               by the field values in field order
+#   msgpack     the same array, packed with msgpack
+#
+# records in any format can always be read, whatever the
+# model is currently set to write, so a model can switch
+# formats and migrate its records at leisure (see the
+# redis_shadow_migrate_format command)
+REDIS_SHADOW_FORMATS = ( 'json', 'array', 'msgpack', )
+
+# encode a single field value the way to_json() would
+def redis_encode_value(v):
+    if v != None and type(v) not in REDIS_CODEC_SCALAR_TYPES:
+        if type(v) == datetime.datetime:
+            v = v.isoformat()[:19]          # same as to_json()
+        else:
+            v = ilcommon.to_json(v)
+    return v
+
+# a per-model encoder/decoder for shadowed records; all
+# the per-field decisions made by the generic redis_out
+# and redis_decode are made once, up front, and the
+# resulting instances are built using the same positional
+# constructor Django uses for rows fetched from SQL
+#
+# NOTE: for the json format, the output is identical to
+# the generic version; the generic versions are kept
+# around as a reference
+#
+# NOTE: the positional formats are tagged with a schema
+# version derived from the field list; the field list
+# for each version is registered in redis so that
+# records written before a field was added or removed
+# can still be read
+class RedisShadowCodec(object):
+
+    def __init__(self, cls):
+        fields = cls._meta.local_fields
+        self.cls = cls
+        self.attnames = [ f.attname for f in fields ]
+        self.decoders = [ ( f.attname, self.field_decoder(f) ) for f in fields ]
+
+        # we can only use the positional constructor if
+        # our fields are exactly the ones it expects
+        self.positional = ([ f.attname for f in cls._meta.concrete_fields ] == self.attnames)
+
+        # storage format and schema version
+        self.format = getattr(cls, 'REDIS_SHADOW_FORMAT', 'json')
+        if self.format not in REDIS_SHADOW_FORMATS:
+            raise RedisShadowException('unknown REDIS_SHADOW_FORMAT for %s: %s' % (cls.__name__, self.format))
+        if self.format == 'msgpack' and msgpack == None:
+            raise RedisShadowException('REDIS_SHADOW_FORMAT for %s is msgpack but msgpack is not installed' % cls.__name__)
+        self.version = '%08x' % (zlib.crc32(','.join(self.attnames)) & 0xffffffff)
+        self.schemas = { self.version: self.attnames }
+        self.schema_registered = False
+
+    # pick the cheapest conversion that will give the
+    # same result as to_python() for a particular field
+    @staticmethod
+    def field_decoder(f):
+        def generic(v):
+            v = f.to_python(v)
+            if isinstance(v, datetime.datetime):
+                v = pytz.utc.fromutc(v)
+            return v
+
+        field_type = type(f)
+        if isinstance(f, models.ForeignKey):
+            # the related model may not have been prepared
+            # yet, so we can't tell what kind of key it has
+            # until the first time we decode something
+            target = []
+            def decode(v):
+                if v == None:
+                    return v
+                if type(v) in ( int, long ):
+                    if len(target) == 0:
+                        target.append(type(f.rel.get_related_field()) in REDIS_CODEC_INTEGER_FIELDS)
+                    if target[0]:
+                        return v
+                return generic(v)
+        elif field_type in REDIS_CODEC_INTEGER_FIELDS:
+            def decode(v):
+                if v == None or type(v) in ( int, long ):
+                    return v
+                return generic(v)
+        elif field_type in REDIS_CODEC_STRING_FIELDS:
+            def decode(v):
+                if v == None or type(v) == unicode:
+                    return v
+                return generic(v)
+        elif field_type in REDIS_CODEC_BOOLEAN_FIELDS:
+            def decode(v):
+                if type(v) == bool:
+                    return v
+                return generic(v)
+        elif field_type == models.DateTimeField:
+            # datetimes are always written by to_json()
+            # as YYYY-MM-DDTHH:MM:SS in UTC, which we
+            # can pick apart much faster than strptime
+            def decode(v):
+                if v == None:
+                    return None
+                if isinstance(v, basestring) and len(v) == 19:
+                    try:
+                        return datetime.datetime(int(v[0:4]), int(v[5:7]), int(v[8:10]),
+                                int(v[11:13]), int(v[14:16]), int(v[17:19]), tzinfo = pytz.utc)
+                    except ValueError:
+                        pass
+                return generic(v)
+        else:
+            decode = generic
+        return decode
+
+    # serialize a record in the model's format
+    def encode(self, record):
+        if self.format == 'json':
+            d = {}
+            for attname in self.attnames:
+                d[attname] = redis_encode_value(getattr(record, attname))
+            return json.dumps(d)
+
+        values = [ self.version ]
+        for attname in self.attnames:
+            values.append(redis_encode_value(getattr(record, attname)))
+        if self.format == 'array':
+            return json.dumps(values, separators = (',', ':'))
+        return msgpack.packb(values)
+
+    # given a serialized record in ANY format, unpack
+    # it into a dict of field values
+    def decode(self, d):
+        if d[0] == '{':
+            d = json.loads(d)
+        else:
+            if d[0] == '[':
+                values = json.loads(d)
+            elif msgpack != None:
+                values = msgpack.unpackb(d, encoding = 'utf-8')
+            else:
+                raise RedisShadowException('cannot decode msgpack record for %s: msgpack is not installed' % self.cls.__name__)
+            d = dict(zip(self.schema(values[0]), values[1:]))
+
+        rv = {}
+        for attname, decode in self.decoders:
+            rv[attname] = decode(d.get(attname))
+        return rv
+
+    # look up the field list for a schema version
+    def schema(self, version):
+        if version not in self.schemas:
+            attnames = self.cls.redis_connection().hget(self.cls.redis_schema_key(), version)
+            if attnames == None:
+                raise RedisShadowException('unknown schema version for %s: %s' % (self.cls.__name__, version))
+            self.schemas[version] = json.loads(attnames)
+        return self.schemas[version]
+
+    # make sure our field list is recorded in redis
+    # before we write anything that depends on it
+    # NOTE: done once per process, immediately rather
+    # than in a pipeline, so it can't be lost
+    def register_schema(self, rd):
+        if self.format != 'json' and not self.schema_registered:
+            rd.hsetnx(self.cls.redis_schema_key(), self.version, json.dumps(self.attnames))
+            self.schema_registered = True
+
+    # given a dict of decoded field values,
+    # create the object
+    # NOTE: a record that came from redis has the index
+    # entries its values give it, so a snapshot of the
+    # indexed values is kept for redis_set (see
+    # redis_index_entries); records loaded from SQL, or
+    # built any other way, get no snapshot, so their first
+    # redis_set writes all their entries
+    def instance(self, cls, values):
+        if self.positional:
+            record = cls(*[ values[attname] for attname in self.attnames ])
+        else:
+            record = cls(**values)
+        if record.pk != None:
+            indexer = cls.redis_indexer()
+            if len(indexer.slots) > 0:
+                record._redis_index_values = indexer.snapshot(record, values)
+        return record
+
+# a per-process cache of decoded records for a single
+# shadowed model; this is an LRU keyed by pk, with an
+# optional time-to-live, plus a second LRU for unique
+# index lookups
+#
+# NOTE: we cache the decoded field values rather than
+# model instances, so every hit builds a fresh instance
+# and callers can't corrupt the cache by modifying the
+# records they get back
+class RedisShadowCache(object):
+
+    def __init__(self, size, ttl = None):
+        self.size = size
+        self.ttl = ttl
+        self.records = OrderedDict()    # pk -> (expiry, values)
+        self.indices = OrderedDict()    # (slot, field) -> (expiry, values)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    # look up an entry in one of the LRUs; expired
+    # entries count as misses
+    def lookup(self, lru, key):
+        entry = lru.pop(key, None)
+        if entry == None or (entry[0] != None and entry[0] < time.time()):
+            self.misses += 1
+            return None
+        lru[key] = entry        # re-insert as most recently used
+        self.hits += 1
+        return self.copy_values(entry[1])
+
+    # store an entry in one of the LRUs, evicting the
+    # least recently used entries if we're over size
+    def store(self, lru, key, values):
+        expiry = time.time() + self.ttl if self.ttl != None else None
+        lru.pop(key, None)
+        lru[key] = (expiry, values)
+        while len(lru) > self.size:
+            lru.popitem(last = False)
+            self.evictions += 1
+
+    def get_record(self, pk):
+        return self.lookup(self.records, int(pk))
+
+    def set_record(self, pk, values):
+        self.store(self.records, int(pk), values)
+
+    def get_index(self, slot, f):
+        return self.lookup(self.indices, (slot, f))
+
+    def set_index(self, slot, f, values):
+        self.store(self.indices, (slot, f), values)
+
+    # drop a record; we can't tell which index entries
+    # pointed at it (or now should), so they all go
+    def invalidate(self, pk):
+        self.records.pop(int(pk), None)
+        self.indices.clear()
+        self.invalidations += 1
+
+    def clear(self):
+        self.records.clear()
+        self.indices.clear()
+
+    def stats(self):
+        return {
+                'size': len(self.records),
+                'index_size': len(self.indices),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions,
+            }
+
+    # mutable values (e.g. JSONField contents) must not be
+    # shared between the cache and the records handed out
+    @staticmethod
+    def copy_values(values):
+        rv = {}
+        for k, v in values.iteritems():
+            if isinstance(v, (list, dict)):
+                v = copy.deepcopy(v)
+            rv[k] = v
+        return rv
+
+# each cached model publishes the pk of every record it
+# writes or deletes on a channel; every process holding
+# a cache subscribes to those channels and drops the
+# matching entries
+#
+# NOTE: we don't have a background thread to listen (see
+# the note on the connection pools above), so pending
+# invalidations are drained, without blocking, every time
+# a cache is consulted
+class RedisShadowCacheListener(object):
+
+    def __init__(self):
+        self.pid = None
+        self.pubsubs = {}       # pool index -> PubSub
+        self.channels = {}      # pool index -> { channel: model class }
+
+    @staticmethod
+    def channel(cls):
+        return 'dbshadow_invalidate:%s' % (cls.__name__,)
+
+    # make sure we are listening for invalidations for
+    # a particular model
+    # NOTE: invalidations are published on the pool the
+    # record was written to, so for a sharded model we
+    # have to listen on every shard
+    def register(self, cls):
+        self.check_pid()
+        ch = self.channel(cls)
+        for pool_index in cls.redis_pool_indices():
+            channels = self.channels.setdefault(pool_index, {})
+            if ch not in channels:
+                channels[ch] = cls
+                if pool_index in self.pubsubs:
+                    self.pubsubs[pool_index].subscribe(ch)
+
+    # after a fork, the parent's subscriptions (and its
+    # sockets) are useless to us, and anything cached
+    # before the fork may have missed invalidations
+    def check_pid(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pubsubs = {}
+            for channels in self.channels.values():
+                for cls in channels.values():
+                    cls._redis_cache.clear()
+
+    # drain all pending invalidation messages
+    def poll(self):
+        self.check_pid()
+        for pool_index, channels in self.channels.iteritems():
+            try:
+                ps = self.pubsubs.get(pool_index)
+                if ps == None:
+                    # (re)subscribe; anything cached while we
+                    # weren't listening is suspect
+                    ps = redis.StrictRedis(connection_pool = redis_pools[pool_index]).pubsub(ignore_subscribe_messages = True)
+                    ps.subscribe(*channels.keys())
+                    self.pubsubs[pool_index] = ps
+                    for cls in channels.values():
+                        cls._redis_cache.clear()
+                while True:
+                    m = ps.get_message()
+                    if m == None:
+                        break
+                    cls = channels.get(m['channel'])
+                    if cls != None:
+                        cls._redis_cache.invalidate(m['data'])
+            except redis.ConnectionError:
+                # we may have missed messages; start over
+                self.pubsubs.pop(pool_index, None)
+                for cls in channels.values():
+                    cls._redis_cache.clear()
+
+redis_cache_listener = RedisShadowCacheListener()
+
+# the index definitions of a shadowed model, compiled
+# into something that can work out every index entry
+# for a record in one go
+#
+# an entry is one of:
+#
+#   ( 'index', key, hash field )
+#   ( 'mindex', slot, key )
+#   ( 'zindex', slot, key, score )
+#
+# and the record's pk is the value/member in each case
+#
+# NOTE: each field path is only looked up once per
+# record, however many indices use it; related records
+# on __ paths are fetched from redis (if the related
+# model is shadowed) rather than through the SQL ORM,
+# unless they are already cached on the record
+class RedisShadowIndexer(object):
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.slots = []     # ( kind, slot, fields, paths, score path )
+        for kind, attr in ( ( 'index', 'REDIS_SHADOW_INDEX' ), ( 'mindex', 'REDIS_SHADOW_MINDEX' ), ( 'zindex', 'REDIS_SHADOW_ZINDEX' ) ):
+            idxs = getattr(cls, attr, [])
+            for slot in range(len(idxs)):
+                idx = idxs[slot]
+                # we allow None as an index so we can "remove"
+                # certain indices after the fact without
+                # having to renumber all the following ones
+                if idx == None:
+                    continue
+                if kind == 'zindex':
+                    fields, score_path = idx[1], self.path(idx[0])
+                else:
+                    fields, score_path = idx, None
+                self.slots.append(( kind, slot, fields, [ self.path(f) for f in fields ], score_path ))
+        self.related_fields = {}
+        self.snapshot_fields = None
+
+    # split an index field into its path of field names
+    @staticmethod
+    def path(field):
+        if isinstance(field, tuple):
+            field = field[0]
+        return tuple(field.split('__'))
+
+    # find the definition of a related field, once
+    # NOTE: done on first use, since related models may
+    # not be resolved when the class is prepared
+    def related_field(self, model, name):
+        k = (model, name)
+        if k not in self.related_fields:
+            self.related_fields[k] = model._meta.get_field(name)
+        return self.related_fields[k]
+
+    # look up the value at the end of a field path
+    # related holds the related records fetched so far
+    def value(self, record, path, related):
+        rv = record
+        for name in path[:-1]:
+            field_def = self.related_field(rv.__class__, name)
+            o = getattr(rv, field_def.get_cache_name(), None)
+            if o == None:
+                fk = getattr(rv, field_def.attname)
+                if fk == None:
+                    return None
+                model = field_def.related.parent_model
+                if issubclass(model, RedisShadow):
+                    k = (model, fk)
+                    if k not in related:
+                        related[k] = model.redis_get(fk)
+                    o = related[k]
+                if o == None:
+                    o = getattr(rv, name)       # not shadowed, so ask the ORM
+                else:
+                    setattr(rv, name, o)        # so the next lookup can use it
+            rv = o
+        return getattr(rv, path[-1])
+
+    # list the (attname, related cache name) of every local
+    # field the indices depend on; the cache name is None
+    # unless the field is a relation
+    def snapshot_field_list(self):
+        if self.snapshot_fields == None:
+            names = []
+            for kind, slot, fields, paths, score_path in self.slots:
+                for path in paths + ([ score_path ] if score_path != None else []):
+                    if path[0] not in names:
+                        names.append(path[0])
+            snapshot_fields = []
+            for name in names:
+                try:
+                    field_def = self.cls._meta.get_field(name)
+                    snapshot_fields.append(( field_def.attname, field_def.get_cache_name() if field_def.rel != None else None ))
+                except FieldDoesNotExist:
+                    snapshot_fields.append(( name, None ))      # e.g. an attname such as user_id
+            self.snapshot_fields = snapshot_fields
+        return self.snapshot_fields
+
+    # take a copy of the local field values the indices
+    # depend on; values (the dict a record was built from)
+    # is used where it has them, to save attribute lookups
+    def snapshot(self, record, values = {}):
+        return dict([ ( attname, values[attname] if attname in values else getattr(record, attname) ) for attname, cache_name in self.snapshot_field_list() ])
+
+    # work out the index entries a record had when a
+    # snapshot of it was taken
+    # NOTE: related records on __ paths are looked up
+    # again, so changes to those aren't seen
+    def snapshot_entries(self, record, snapshot):
+        old = copy.copy(record)
+        for attname, cache_name in self.snapshot_field_list():
+            v = snapshot[attname]
+            if getattr(old, attname) != v:
+                setattr(old, attname, v)
+                if cache_name != None and cache_name in old.__dict__:
+                    del old.__dict__[cache_name]
+        return self.entries(old)
+
+    # work out all the index entries for a record, or
+    # just those for some (kind, slot) pairs
+    # returns a frozenset
+    def entries(self, record, slots = None):
+        cls = self.cls
+        values = {}
+        related = {}
+        rv = []
+        for kind, slot, fields, paths, score_path in self.slots:
+            if slots != None and (kind, slot) not in slots:
+                continue
+            vals = []
+            for path in paths:
+                if path not in values:
+                    values[path] = self.value(record, path, related)
+                vals.append(values[path])
+            cls.redis_fix_index_types(fields, vals)
+            if kind == 'index':
+                rv.append(( kind, cls.redis_index_key(slot), repr(vals) ))
+            elif kind == 'mindex':
+                rv.append(( kind, slot, cls.redis_mindex_key(slot, vals) ))
+            else:
+                if score_path not in values:
+                    values[score_path] = self.value(record, score_path, related)
+                score = [ values[score_path] ]
+                cls.redis_fix_index_types(None, score)
+                rv.append(( kind, slot, cls.redis_zindex_key(slot, vals), score[0] ))
+        return frozenset(rv)
+
+    # add the commands to add a record to some index
+    # entries to a pipeline
+    def add_entries(self, pipe, pk, entries):
+        for e in sorted(entries):
+            if e[0] == 'index':
+                pipe.hset(e[1], e[2], pk)
+            elif e[0] == 'mindex':
+                pipe.sadd(e[2], pk)
+                pipe.sadd(self.cls.redis_index_registry_key('mindex', e[1]), e[2])
+            else:
+                pipe.zadd(e[2], e[3], pk)
+                pipe.sadd(self.cls.redis_index_registry_key('zindex', e[1]), e[2])
+
+    # add the commands to remove a record from some
+    # index entries to a pipeline
+    def remove_entries(self, pipe, pk, entries):
+        for e in sorted(entries):
+            if e[0] == 'index':
+                index_remove_script(keys = [ e[1] ], args = [ e[2], pk ], client = pipe)
+            elif e[0] == 'mindex':
+                pipe.srem(e[2], pk)
+            else:
+                pipe.zrem(e[2], pk)
+
+    # add the commands to bring a record's index entries
+    # up to date to a pipeline; old is what was written
+    # last time (or None if we don't know), and only the
+    # differences are written
+    # returns the record's current entries
+    def update(self, record, pipe, old = None):
+        new = self.entries(record)
+        if old == None:
+            self.add_entries(pipe, record.id, new)
+        else:
+            # a zindex entry whose score has changed doesn't
+            # need removing, as ZADD will just move it
+            added = new - old
+            moved = set([ e[2] for e in added if e[0] == 'zindex' ])
+            self.remove_entries(pipe, record.id, [ e for e in old - new if e[0] != 'zindex' or e[2] not in moved ])
+            self.add_entries(pipe, record.id, added)
+        return new
+
 # helper class to allow a model to be
 # more easily shadowed into a redis server,
 # on a strictly voluntary basis
@@ -102,6 +1083,30 @@ ZINDEX_DATETIME_EPOCH = datetime.datetime(2014, 1, 1, tzinfo = pytz.utc)
 # set REDIS_SHADOW_AUTOSAVE to True and you
 # must list RedisShadow before models.Model
 #
+# NOTE: rarely-changing models can keep decoded
+# records in a per-process cache by setting
+# REDIS_SHADOW_CACHE to a dict with 'size' (max
+# records) and 'ttl' (seconds, or None); only
+# redis_get and redis_get_by_index use the cache
+#
+# NOTE: a model too big for one server can be sharded
+# by setting REDIS_SHADOW_SHARDS to a list of pool
+# indices instead of REDIS_SHADOW_POOL; records are
+# placed on a consistent hash ring (see
+# RedisShadowHashRing) and each record's index entries
+# are kept on the same shard as the record. Records are
+# routed by pk, or by the value of REDIS_SHADOW_SHARD_KEY
+# if set (a field name, as used in the indices), which
+# acts as a hash tag: all the records sharing a value
+# end up on one shard, and index lookups that include
+# that field (untransformed) only go to that shard.
+# Other lookups go to every shard and the results are
+# merged. The first shard also holds the id counter,
+# the locks and anything else that isn't a record or
+# an index entry. The shard key of a record must never
+# change. See the redis_shadow_rebalance command for
+# adding a shard.
+#
 class RedisShadow(object):
 
     # determine if a particular record is only in the
@@ -116,8 +1121,11 @@ class RedisShadow(object):
 
     # determine the correct shadow pool for this model
     # NOTE: returns the pool index
+    # NOTE: for a sharded model this is the first shard
     @classmethod
     def redis_pool_index(cls):
+        if cls.redis_is_sharded():
+            return cls.REDIS_SHADOW_SHARDS[0]
         return getattr(cls, 'REDIS_SHADOW_POOL', 0)
 
     # determine the correct shadow pool for this model
@@ -126,19 +1134,155 @@ class RedisShadow(object):
     def redis_pool(cls):
         return redis_pools[cls.redis_pool_index()]
 
-    # fetch a connection from the right pool
+    # fetch a connection from the right pool, or from a
+    # particular pool (e.g. one of the model's shards)
     @classmethod
-    def redis_connection(cls):
-        if settings.ILCLOUD_REDIS_SHADOW_DUMP_REQUESTS:
-            return DebugStrictRedis(connection_pool = cls.redis_pool())
-        else:
-            return redis.StrictRedis(connection_pool = cls.redis_pool())
+    def redis_connection(cls, pool_index = None):
+        if pool_index == None:
+            pool_index = cls.redis_pool_index()
+        return redis_connection(pool_index)
+
+    # fetch a connection for pure reads, which may be to
+    # a replica (see redis_read_connection)
+    @classmethod
+    def redis_read_connection(cls, pool_index = None):
+        if pool_index == None:
+            pool_index = cls.redis_pool_index()
+        return redis_read_connection(pool_index)
+
+    # make sure the rest of this request reads this
+    # model's records from the primaries
+    @classmethod
+    def redis_pin_primary(cls):
+        for pool_index in cls.redis_pool_indices():
+            redis_pin_primary(pool_index)
+
+    # determine if this model is spread across several
+    # pools (see REDIS_SHADOW_SHARDS)
+    @classmethod
+    def redis_is_sharded(cls):
+        return bool(getattr(cls, 'REDIS_SHADOW_SHARDS', None))
+
+    # list every pool that holds records of this model
+    @classmethod
+    def redis_pool_indices(cls):
+        if cls.redis_is_sharded():
+            return list(cls.REDIS_SHADOW_SHARDS)
+        return [ cls.redis_pool_index() ]
+
+    # fetch the hash ring for a sharded model
+    @classmethod
+    def redis_hash_ring(cls):
+        if '_redis_hash_ring' not in cls.__dict__:
+            cls._redis_hash_ring = RedisShadowHashRing(cls.REDIS_SHADOW_SHARDS)
+        return cls._redis_hash_ring
+
+    # determine which pool holds the records with a
+    # particular routing value (see redis_route)
+    @classmethod
+    def redis_shard_index(cls, route):
+        if not cls.redis_is_sharded():
+            return cls.redis_pool_index()
+        return cls.redis_hash_ring().node(route)
+
+    # list the pools that might hold the record with a
+    # particular pk; if records are routed by a shard key
+    # we can't tell from the pk alone, so it could be any
+    @classmethod
+    def redis_pk_pool_indices(cls, pk):
+        if cls.redis_is_sharded() and getattr(cls, 'REDIS_SHADOW_SHARD_KEY', None) != None:
+            return cls.redis_pool_indices()
+        return [ cls.redis_shard_index(pk) ]
+
+    # list the pools an index lookup has to go to; if the
+    # index includes the shard key (with no transforms),
+    # only the shard for that value can have any matches
+    # NOTE: vals must already have been through
+    # redis_fix_index_types
+    @classmethod
+    def redis_query_pool_indices(cls, idx, vals):
+        key = getattr(cls, 'REDIS_SHADOW_SHARD_KEY', None)
+        if cls.redis_is_sharded() and key != None and key in idx:
+            return [ cls.redis_shard_index(vals[list(idx).index(key)]) ]
+        return cls.redis_pool_indices()
+
+    # the value this record is routed by: the pk, or the
+    # (type-fixed) value of REDIS_SHADOW_SHARD_KEY if set
+    def redis_route(self):
+        key = getattr(self, 'REDIS_SHADOW_SHARD_KEY', None)
+        if key == None:
+            return self.id
+        vals = [ self.redis_index_value(key) ]
+        self.redis_fix_index_types(None, vals)
+        return vals[0]
+
+    # determine the pool holding this record and its
+    # index entries
+    def redis_record_pool_index(self):
+        if not self.redis_is_sharded():
+            return self.redis_pool_index()
+        return self.redis_shard_index(self.redis_route())
+
+    # make sure a pipeline we have been handed is for the
+    # pool this record belongs in; with a sharded model
+    # the caller must pick the right one (see
+    # redis_record_pool_index)
+    def redis_check_pipe(self, pipe, pool_index):
+        if self.redis_is_sharded() and pipe.connection_pool is not redis_pools[pool_index]:
+            raise RedisShadowException('%s:%s belongs in pool %d' % (self.__class__.__name__, self.id, pool_index))
+
+    # fetch the per-process record cache for this model,
+    # or None if the model isn't cached
+    # NOTE: each class gets its own cache, even if it
+    # inherits REDIS_SHADOW_CACHE from a parent
+    @classmethod
+    def redis_cache(cls):
+        if '_redis_cache' not in cls.__dict__:
+            config = getattr(cls, 'REDIS_SHADOW_CACHE', None)
+            cache = None
+            if config:
+                cache = RedisShadowCache(config['size'], config.get('ttl'))
+            cls._redis_cache = cache
+            if cache != None:
+                redis_cache_listener.register(cls)
+        if cls._redis_cache != None:
+            redis_cache_listener.poll()
+        return cls._redis_cache
+
+    # report cache hit/miss counters for this model
+    @classmethod
+    def redis_cache_stats(cls):
+        cache = cls.redis_cache()
+        if cache == None:
+            return None
+        return cache.stats()
+
+    # drop a record from our own cache and queue up a
+    # message telling every other process to do the same
+    @classmethod
+    def redis_cache_invalidate(cls, pk, pipe):
+        cache = cls.redis_cache()
+        if cache != None:
+            cache.invalidate(pk)
+            pipe.publish(RedisShadowCacheListener.channel(cls), pk)
 
     # create a key for the record in redis
     @classmethod
     def redis_key(cls, pk):
         return 'dbshadow:%s:%d' % (cls.__name__, pk)
 
+    # the part of the record key that precedes the pk;
+    # scripts use this to build record keys server-side
+    @classmethod
+    def redis_key_prefix(cls):
+        return 'dbshadow:%s:' % (cls.__name__,)
+
+    # create a key for the schema registry of a particular
+    # model (see RedisShadowCodec)
+    @classmethod
+    def redis_schema_key(cls):
+        return 'dbshadow_schema:%s' % (cls.__name__,)
+
     # create a key for the ID record of a particular model
     @classmethod
     def redis_id_key(cls):
@@ -149,6 +1293,12 @@ class RedisShadow(object):
     def redis_lock_key(cls, pk):
         return 'dbshadow_lock:%s:%d' % (cls.__name__, pk)
 
+    # create a wake-up list key for a lock in redis
+    # (see redis_lock)
+    @classmethod
+    def redis_lock_wake_key(cls, pk):
+        return 'dbshadow_lock_wake:%s:%d' % (cls.__name__, pk)
+
     # create an index key for the record in redis
     @classmethod
     def redis_index_key(cls, slot):
@@ -177,197 +1327,460 @@ class RedisShadow(object):
             return k
         return k + ''.join([ ':%s' % str(v) for v in vals ])
 
+    # create a key for the registry of all the keys used
+    # by a particular mindex or zindex slot; kind is
+    # 'mindex' or 'zindex'
+    # NOTE: the registry lets us find all of a slot's
+    # keys without walking the entire keyspace; it is
+    # only trusted once the "complete" flag key exists,
+    # which happens the first time the slot is flushed
+    # (keys written before the registry existed would
+    # otherwise be missed)
+    @classmethod
+    def redis_index_registry_key(cls, kind, slot):
+        return 'dbshadow_index_keys:%s:%s:%d' % (cls.__name__, kind, slot)
+
+    @classmethod
+    def redis_index_registry_complete_key(cls, kind, slot):
+        return cls.redis_index_registry_key(kind, slot) + ':complete'
+
     # fetch record(s) from the redis server
     # pass in a single pk value to get just one;
     # pass in a list or set to get multiple
     @classmethod
     def redis_get(cls, pk):
-        rd = cls.redis_connection()
+        cache = cls.redis_cache()
+        if cache != None:
+            return cls.redis_get_cached(cache, pk)
+
         if isinstance(pk, (list, set)):
             if len(pk) == 0:
                 # don't try mget() with an empty list
                 return []
-            dlist = rd.mget([ cls.redis_key(int(k)) for k in pk ])       # will take a list
+            dlist = cls.redis_mget([ int(k) for k in pk ])
             return [ cls.redis_in(d) for d in dlist if d != None ]
         else:
-            d = rd.get(cls.redis_key(pk))
+            d = cls.redis_mget([ pk ])[0]
             return cls.redis_in(d)
 
+    # fetch the serialized records for a list of pks, in
+    # the same order, with None for any that are missing
+    # NOTE: one MGET per pool involved
+    @classmethod
+    def redis_mget(cls, pks, primary = False):
+        return redis_mget_routed([ ( cls.redis_pk_pool_indices(pk), cls.redis_key(pk) ) for pk in pks ], primary)
+
+    # same as redis_get, but consulting the record
+    # cache first; only the misses are fetched
+    # NOTE: misses are read from the primary; a replica
+    # that is behind could hand us a value older than an
+    # invalidation we have already seen, and it would then
+    # stay cached until the record is next written
+    @classmethod
+    def redis_get_cached(cls, cache, pk):
+        if not isinstance(pk, (list, set)):
+            values = cache.get_record(pk)
+            if values == None:
+                values = cls.redis_decode(cls.redis_mget([ pk ], primary = True)[0])
+                if values == None:
+                    return None
+                cache.set_record(pk, values)
+                values = cache.copy_values(values)
+            return cls.redis_instance(values)
+
+        pks = [ int(k) for k in pk ]
+        found = {}
+        missing = []
+        for k in pks:
+            values = cache.get_record(k)
+            if values != None:
+                found[k] = values
+            else:
+                missing.append(k)
+        if len(missing) > 0:
+            dlist = cls.redis_mget(missing, primary = True)
+            for k, d in zip(missing, dlist):
+                values = cls.redis_decode(d)
+                if values != None:
+                    cache.set_record(k, values)
+                    found[k] = cache.copy_values(values)
+        return [ cls.redis_instance(found[k]) for k in pks if k in found ]
+
     # fetch a record from the redis server by index
-    #**** this could be improved by using a script that
-    # looks up the value in the index and computes the
-    # key server-side, only returning the actual value
+    # NOTE: the index lookup and the record fetch are
+    # done server-side by a script, in one round trip
+    # NOTE: for a cached model, misses are read from the
+    # primary (see redis_get_cached)
     @classmethod
     def redis_get_by_index(cls, slot, vals):
-        rd = cls.redis_connection()
         k = cls.redis_index_key(slot)
         idx = cls.REDIS_SHADOW_INDEX[slot]
         cls.redis_fix_index_types(idx, vals)        # ensure lookup types are correct
         f = repr(vals)
-        pk = rd.hget(k, f)
-        if pk == None:
+
+        cache = cls.redis_cache()
+        if cache != None:
+            values = cache.get_index(slot, f)
+            if values != None:
+                return cls.redis_instance(values)
+
+        for pool_index in cls.redis_query_pool_indices(idx, vals):
+            d = index_get_script(
+                    keys = [ k ],
+                    args = [ cls.redis_key_prefix(), f ],
+                    client = cls.redis_read_connection(pool_index) if cache == None else cls.redis_connection(pool_index),
+                )
+            if d != None:
+                break               # unique, so no need to ask any other shards
+        if cache == None:
+            return cls.redis_in(d)
+
+        values = cls.redis_decode(d)
+        if values == None:
             return None
-        d = rd.get(cls.redis_key(int(pk)))
-        return cls.redis_in(d)
+        cache.set_index(slot, f, values)
+        return cls.redis_instance(cache.copy_values(values))
+
+    # fetch many records from the redis server by the
+    # same index, one list of values per record
+    # returns a list in the same order as vals_list,
+    # with None wherever no record was found
+    @classmethod
+    def redis_get_by_indexes(cls, slot, vals_list):
+        k = cls.redis_index_key(slot)
+        idx = cls.REDIS_SHADOW_INDEX[slot]
+        fs = []
+        by_pool = OrderedDict()
+        for vals in vals_list:
+            vals = list(vals)
+            cls.redis_fix_index_types(idx, vals)    # ensure lookup types are correct
+            for pool_index in cls.redis_query_pool_indices(idx, vals):
+                by_pool.setdefault(pool_index, []).append(len(fs))
+            fs.append(repr(vals))
+
+        # each pool is only asked for the values that
+        # haven't already been found in another one
+        rv = [ None ] * len(fs)
+        for pool_index, positions in by_pool.iteritems():
+            rd = cls.redis_read_connection(pool_index)
+            positions = [ i for i in positions if rv[i] == None ]
+            for j in range(0, len(positions), REDIS_SCRIPT_MAX_ARGS):
+                chunk = positions[j:j+REDIS_SCRIPT_MAX_ARGS]
+                dlist = index_mget_script(
+                        keys = [ k ],
+                        args = [ cls.redis_key_prefix() ] + [ fs[i] for i in chunk ],
+                        client = rd,
+                    )
+                for i, d in zip(chunk, dlist):
+                    rv[i] = d
+        return [ cls.redis_in(d) for d in rv ]
 
     # fetch multiple records from the redis server by
     # mindex
-    # fetches all the IDs from the mindex and then
-    # pulls all the records with those IDs
+    # the IDs are fetched from the mindex and the records
+    # with those IDs are pulled server-side by a script,
+    # in one round trip
     @classmethod
     def redis_get_by_mindex(cls, slot, vals):
-        ids = cls.redis_get_ids_by_mindex(slot, vals)
-        return cls.redis_get(ids)                   # fetch and parse those items
+        return cls.redis_get_by_mindexes(slot, vals)
 
     # fetch multiple records from the redis server by
     # COMBINING multiple mindexes
+    # NOTE: a record's mindex entries are all on its own
+    # shard, so for a sharded model we intersect on each
+    # shard and combine the results; if any of the
+    # mindexes includes the shard key, only that shard
+    # can have any matches
     @classmethod
     def redis_get_by_mindexes(cls, *args):
-        rd = cls.redis_connection()
         ks = []
+        pool_indices = cls.redis_pool_indices()
         for i in range(0,len(args),2):
             slot = args[i]
             vals = args[i+1]
             idx = cls.REDIS_SHADOW_MINDEX[slot]
             cls.redis_fix_index_types(idx, vals)        # ensure lookup types are correct
             ks.append(cls.redis_mindex_key(slot, vals))
-        ids = rd.sinter(*ks)                        # merge mindexes directly in redis (faster)
-        return cls.redis_get(ids)                   # fetch and parse those items
+            query_pool_indices = cls.redis_query_pool_indices(idx, vals)
+            pool_indices = [ pi for pi in pool_indices if pi in query_pool_indices ]
+        rv = []
+        for pool_index in pool_indices:
+            dlist = mindex_get_script(              # merge mindexes directly in redis (faster)
+                    keys = ks,
+                    args = [ cls.redis_key_prefix() ],
+                    client = cls.redis_read_connection(pool_index),
+                )
+            rv.extend([ cls.redis_in(d) for d in dlist if d != None ])
+        return rv
 
     # fetch just the IDs of multiple records from the
     # redis server by mindex
     # NOTE: actually returns a Python set, NOT a list!
     @classmethod
     def redis_get_ids_by_mindex(cls, slot, vals):
-        rd = cls.redis_connection()
         idx = cls.REDIS_SHADOW_MINDEX[slot]
         cls.redis_fix_index_types(idx, vals)        # ensure lookup types are correct
         k = cls.redis_mindex_key(slot, vals)
-        return rd.smembers(k)
+        rv = set()
+        for pool_index in cls.redis_query_pool_indices(idx, vals):
+            rv |= cls.redis_read_connection(pool_index).smembers(k)
+        return rv
+
+    # convert a zindex score range into redis bounds
+    # either end may be None (no limit), a value to be
+    # converted like any other score (e.g. a datetime), or
+    # a string already in redis syntax (e.g. '(100');
+    # min_exclusive and max_exclusive leave out records
+    # scoring exactly the bound
+    @classmethod
+    def redis_zindex_bounds(cls, score_range = None, min_exclusive = False, max_exclusive = False):
+        if score_range == None:
+            score_range = [ None, None ]            # all of them
+        bounds = []
+        for i in range(2):
+            v = score_range[i]
+            if v == None:
+                bounds.append(( '-inf', '+inf' )[i])
+            elif isinstance(v, basestring):
+                bounds.append(v)
+            else:
+                s = [ v ]
+                cls.redis_fix_index_types(None, s)  # fix any datetime objects
+                exclusive = ( min_exclusive, max_exclusive )[i]
+                bounds.append(('(%d' if exclusive else '%d') % s[0])
+        return bounds
+
+    # run a zindex script on every pool a query has to go
+    # to, and merge the results back into the order redis
+    # would use (by score, then by member)
+    # returns a list of (score, member, record, score as
+    # redis gave it) tuples
+    @classmethod
+    def redis_zindex_merge(cls, script, k, pool_indices, args, reverse):
+        merged = []
+        for pool_index in pool_indices:
+            dlist, scored = script(keys = [ k ], args = args, client = cls.redis_read_connection(pool_index))
+            for i in range(len(dlist)):
+                merged.append(( float(scored[i * 2 + 1]), scored[i * 2], dlist[i], scored[i * 2 + 1] ))
+        merged.sort(reverse = reverse)
+        return merged
 
     # fetch multiple records from the redis server by
     # zindex
-    # fetches all the IDs from the zindex and then
-    # pulls all the records with those IDs
+    # the IDs are fetched from the zindex and the records
+    # with those IDs are pulled server-side by a script,
+    # in one round trip
+    # NOTE: records are returned in score order (or
+    # reverse score order); offset and limit apply to
+    # that order (see also redis_page_by_zindex)
+    # NOTE: for a sharded model each shard is asked for
+    # its first offset + limit records, and these are
+    # merged in the same order redis would use (by score,
+    # then by member)
+    @classmethod
+    def redis_get_by_zindex(cls, slot, vals, score_range = None, offset = 0, limit = None, reverse = False, min_exclusive = False, max_exclusive = False):
+        idx = cls.REDIS_SHADOW_ZINDEX[slot]
+        cls.redis_fix_index_types(idx[1], vals)     # ensure lookup types are correct
+        k = cls.redis_zindex_key(slot, vals)
+        bounds = cls.redis_zindex_bounds(score_range, min_exclusive, max_exclusive)
+        pool_indices = cls.redis_query_pool_indices(idx[1], vals)
+        if len(pool_indices) == 1:
+            dlist = zindex_get_script(
+                    keys = [ k ],
+                    args = [
+                        cls.redis_key_prefix(),
+                        bounds[0],
+                        bounds[1],
+                        1 if reverse else 0,
+                        offset,
+                        limit if limit != None else -1,
+                        0,
+                    ],
+                    client = cls.redis_read_connection(pool_indices[0]),
+                )
+            return [ cls.redis_in(d) for d in dlist if d != None ]
+
+        merged = cls.redis_zindex_merge(zindex_get_script, k, pool_indices, [
+                cls.redis_key_prefix(),
+                bounds[0],
+                bounds[1],
+                1 if reverse else 0,
+                0,
+                offset + limit if limit != None else -1,
+                1,
+            ], reverse)
+        merged = merged[offset:offset + limit if limit != None else None]
+        return [ cls.redis_in(m[2]) for m in merged if m[2] != None ]
+
+    # fetch a page of records from the redis server by
+    # zindex, continuing from where the last page left off
+    # returns ( records, cursor ), where cursor is None if
+    # there are no more records, or else a (score, member)
+    # tuple to pass in to get the next page
+    # NOTE: unlike offsets, the cursor doesn't drift when
+    # records are added or removed between pages, and the
+    # cost of a page doesn't grow with its depth
     @classmethod
-    def redis_get_by_zindex(cls, slot, vals, score_range = None):
-        ids = cls.redis_get_ids_by_zindex(slot, vals, score_range)
-        return cls.redis_get(ids)                   # fetch and parse those items
+    def redis_page_by_zindex(cls, slot, vals, limit, cursor = None, reverse = False, score_range = None, min_exclusive = False, max_exclusive = False):
+        idx = cls.REDIS_SHADOW_ZINDEX[slot]
+        cls.redis_fix_index_types(idx[1], vals)     # ensure lookup types are correct
+        k = cls.redis_zindex_key(slot, vals)
+        bounds = cls.redis_zindex_bounds(score_range, min_exclusive, max_exclusive)
+        merged = cls.redis_zindex_merge(zindex_page_script, k, cls.redis_query_pool_indices(idx[1], vals), [
+                cls.redis_key_prefix(),
+                bounds[0],
+                bounds[1],
+                1 if reverse else 0,
+                limit,
+                cursor[0] if cursor != None else '',
+                cursor[1] if cursor != None else '',
+            ], reverse)
+        merged = merged[:limit]
+        next_cursor = None
+        if len(merged) == limit:
+            next_cursor = ( merged[-1][3], merged[-1][1] )
+        return [ cls.redis_in(m[2]) for m in merged if m[2] != None ], next_cursor
 
     # fetch just the IDs of multiple records from the
-    # redis server by zindex
-    # NOTE: actually returns a Python set, NOT a list!
+    # redis server by zindex, in score order
+    # NOTE: for a sharded model the IDs from each shard
+    # are merged back into score order
     @classmethod
-    def redis_get_ids_by_zindex(cls, slot, vals, score_range = None):
-        rd = cls.redis_connection()
+    def redis_get_ids_by_zindex(cls, slot, vals, score_range = None, offset = 0, limit = None, reverse = False, min_exclusive = False, max_exclusive = False):
         idx = cls.REDIS_SHADOW_ZINDEX[slot]
         cls.redis_fix_index_types(idx[1], vals)     # ensure lookup types are correct
         k = cls.redis_zindex_key(slot, vals)
-        if score_range == None:
-            return rd.zrange(k, 0, -1)              # all of them
-        else:
-            cls.redis_fix_index_types(None, score_range)    # fix any datetime objects
-            return rd.zrangebyscore(k, score_range[0], score_range[1])  # within range
+        bounds = cls.redis_zindex_bounds(score_range, min_exclusive, max_exclusive)
+        pool_indices = cls.redis_query_pool_indices(idx[1], vals)
+        if len(pool_indices) == 1:
+            rd = cls.redis_read_connection(pool_indices[0])
+            if limit == None and offset == 0:
+                limit_args = {}
+            else:
+                limit_args = { 'start': offset, 'num': limit if limit != None else -1 }
+            if reverse:
+                return rd.zrevrangebyscore(k, bounds[1], bounds[0], **limit_args)
+            return rd.zrangebyscore(k, bounds[0], bounds[1], **limit_args)
+
+        merged = []
+        for pool_index in pool_indices:
+            rd = cls.redis_read_connection(pool_index)
+            if limit == None:
+                limit_args = {}
+            else:
+                limit_args = { 'start': 0, 'num': offset + limit }
+            if reverse:
+                scored = rd.zrevrangebyscore(k, bounds[1], bounds[0], withscores = True, **limit_args)
+            else:
+                scored = rd.zrangebyscore(k, bounds[0], bounds[1], withscores = True, **limit_args)
+            merged.extend([ ( score, member ) for member, score in scored ])
+        merged.sort(reverse = reverse)
+        return [ m[1] for m in merged[offset:offset + limit if limit != None else None] ]
+
+    # count the records in a zindex (within a score
+    # range) without fetching any of them
+    @classmethod
+    def redis_count_by_zindex(cls, slot, vals, score_range = None, min_exclusive = False, max_exclusive = False):
+        idx = cls.REDIS_SHADOW_ZINDEX[slot]
+        cls.redis_fix_index_types(idx[1], vals)     # ensure lookup types are correct
+        k = cls.redis_zindex_key(slot, vals)
+        bounds = cls.redis_zindex_bounds(score_range, min_exclusive, max_exclusive)
+        count = 0
+        for pool_index in cls.redis_query_pool_indices(idx[1], vals):
+            count += cls.redis_read_connection(pool_index).zcount(k, bounds[0], bounds[1])
+        return count
 
     # fetch related fields
-    # these are pipelined and fetched in a single
-    # atomic redis request
-    # NOTE: this does an awful lot of mucking around
-    # with Django internals
+    # these are fetched with one MGET per pool involved
+    # (just one, unless the related models live in
+    # different pools or are sharded) for each level of
+    # related records
+    # NOTE: this is just redis_get_related_multi for a
+    # single record
     def redis_get_related(self, *args):
-        rd = self.redis_connection()
-
-        # first, match up all the related field names
-        # with their definitions
-        field_list = self.redis_get_field_definitions(*args)
-
-        # now fetch all the data
-        pipe = rd.pipeline()
-        for field_def in field_list:
-            fk = getattr(self, field_def.attname)
-            if fk != None:
-                #print "[pid:%d]" % os.getpid(), "queueing fetch for", field_def.attname
-                pipe.get(field_def.related.parent_model.redis_key(fk))
-                
-        rvs = pipe.execute()
-        #print "[pid:%d]" % os.getpid(), "results:", repr(rvs)
-        
-        # store it in the right places
-        # tricky bit: we didn't fetch related
-        # objects whose IDs are set to None, so
-        # we need to skip those
-        i = 0
-        for field_def in field_list:
-            fk = getattr(self, field_def.attname)
-            if fk != None:
-                #print "[pid:%d]" % os.getpid(), "writing", field_def.name, field_def.attname
-                o = field_def.related.parent_model.redis_in(rvs[i])
-                setattr(self, field_def.name, o)
-                setattr(self, field_def.attname, o.id)  # set the ID too, else Django will re-fetch object
-                i += 1
+        self.redis_get_related_multi([ self ], *args)
 
     # fetch the related fields for an entire set of
-    # records in a single atomic request
+    # records in a single request (per pool)
     # duplicate records are only fetched once
+    # fields may be paths through several related
+    # records, as with select_related (e.g.
+    # 'gamehistory__game'); each level of the paths is
+    # fetched in a single request (per pool) and each
+    # related record is only created once, so records
+    # that share a related record share the instance
+    # NOTE: related records that are missing from redis
+    # are left alone (so Django will fetch them from SQL
+    # if they are used)
     # NOTE: this doesn't check that the records are
     # all of the proper class
     @classmethod
     def redis_get_related_multi(cls, records, *args):
-        rd = cls.redis_connection()
-
-        # first, match up all the related field names
-        # with their definitions
-        field_list = cls.redis_get_field_definitions(*args)
-
-        # for each related field, collect up the unique
-        # IDs for the entire set of records
-        related_items = []
-        for field_def in field_list:
-            all_ids = [ getattr(r, field_def.attname) for r in records ]
-            unique_ids = set([ fk for fk in all_ids if fk != None ])        # removes duplicates
-            related_items.append(( field_def.related.parent_model, unique_ids ))
-            
-        # convert all of these items to their redis keys
-        fetchable_items = []
-        for ri in related_items:
-            fetchable_items.extend([ ri[0].redis_key(fk) for fk in ri[1] ])
-
-        # if there is absolutely nothing to fetch, we can
-        # quit now
-        if len(fetchable_items) == 0:
-            return
-
-        # and fetch them
-        # NOTE: we don't need to pipeline because we're
-        # using one massive mget
-        rvs = rd.mget(*fetchable_items)
-        
-        # now for each field being processed, sort the
-        # responses into a dict and then set up the
-        # references in the records
-        j = 0
-        for i in range(len(field_list)):
-            field_def = field_list[i]
-            ri = related_items[i]
-            
-            # extract just the records for this model and
-            # stuff them in a dict
-            rv_map = {}
-            for k in range(j,j+len(ri[1])):
-                rv = ri[0].redis_in(rvs[k]) # should never be None
-                rv_map[rv.id] = rv
-                
-            # now process all the records and look up the
-            # appropriate related field
-            for r in records:
-                fk = getattr(r, field_def.attname)
-                if fk != None:
-                    o = rv_map[fk]
+        # turn the paths into a tree of field names
+        tree = OrderedDict()
+        for path in args:
+            node = tree
+            for field in path.split('__'):
+                node = node.setdefault(field, OrderedDict())
+
+        # related records by (model, pk), shared across
+        # all the fields and levels
+        instances = {}
+
+        # work through the tree a level at a time; each
+        # level is a list of (model, records, subtree)
+        level = [ ( cls, records, tree ) ]
+        while len(level) > 0:
+            # first, match up all the related field names
+            # with their definitions, and collect up the
+            # unique IDs we don't already have
+            work = []
+            fetchable_items = []
+            fetchable_keys = []
+            for model, level_records, node in level:
+                if not issubclass(model, RedisShadow):
+                    raise RedisShadowException('%s is not shadowed in redis' % (model.__name__,))
+                for field_def in model.redis_get_field_definitions(*node.keys()):
+                    related_model = field_def.related.parent_model
+                    for r in level_records:
+                        fk = getattr(r, field_def.attname)
+                        if fk != None and (related_model, fk) not in instances:
+                            instances[(related_model, fk)] = None
+                            fetchable_items.append(( related_model.redis_pk_pool_indices(fk), related_model.redis_key(fk) ))
+                            fetchable_keys.append(( related_model, fk ))
+                    work.append(( field_def, level_records, node[field_def.name] ))
+
+            # and fetch them
+            # NOTE: we don't need to pipeline because we're
+            # using one massive mget per pool
+            if len(fetchable_items) > 0:
+                rvs = redis_mget_routed(fetchable_items)
+                for k, d in zip(fetchable_keys, rvs):
+                    instances[k] = k[0].redis_in(d)
+
+            # now set up the references in the records, and
+            # collect the related records whose own related
+            # records we have to fetch next
+            next_level = []
+            for field_def, level_records, subtree in work:
+                related_model = field_def.related.parent_model
+                related_records = []
+                seen = set()
+                for r in level_records:
+                    fk = getattr(r, field_def.attname)
+                    if fk == None:
+                        continue
+                    o = instances[(related_model, fk)]
+                    if o == None:
+                        continue
                     setattr(r, field_def.name, o)
                     setattr(r, field_def.attname, o.id) # set the ID too, else Django will re-fetch the object
-                    
-            # skip over the fetched records for this model
-            j += len(ri[1])
+                    if len(subtree) > 0 and o.id not in seen:
+                        seen.add(o.id)
+                        related_records.append(o)
+                if len(related_records) > 0:
+                    next_level.append(( related_model, related_records, subtree ))
+            level = next_level
 
     # match up a list of related field names with
     # their definitions
@@ -391,44 +1804,99 @@ class RedisShadow(object):
     # (also updates any indices)
     # NOTE: if you pass in a redis pipeline it will be used
     # and you are responsible for executing the pipeline
-    # (the pipeline itself will be returned)
+    # (the pipeline itself will be returned); for a sharded
+    # model it must be for redis_record_pool_index()
     def redis_set(self, pipe = None, update_indices = True):
         rd = self.redis_connection()
+        self.redis_assign_id()
+        self.redis_codec().register_schema(rd)
+
+        pool_index = self.redis_record_pool_index()
+        redis_pin_primary(pool_index)
+        execute_pipe = False
+        if pipe == None:
+            pipe = self.redis_connection(pool_index).pipeline()
+            execute_pipe = True
+        else:
+            self.redis_check_pipe(pipe, pool_index)
+        self.redis_set_commands(pipe, update_indices)
+
+        # execute and return the results
+        if execute_pipe:
+            return pipe.execute()
+        else:
+            return pipe
+
+    # write several records of this model at once: new
+    # records get their primary keys from a single DECRBY,
+    # and each pool gets one pipeline
+    # returns the records
+    @classmethod
+    def redis_set_many(cls, records, update_indices = True):
+        if len(records) == 0:
+            return records
+        rd = cls.redis_connection()
+        new = [ r for r in records if r.id == None ]
+        if len(new) > 0:
+            # the same ids, in the same order, as calling
+            # redis_set() on each in turn
+            last = rd.decrby(cls.redis_id_key(), len(new))
+            for i in range(len(new)):
+                new[i].id = last + len(new) - 1 - i
+        cls.redis_codec().register_schema(rd)
+
+        pipes = {}
+        for r in records:
+            pool_index = r.redis_record_pool_index()
+            if pool_index not in pipes:
+                redis_pin_primary(pool_index)
+                pipes[pool_index] = cls.redis_connection(pool_index).pipeline()
+            r.redis_set_commands(pipes[pool_index], update_indices)
+        for pipe in pipes.values():
+            pipe.execute()
+        return records
+
+    # how long (in seconds) the record should live in
+    # redis, or None to keep it until it is deleted;
+    # REDIS_SHADOW_TTL sets this for a whole model, and
+    # models can override this for a per-record TTL
+    # NOTE: a record that expires leaves its index entries
+    # behind, so lookups must cope with missing records
+    def redis_ttl(self):
+        return getattr(self, 'REDIS_SHADOW_TTL', None)
+
+    # make sure the record has a primary key, so we know
+    # which pool it belongs in before writing it
+    def redis_assign_id(self):
         if self.id == None:
             # this record hasn't been saved to the SQL database;
             # we need to obtain a primary key (id)
             # NOTE: we use negative values starting at -1 and
             # proceeding down, to indicate the record is only
             # in redis and not SQL
-            self.id = rd.decr(self.redis_id_key())
-
-        execute_pipe = False
-        if pipe == None:
-            pipe = rd.pipeline()
-            execute_pipe = True
-        pipe.set(self.redis_key(self.id), self.redis_out())
+            self.id = self.redis_connection().decr(self.redis_id_key())
+        return self.id
+
+    # add the commands to write a record (and update its
+    # indices) to a pipeline, wherever it is going
+    def redis_set_commands(self, pipe, update_indices = True):
+        ttl = self.redis_ttl()
+        if ttl == None:
+            pipe.set(self.redis_key(self.id), self.redis_out())
+        else:
+            pipe.setex(self.redis_key(self.id), ttl, self.redis_out())
+        self.redis_cache_invalidate(self.id, pipe)
         
         # update any indices, but only if asked; rarely a
         # record will be updated in a way that requires the
         # indices to not be updated
+        # NOTE: if we know which index entries this record
+        # had (see redis_index_entries), only the changes
+        # are written, including removing it from any index
+        # entries it no longer belongs in
         if update_indices:
-            idxs = getattr(self, 'REDIS_SHADOW_INDEX', [])
-            for slot in range(len(idxs)):
-                self.redis_add_to_index(slot, pipe = pipe)
-
-            idxs = getattr(self, 'REDIS_SHADOW_MINDEX', [])
-            for slot in range(len(idxs)):
-                self.redis_add_to_mindex(slot, pipe = pipe)
-
-            idxs = getattr(self, 'REDIS_SHADOW_ZINDEX', [])
-            for slot in range(len(idxs)):
-                self.redis_add_to_zindex(slot, pipe = pipe)
-                
-        # execute and return the results
-        if execute_pipe:
-            return pipe.execute()
-        else:
-            return pipe
+            self._redis_index_entries = self.redis_indexer().update(self, pipe, self.redis_index_entries())
+            self._redis_index_values = None
 
     # remove a record from the redis server
     # (also updates any indices)
@@ -442,28 +1910,16 @@ class RedisShadow(object):
                 print "[pid:%d]" % os.getpid(), "NOT DELETING DUE TO MISSING PK:", unicode(self)
             return None
 
+        pool_index = self.redis_record_pool_index()
+        redis_pin_primary(pool_index)
         execute_pipe = False
         if pipe == None:
-            rd = self.redis_connection()
+            rd = self.redis_connection(pool_index)
             pipe = rd.pipeline()
             execute_pipe = True
-        
-        # update any indices
-        # each index is a sequence of field names
-        idxs = getattr(self, 'REDIS_SHADOW_INDEX', [])
-        for slot in range(len(idxs)):
-            self.redis_remove_from_index(slot, pipe = pipe)
-                
-        idxs = getattr(self, 'REDIS_SHADOW_MINDEX', [])
-        for slot in range(len(idxs)):
-            self.redis_remove_from_mindex(slot, pipe = pipe)
-
-        idxs = getattr(self, 'REDIS_SHADOW_ZINDEX', [])
-        for slot in range(len(idxs)):
-            self.redis_remove_from_zindex(slot, pipe = pipe)
-
-        # remove the record itself
-        pipe.delete(self.redis_key(self.id))
+        else:
+            self.redis_check_pipe(pipe, pool_index)
+        self.redis_del_commands(pipe)
         
         # execute and return the results
         if execute_pipe:
@@ -471,11 +1927,29 @@ class RedisShadow(object):
         else:
             return pipe
 
+    # add the commands to remove a record (and its index
+    # entries) to a pipeline, wherever it is going
+    def redis_del_commands(self, pipe):
+        # update any indices, using the entries we last
+        # wrote if we know them
+        indexer = self.redis_indexer()
+        entries = self.redis_index_entries()
+        if entries == None:
+            entries = indexer.entries(self)
+        indexer.remove_entries(pipe, self.id, entries)
+        self._redis_index_entries = None
+        self._redis_index_values = None
+
+        # remove the record itself
+        pipe.delete(self.redis_key(self.id))
+        self.redis_cache_invalidate(self.id, pipe)
+
     # for a particular index field, look up the value
     # __ separates related field lookups; use these with
     # care as they will force a SQL ORM lookup on each
     # related record for every redis write if the related
-    # record is not already cached
+    # record is not already cached (redis_get_related_multi
+    # can fetch them all from redis up front)
     def redis_index_value(self, field):
         if isinstance(field, tuple):
             field = field[0]
@@ -518,16 +1992,40 @@ class RedisShadow(object):
                     #elif t == 'date':
                     #   would love to do this but you have to know the time zone
 
-    # create a JSON dictionary suitable for
-    # serialization into redis
+    # fetch the compiled index definitions for this model
+    # (see RedisShadowIndexer)
+    @classmethod
+    def redis_indexer(cls):
+        if '_redis_indexer' not in cls.__dict__:
+            cls._redis_indexer = RedisShadowIndexer(cls)
+        return cls._redis_indexer
+
+    # fetch the compiled codec for this model
+    # NOTE: this is normally built when the class is
+    # prepared, but abstract models (and anything
+    # prepared before this module was loaded) get it
+    # on first use
+    @classmethod
+    def redis_codec(cls):
+        if '_redis_codec' not in cls.__dict__:
+            cls._redis_codec = RedisShadowCodec(cls)
+        return cls._redis_codec
+
+    # serialize the record for storage in redis, in
+    # the model's REDIS_SHADOW_FORMAT
     def redis_out(self):
+        return self.redis_codec().encode(self)
+
+    # the original, generic version of redis_out;
+    # kept as a reference for the compiled codec
+    def redis_out_generic(self):
         d = {}
         for f in self.__class__._meta.local_fields:
             d[f.attname] = getattr(self, f.attname)
         return json.dumps(ilcommon.to_json(d))
         
-    # given a JSON dictionary, unpack it
-    # into an object the Django will accept
+    # given a serialized record (in any format),
+    # unpack it into an object the Django will accept
     # NOTE: objects which override the
     # default constructor and do something
     # clever will probably not work well
@@ -537,6 +2035,39 @@ class RedisShadow(object):
         if d == None:
             return None
         
+        # create the object
+        codec = cls.redis_codec()
+        return codec.instance(cls, codec.decode(d))
+
+    # the original, generic version of redis_in;
+    # kept as a reference for the compiled codec
+    @classmethod
+    def redis_in_generic(cls, d):
+        # don't deserialize if we got nothing
+        if d == None:
+            return None
+        
+        # create the object
+        return cls(**cls.redis_decode_generic(d))
+
+    # given a serialized record (in any format),
+    # unpack it into a dict of field values ready
+    # to be passed to the constructor
+    @classmethod
+    def redis_decode(cls, d):
+        # don't deserialize if we got nothing
+        if d == None:
+            return None
+        return cls.redis_codec().decode(d)
+
+    # the original, generic version of redis_decode;
+    # kept as a reference for the compiled codec
+    @classmethod
+    def redis_decode_generic(cls, d):
+        # don't deserialize if we got nothing
+        if d == None:
+            return None
+        
         # else deserialize the dict
         d = json.loads(d)
         
@@ -557,8 +2088,13 @@ class RedisShadow(object):
             #else:
             #    print
         
-        # create the object
-        return cls(**d)
+        return d
+
+    # given a dict of decoded field values,
+    # create the object
+    @classmethod
+    def redis_instance(cls, values):
+        return cls.redis_codec().instance(cls, values)
 
     # obtain an exclusive lock in redis,
     # but with an expiration time
@@ -567,6 +2103,11 @@ class RedisShadow(object):
     # process, in case it times out before we
     # get around to unlocking it and another
     # process locks it again
+    # NOTE: if REDIS_SHADOW_LOCK_NOTIFY is True on
+    # the class, waiters block on a per-lock wake list
+    # that redis_unlock pushes to, rather than polling;
+    # every process locking the class must agree on
+    # this setting
     @classmethod
     def redis_lock(cls, pk, callback = None):
         if settings.ILCLOUD_REDIS_SHADOW_DUMP_REQUESTS:
@@ -579,14 +2120,7 @@ class RedisShadow(object):
         # deal but with redis it will report that the lock
         # has already been granted
         if (cls,pk) in RedisShadowMiddleware.lock_tracker:
-            if settings.ILCLOUD_REDIS_SHADOW_DUMP_REQUESTS:
-                print "[pid:%d]" % os.getpid(), "  -- already locked"
-            if callback != None:
-                # we might be adding a callback to an existing lock
-                if isinstance(RedisShadowMiddleware.lock_tracker[(cls,pk)], bool):
-                    RedisShadowMiddleware.lock_tracker[(cls,pk)] = []
-                if callback not in RedisShadowMiddleware.lock_tracker[(cls,pk)]:
-                    RedisShadowMiddleware.lock_tracker[(cls,pk)].append(callback)
+            cls.redis_lock_add_callback(pk, callback)
             return True
 
         rd = cls.redis_connection()
@@ -597,13 +2131,22 @@ class RedisShadow(object):
         # amount of time and try again
         # NOTE: we expect locks to be yielded very
         # quickly, so our poll frequency is about 100ms
+        # NOTE: with notification enabled we are woken as
+        # soon as the lock is released instead; we still
+        # time out of BLPOP every second (the shortest it
+        # allows) in case the lock simply expires
+        notify = getattr(cls, 'REDIS_SHADOW_LOCK_NOTIFY', False)
         date_give_up = datetime.datetime.utcnow() + datetime.timedelta(settings.ILCLOUD_REDIS_SHADOW_LOCK_WAIT)
         while datetime.datetime.utcnow() < date_give_up:
             locked = rd.set(k, os.getpid(), settings.ILCLOUD_REDIS_SHADOW_LOCK_DURATION, nx = True)
             if locked:
                 RedisShadowMiddleware.lock_tracker[(cls,pk)] = [ callback ] if callback != None else True
+                redis_pin_all_primaries()   # whatever we read under the lock must be current
                 return locked
-            time.sleep(random.uniform(0.075, 0.125))
+            if notify:
+                rd.blpop(cls.redis_lock_wake_key(pk), 1)
+            else:
+                time.sleep(random.uniform(0.075, 0.125))
             
         # if we get here, it's because we timed out
         # trying to get a lock
@@ -620,11 +2163,18 @@ class RedisShadow(object):
             print "[pid:%d]" % os.getpid(), "RELEASING LOCK: %s:%d" % (cls.__name__, pk)
 
         rd = cls.redis_connection()
-        rv = unlock_script(
-                keys = [ cls.redis_lock_key(pk) ],
-                args = [ os.getpid() ],
-                client = rd,
-            )
+        if getattr(cls, 'REDIS_SHADOW_LOCK_NOTIFY', False):
+            rv = unlock_notify_script(
+                    keys = [ cls.redis_lock_key(pk), cls.redis_lock_wake_key(pk) ],
+                    args = [ os.getpid(), int(settings.ILCLOUD_REDIS_SHADOW_LOCK_DURATION * 1000) ],
+                    client = rd,
+                )
+        else:
+            rv = unlock_script(
+                    keys = [ cls.redis_lock_key(pk) ],
+                    args = [ os.getpid() ],
+                    client = rd,
+                )
 
         # process all callbacks on releasing this lock
         callbacks = RedisShadowMiddleware.lock_tracker[(cls,pk)]
@@ -635,6 +2185,101 @@ class RedisShadow(object):
         del RedisShadowMiddleware.lock_tracker[(cls,pk)]
         return rv
 
+    # we already hold a lock, but we might be adding a
+    # callback to it
+    @classmethod
+    def redis_lock_add_callback(cls, pk, callback):
+        if settings.ILCLOUD_REDIS_SHADOW_DUMP_REQUESTS:
+            print "[pid:%d]" % os.getpid(), "  -- already locked"
+        if callback != None:
+            if isinstance(RedisShadowMiddleware.lock_tracker[(cls,pk)], bool):
+                RedisShadowMiddleware.lock_tracker[(cls,pk)] = []
+            if callback not in RedisShadowMiddleware.lock_tracker[(cls,pk)]:
+                RedisShadowMiddleware.lock_tracker[(cls,pk)].append(callback)
+
+    # obtain a whole set of exclusive locks at once
+    # in a single atomic operation; either every lock
+    # is granted or none of them are
+    # NOTE: locks we already hold are skipped; the
+    # rest are always taken in pk order, the same order
+    # we would use locking them one by one
+    # NOTE: if any of them are held elsewhere we wait and
+    # try again, as redis_lock does, until
+    # ILCLOUD_REDIS_SHADOW_LOCK_WAIT runs out
+    @classmethod
+    def redis_lock_many(cls, pks, callback = None):
+        pks = sorted(set(pks))
+        if settings.ILCLOUD_REDIS_SHADOW_DUMP_REQUESTS:
+            print "[pid:%d]" % os.getpid(), "ACQUIRING LOCKS: %s:%s" % (cls.__name__, ','.join([ str(pk) for pk in pks ]))
+
+        needed = []
+        for pk in pks:
+            if (cls,pk) in RedisShadowMiddleware.lock_tracker:
+                cls.redis_lock_add_callback(pk, callback)
+            else:
+                needed.append(pk)
+        if len(needed) == 0:
+            return True
+
+        rd = cls.redis_connection()
+        ks = [ cls.redis_lock_key(pk) for pk in needed ]
+        notify = getattr(cls, 'REDIS_SHADOW_LOCK_NOTIFY', False)
+        blocked = 1
+        date_give_up = datetime.datetime.utcnow() + datetime.timedelta(settings.ILCLOUD_REDIS_SHADOW_LOCK_WAIT)
+        while datetime.datetime.utcnow() < date_give_up:
+            blocked = lock_many_script(
+                    keys = ks,
+                    args = [ os.getpid(), settings.ILCLOUD_REDIS_SHADOW_LOCK_DURATION ],
+                    client = rd,
+                )
+            if blocked == 0:
+                for pk in needed:
+                    RedisShadowMiddleware.lock_tracker[(cls,pk)] = [ callback ] if callback != None else True
+                redis_pin_all_primaries()   # whatever we read under the locks must be current
+                return True
+
+            # wait on the lock that stopped us
+            if notify:
+                rd.blpop(cls.redis_lock_wake_key(needed[blocked - 1]), 1)
+            else:
+                time.sleep(random.uniform(0.075, 0.125))
+
+        # if we get here, it's because we timed out
+        # trying to get the locks
+        raise RedisShadowLockException("timed out trying to gain lock " + ks[blocked - 1])
+
+    # release a whole set of exclusive locks in a
+    # single operation (locks we don't hold are ignored)
+    # returns the number of locks that were ours to
+    # release
+    @classmethod
+    def redis_unlock_many(cls, pks):
+        pks = [ pk for pk in sorted(set(pks)) if (cls,pk) in RedisShadowMiddleware.lock_tracker ]
+        if len(pks) == 0:
+            return 0
+        if settings.ILCLOUD_REDIS_SHADOW_DUMP_REQUESTS:
+            print "[pid:%d]" % os.getpid(), "RELEASING LOCKS: %s:%s" % (cls.__name__, ','.join([ str(pk) for pk in pks ]))
+
+        rd = cls.redis_connection()
+        rv = unlock_many_script(
+                keys = [ cls.redis_lock_key(pk) for pk in pks ] + [ cls.redis_lock_wake_key(pk) for pk in pks ],
+                args = [
+                    os.getpid(),
+                    1 if getattr(cls, 'REDIS_SHADOW_LOCK_NOTIFY', False) else 0,
+                    int(settings.ILCLOUD_REDIS_SHADOW_LOCK_DURATION * 1000),
+                ],
+                client = rd,
+            )
+
+        # process all callbacks on releasing these locks
+        for pk in pks:
+            callbacks = RedisShadowMiddleware.lock_tracker[(cls,pk)]
+            if not isinstance(callbacks, bool):
+                for callback in callbacks:
+                    callback(pk)
+            del RedisShadowMiddleware.lock_tracker[(cls,pk)]
+        return rv
+
     # save a record
     # for the most part, this just passes through to Django,
     # but it does save a reference to the object so that
@@ -658,6 +2303,12 @@ class RedisShadow(object):
         
         return rv
 
+    # determine if this model's middleware writes should
+    # go through the write-behind spool
+    @classmethod
+    def redis_write_behind(cls):
+        return getattr(cls, 'REDIS_SHADOW_WRITE_BEHIND', False) and RedisShadowSpool.enabled()
+
     # mark a record as needing to be saved in redis when
     # the request is over; this is useful if you know it
     # has been saved by Django and Django has skipped the
@@ -679,9 +2330,10 @@ class RedisShadow(object):
             # else we can log this in the save tracker and
             # finish it later
             record_key = (self.__class__,self.pk)
-            if RedisShadowMiddleware.save_tracker[self.redis_pool_index()] == None:
-                RedisShadowMiddleware.save_tracker[self.redis_pool_index()] = {}
-            RedisShadowMiddleware.save_tracker[self.redis_pool_index()][record_key] = self
+            pool_index = self.redis_record_pool_index()
+            if RedisShadowMiddleware.save_tracker[pool_index] == None:
+                RedisShadowMiddleware.save_tracker[pool_index] = {}
+            RedisShadowMiddleware.save_tracker[pool_index][record_key] = self
 
     # delete a record
     # for the most part, this just passes through to Django,
@@ -729,178 +2381,319 @@ class RedisShadow(object):
             # else we can log this in the delete tracker and
             # finish it later
             record_key = (self.__class__,self.pk)
-            if RedisShadowMiddleware.delete_tracker[self.redis_pool_index()] == None:
-                RedisShadowMiddleware.delete_tracker[self.redis_pool_index()] = {}
-            RedisShadowMiddleware.delete_tracker[self.redis_pool_index()][record_key] = self
+            pool_index = self.redis_record_pool_index()
+            if RedisShadowMiddleware.delete_tracker[pool_index] == None:
+                RedisShadowMiddleware.delete_tracker[pool_index] = {}
+            RedisShadowMiddleware.delete_tracker[pool_index][record_key] = self
 
     # flush a redis index (because you are about to
     # repopulate it)
     @classmethod
     def redis_flush_index(cls, slot):
-        rd = cls.redis_connection()
         k = cls.redis_index_key(slot)
-        rd.delete(k)
+        for pool_index in cls.redis_pool_indices():
+            cls.redis_connection(pool_index).delete(k)
 
     # flush a redis mindex (because you are about to
     # repopulate it)
-    # NOTE: THIS IS NOT FAST
     @classmethod
     def redis_flush_mindex(cls, slot):
-        rd = cls.redis_connection()
-        k = cls.redis_mindex_key(slot, None)    # just the base key
-        ks = rd.keys(k + ':*')                  # slow operation
-        if len(ks):
-            rd.delete(ks)
+        return cls.redis_flush_index_keys('mindex', slot)
 
     # flush a redis zindex (because you are about to
     # repopulate it)
-    # NOTE: THIS IS NOT FAST
     @classmethod
     def redis_flush_zindex(cls, slot):
-        rd = cls.redis_connection()
-        k = cls.redis_zindex_key(slot, None)    # just the base key
-        ks = rd.keys(k + ':*')                  # slow operation
-        if len(ks):
-            rd.delete(ks)
+        return cls.redis_flush_index_keys('zindex', slot)
+
+    # iterate over all the keys used by a mindex or zindex
+    # slot; kind is 'mindex' or 'zindex'
+    # NOTE: uses the slot's key registry if it can be
+    # trusted, otherwise falls back to an incremental
+    # SCAN (slow, but doesn't block the server)
+    # NOTE: for a sharded model this only covers one
+    # shard (the first, unless pool_index says otherwise)
+    @classmethod
+    def redis_iter_index_keys(cls, kind, slot, count = 1000, pool_index = None):
+        rd = cls.redis_connection(pool_index)
+        if rd.exists(cls.redis_index_registry_complete_key(kind, slot)):
+            return rd.sscan_iter(cls.redis_index_registry_key(kind, slot), count = count)
+        if kind == 'mindex':
+            k = cls.redis_mindex_key(slot, None)    # just the base key
+        else:
+            k = cls.redis_zindex_key(slot, None)    # just the base key
+        return rd.scan_iter(match = k + ':*', count = count)
+
+    # delete all the keys used by a mindex or zindex slot,
+    # in bounded batches
+    # NOTE: once this has finished the slot's registry
+    # is complete, so later flushes won't need to SCAN
+    # returns the number of keys deleted
+    @classmethod
+    def redis_flush_index_keys(cls, kind, slot, batch_size = 1000):
+        rk = cls.redis_index_registry_key(kind, slot)
+        deleted_count = 0
+        for pool_index in cls.redis_pool_indices():
+            rd = cls.redis_connection(pool_index)
+            batch = []
+            for k in cls.redis_iter_index_keys(kind, slot, batch_size, pool_index):
+                batch.append(k)
+                if len(batch) >= batch_size:
+                    cls.redis_flush_index_key_batch(rd, rk, batch)
+                    deleted_count += len(batch)
+                    batch = []
+            if len(batch) > 0:
+                cls.redis_flush_index_key_batch(rd, rk, batch)
+                deleted_count += len(batch)
+
+            rd.set(cls.redis_index_registry_complete_key(kind, slot), 1)
+        return deleted_count
+
+    # delete one batch of index keys and remove them
+    # from the registry (rather than deleting the whole
+    # registry at the end, so that keys added while we
+    # are flushing stay registered)
+    @classmethod
+    def redis_flush_index_key_batch(cls, rd, rk, keys):
+        pipe = rd.pipeline(transaction = False)
+        pipe.delete(*keys)
+        pipe.srem(rk, *keys)
+        pipe.execute()
 
     # flush all indices (because you are about to
     # repopulate them)
     @classmethod
     def redis_flush_all_indices(cls):
-        rd = cls.redis_connection()
-        pipe = rd.pipeline()
         deleted_count = 0
 
         idxs = getattr(cls, 'REDIS_SHADOW_INDEX', [])
-        for slot in range(len(idxs)):
-            k = cls.redis_index_key(slot)
-            pipe.delete(k)
-            deleted_count += 1
+        for pool_index in cls.redis_pool_indices():
+            pipe = cls.redis_connection(pool_index).pipeline()
+            for slot in range(len(idxs)):
+                k = cls.redis_index_key(slot)
+                pipe.delete(k)
+                deleted_count += 1
+
+            if len(pipe.command_stack) > 0:
+                # don't execute the pipeline if it is empty;
+                # StrictPipeline will complain
+                pipe.execute()
 
         idxs = getattr(cls, 'REDIS_SHADOW_MINDEX', [])
         for slot in range(len(idxs)):
-            k = cls.redis_mindex_key(slot, None)    # just the base key
-            ks = rd.keys(k + ':*')                  # slow operation
-            pipe.delete(*ks)
-            deleted_count += len(ks)
+            deleted_count += cls.redis_flush_mindex(slot)
 
         idxs = getattr(cls, 'REDIS_SHADOW_ZINDEX', [])
         for slot in range(len(idxs)):
-            k = cls.redis_zindex_key(slot, None)    # just the base key
-            ks = rd.keys(k + ':*')                  # slow operation
-            pipe.delete(*ks)
-            deleted_count += len(ks)
+            deleted_count += cls.redis_flush_zindex(slot)
 
-        if deleted_count > 0:
-            # don't execute the pipeline if it is empty;
-            # StrictPipeline will complain
-            pipe.execute()
+        return deleted_count
 
     # add a specific record to a specific index
     # NOTE: if no pipeline is provided, executes all
     # commands immediately
     def redis_add_to_index(self, slot, pipe = None):
-        if pipe == None:
-            pipe = self.redis_connection()
-
-        idxs = getattr(self, 'REDIS_SHADOW_INDEX', [])
-        idx = idxs[slot]
-        # we allow None as an index so we can "remove"
-        # certain indices after the fact without
-        # having to renumber all the following ones
-        if idx != None:
-            k = self.redis_index_key(slot)
-            vals = [ self.redis_index_value(field) for field in idx ]   # redis hash field is composite of index field values in record
-            self.redis_fix_index_types(idx, vals)
-            f = repr(vals)
-            pipe.hset(k, f, self.id)
+        self.redis_update_slot('index', slot, pipe, True)
 
     # add a specific record to a specific mindex
     # NOTE: if no pipeline is provided, executes all
     # commands immediately
     def redis_add_to_mindex(self, slot, pipe = None):
-        if pipe == None:
-            pipe = self.redis_connection()
-
-        idxs = getattr(self, 'REDIS_SHADOW_MINDEX', [])
-        idx = idxs[slot]
-        # we allow None as an index so we can "remove"
-        # certain indices after the fact without
-        # having to renumber all the following ones
-        if idx != None:
-            vals = [ self.redis_index_value(field) for field in idx ]   # redis key is composite of slot and index field values in record
-            self.redis_fix_index_types(idx, vals)
-            k = self.redis_mindex_key(slot, vals)
-            pipe.sadd(k, self.id)
+        self.redis_update_slot('mindex', slot, pipe, True)
     
     # add a specific record to a specific zindex
     # NOTE: if no pipeline is provided, executes all
     # commands immediately
     def redis_add_to_zindex(self, slot, pipe = None):
-        if pipe == None:
-            pipe = self.redis_connection()
-
-        idxs = getattr(self, 'REDIS_SHADOW_ZINDEX', [])
-        idx = idxs[slot]
-        # we allow None as an index so we can "remove"
-        # certain indices after the fact without
-        # having to renumber all the following ones
-        if idx != None:
-            vals = [ self.redis_index_value(field) for field in idx[1] ]   # redis key is composite of slot and index field values in record
-            self.redis_fix_index_types(idx[1], vals)
-            k = self.redis_zindex_key(slot, vals)
-            s = [ self.redis_index_value(idx[0]) ]      # score
-            self.redis_fix_index_types(None, s)
-            pipe.zadd(k, s[0], self.id)
+        self.redis_update_slot('zindex', slot, pipe, True)
     
     # remove a specific record from a specific index
     # NOTE: if no pipeline is provided, executes all
     # commands immediately
     def redis_remove_from_index(self, slot, pipe = None):    
-        if pipe == None:
-            pipe = self.redis_connection()
-
-        idxs = getattr(self, 'REDIS_SHADOW_INDEX', [])
-        idx = idxs[slot]
-        # we allow None as an index so we can "remove"
-        # certain indices after the fact without
-        # having to renumber all the following ones
-        if idx != None:
-            k = self.redis_index_key(slot)
-            vals = [ self.redis_index_value(field) for field in idx ]   # redis hash field is composite of index field values in record
-            self.redis_fix_index_types(idx, vals)
-            f = repr(vals)
-            pipe.hdel(k, f)
+        self.redis_update_slot('index', slot, pipe, False)
 
     def redis_remove_from_mindex(self, slot, pipe = None):    
-        if pipe == None:
-            pipe = self.redis_connection()
-
-        idxs = getattr(self, 'REDIS_SHADOW_MINDEX', [])
-        idx = idxs[slot]
-        # we allow None as an index so we can "remove"
-        # certain indices after the fact without
-        # having to renumber all the following ones
-        if idx != None:
-            vals = [ self.redis_index_value(field) for field in idx ]   # redis hash field is composite of index field values in record
-            self.redis_fix_index_types(idx, vals)
-            k = self.redis_mindex_key(slot, vals)
-            pipe.srem(k, self.id)
+        self.redis_update_slot('mindex', slot, pipe, False)
 
     def redis_remove_from_zindex(self, slot, pipe = None):    
+        self.redis_update_slot('zindex', slot, pipe, False)
+
+    # add a record to (or remove it from) a single index
+    # slot, based on its current values
+    def redis_update_slot(self, kind, slot, pipe, add):
         if pipe == None:
-            pipe = self.redis_connection()
-
-        idxs = getattr(self, 'REDIS_SHADOW_ZINDEX', [])
-        idx = idxs[slot]
-        # we allow None as an index so we can "remove"
-        # certain indices after the fact without
-        # having to renumber all the following ones
-        if idx != None:
-            vals = [ self.redis_index_value(field) for field in idx[1] ]   # redis hash field is composite of index field values in record
-            self.redis_fix_index_types(idx[1], vals)
-            k = self.redis_zindex_key(slot, vals)
-            pipe.zrem(k, self.id)
+            pipe = self.redis_connection(self.redis_record_pool_index())
+
+        indexer = self.redis_indexer()
+        entries = indexer.entries(self, [ (kind, slot) ])
+        if add:
+            indexer.add_entries(pipe, self.id, entries)
+        else:
+            indexer.remove_entries(pipe, self.id, entries)
+
+        # we no longer know exactly which entries the
+        # record has
+        self._redis_index_entries = None
+        self._redis_index_values = None
+
+    # work out which index entries this record has in
+    # redis: the ones we last wrote, or else the ones it
+    # had when it was loaded from redis (see
+    # RedisShadowCodec.instance)
+    # returns None if we don't know
+    def redis_index_entries(self):
+        entries = getattr(self, '_redis_index_entries', None)
+        if entries == None:
+            values = getattr(self, '_redis_index_values', None)
+            if values != None:
+                entries = self.redis_indexer().snapshot_entries(self, values)
+        return entries
+
+    # forget which index entries this record has, so the
+    # next redis_set writes all of them (e.g. when it is
+    # being written somewhere its entries may be missing)
+    def redis_forget_index_entries(self):
+        self._redis_index_entries = None
+        self._redis_index_values = None
+
+# write-behind spooling for record saves and deletes
+#
+# when a model sets REDIS_SHADOW_WRITE_BEHIND to True and
+# a spool server is configured, the middleware doesn't
+# write that model's records to the shadow at the end of
+# the request; instead the pipeline commands for each
+# record are serialized and pushed onto a redis list on
+# the spool server, and the redis_shadow_spool_worker
+# command replays them against the shadow
+#
+# settings:
+#
+#   ILCLOUD_REDIS_SHADOW_SPOOL          (host, port, db) of the spool server, or None to disable
+#   ILCLOUD_REDIS_SHADOW_SPOOL_SHARDS   number of spool lists (default 4); run one worker per list
+#
+# NOTE: each record's commands go to a spool list chosen
+# by hashing (class, pk), and each list is drained in
+# order by a single worker, so writes to any one record
+# are always applied in the order they were made
+#
+# NOTE: the data only reaches the shadow when the worker
+# gets to it; don't use this for models that are read
+# back under a lock (e.g. GameProgress), as the next
+# lock holder may not see the previous holder's writes
+class RedisShadowSpool(object):
+
+    pool = None
+
+    @classmethod
+    def enabled(cls):
+        return getattr(settings, 'ILCLOUD_REDIS_SHADOW_SPOOL', None) != None
+
+    @classmethod
+    def shards(cls):
+        return getattr(settings, 'ILCLOUD_REDIS_SHADOW_SPOOL_SHARDS', 4)
+
+    @classmethod
+    def connection(cls):
+        if cls.pool == None:
+            h, p, db = settings.ILCLOUD_REDIS_SHADOW_SPOOL
+            cls.pool = redis.ConnectionPool(host = h, port = p, db = db)
+        return redis.StrictRedis(connection_pool = cls.pool)
+
+    @staticmethod
+    def spool_key(shard):
+        return 'dbshadow_spool:%d' % (shard,)
+
+    @staticmethod
+    def processing_key(shard):
+        return 'dbshadow_spool_processing:%d' % (shard,)
+
+    # capture the commands a method would add to a
+    # pipeline for a particular pool, without running them
+    @staticmethod
+    def capture(pool_index, method):
+        pipe = redis_connection(pool_index).pipeline(transaction = False)
+        method(pipe)
+        cmds = [ args for args, options in pipe.command_stack ]
+        pipe.reset()
+        return cmds
+
+    # serialize one record's commands; arguments that
+    # aren't valid UTF-8 (e.g. msgpack records) are
+    # base64-encoded so they survive the trip through JSON
+    @staticmethod
+    def encode_entry(pool_index, record_key, cmds):
+        encoded = []
+        for args in cmds:
+            encoded_args = []
+            for a in args:
+                if isinstance(a, str):
+                    try:
+                        a.decode('utf-8')
+                    except UnicodeDecodeError:
+                        a = { 'b64': base64.b64encode(a) }
+                encoded_args.append(a)
+            encoded.append(encoded_args)
+        return json.dumps({ 'p': pool_index, 'k': record_key, 'c': encoded })
+
+    @staticmethod
+    def decode_entry(entry):
+        entry = json.loads(entry)
+        cmds = []
+        for args in entry['c']:
+            cmds.append([ base64.b64decode(a['b64']) if isinstance(a, dict) else a for a in args ])
+        return entry['p'], entry['k'], cmds
+
+    # push a list of (pool index, record key, commands)
+    # tuples onto the spool, in a single round trip
+    # NOTE: we LPUSH and the worker pops from the right,
+    # so each list is first-in, first-out
+    @classmethod
+    def push(cls, entries):
+        pipe = cls.connection().pipeline(transaction = False)
+        for pool_index, record_key, cmds in entries:
+            if len(cmds) == 0:
+                continue        # e.g. deleting a record that was never saved
+            shard = (zlib.crc32(record_key) & 0xffffffff) % cls.shards()
+            pipe.lpush(cls.spool_key(shard), cls.encode_entry(pool_index, record_key, cmds))
+        if len(pipe.command_stack) > 0:
+            pipe.execute()
+
+    # replay a list of serialized entries against the
+    # shadow, in order; commands for each pool go out in
+    # a single pipeline
+    # NOTE: connection errors are raised so the caller can
+    # retry the whole batch (every spooled command is
+    # safe to repeat); errors from individual commands
+    # are returned, since retrying them won't help
+    @classmethod
+    def apply(cls, entries):
+        pipes = {}
+        for entry in entries:
+            pool_index, record_key, cmds = cls.decode_entry(entry)
+            if pool_index not in pipes:
+                pipes[pool_index] = redis_connection(pool_index).pipeline(transaction = False)
+            for args in cmds:
+                pipes[pool_index].execute_command(*args)
+
+        errors = []
+        for pool_index, pipe in pipes.iteritems():
+            for rv in pipe.execute(raise_on_error = False):
+                if isinstance(rv, redis.ConnectionError):
+                    raise rv
+                if isinstance(rv, Exception):
+                    errors.append(rv)
+        return errors
+
+# compile the codec and the index definitions for every
+# shadowed model as soon as
+# Django has finished setting up its fields
+def redis_shadow_class_prepared(sender, **kwargs):
+    if issubclass(sender, RedisShadow):
+        sender.redis_codec()
+        sender.redis_indexer()
+
+class_prepared.connect(redis_shadow_class_prepared)
 
 class RedisShadowMiddleware(object):
 
@@ -926,12 +2719,25 @@ class RedisShadowMiddleware(object):
     # was raised
     message_queue = None
 
+    # how many of the request's state messages were
+    # delivered and how many were dropped because nobody
+    # was listening; set by send_all_messages
+    message_report = None
+
+    # the pools whose reads are pinned to the primary for
+    # the rest of the request (see redis_pin_primary)
+    # NOTE: outside of a request, pins last for the life
+    # of the process
+    primary_pins = set()
+
     def process_request(self, request):
         # make sure these are cleared
         self.__class__.save_tracker = [ None ] * len(settings.ILCLOUD_REDIS_SHADOW) # one per connection
         self.__class__.delete_tracker = [ None ] * len(settings.ILCLOUD_REDIS_SHADOW) # one per connection
         self.__class__.lock_tracker = {}
         self.__class__.message_queue = []
+        self.__class__.message_report = None
+        self.__class__.primary_pins = set()
         
     def process_response(self, request, response):
         # if there are any records to save, save them
@@ -962,7 +2768,9 @@ class RedisShadowMiddleware(object):
             return
         
         # go ahead and set all the records
-        # NOTE: we use a single pipeline for all of these
+        # NOTE: we use a single pipeline for all of these,
+        # except for write-behind records, which are spooled
+        spooled = []
         for ci in range(len(save_tracker)):
             c = save_tracker[ci]
             if c != None and len(c) > 0:
@@ -972,8 +2780,13 @@ class RedisShadowMiddleware(object):
                 rd = redis_connection(ci)
                 pipe = rd.pipeline()
                 for k,v in c.iteritems():
-                    v.redis_set(pipe)
-                pipe.execute()
+                    if v.redis_write_behind():
+                        spooled.append(( ci, '%s:%s' % (k[0].__name__, k[1]), RedisShadowSpool.capture(ci, v.redis_set) ))
+                    else:
+                        v.redis_set(pipe)
+                if len(pipe.command_stack) > 0:
+                    pipe.execute()
+        RedisShadowSpool.push(spooled)
 
         # flush the recorded saves, we're done
         # (should not be necessary)
@@ -985,7 +2798,9 @@ class RedisShadowMiddleware(object):
             return
         
         # go ahead and delete all the records
-        # NOTE: we use a single pipeline for all of these
+        # NOTE: we use a single pipeline for all of these,
+        # except for write-behind records, which are spooled
+        spooled = []
         for ci in range(len(delete_tracker)):
             c = delete_tracker[ci]
             if c != None and len(c) > 0:
@@ -995,8 +2810,13 @@ class RedisShadowMiddleware(object):
                 rd = redis_connection(ci)
                 pipe = rd.pipeline()
                 for k,v in c.iteritems():
-                    v.redis_del(pipe)
-                pipe.execute()
+                    if v.redis_write_behind():
+                        spooled.append(( ci, '%s:%s' % (k[0].__name__, k[1]), RedisShadowSpool.capture(ci, v.redis_del) ))
+                    else:
+                        v.redis_del(pipe)
+                if len(pipe.command_stack) > 0:
+                    pipe.execute()
+        RedisShadowSpool.push(spooled)
 
         # flush the recorded deletes, we're done
         # (should not be necessary)
@@ -1017,41 +2837,42 @@ class RedisShadowMiddleware(object):
             
             # Before we submit these messages to the queues,
             # we want to determine which queues already exist.
-            # To do this reliably we must lock all of the
-            # candidate queues, verify their existence, add
-            # the messages if the queue exists, and then
-            # release the locks.
-
-            # lock queues
+            # The script does the check and the delivery in
+            # one atomic step, so we no longer need to lock
+            # the candidate queues to do this reliably; set
+            # ILCLOUD_REDIS_SHADOW_MESSAGE_LOCKS to True to
+            # lock them anyway (e.g. if queues are set up
+            # in several steps under the GameProgress lock).
             unique_progress_ids = sorted(set([ m[0].id for m in message_queue ]))
+            use_locks = getattr(settings, 'ILCLOUD_REDIS_SHADOW_MESSAGE_LOCKS', False)
+            if use_locks:
+                GameProgress.redis_lock_many(unique_progress_ids)
+
+            # NOTE: every message has to be JSON-serialized
+            # up front now, even those for queues nobody is
+            # listening to; this is far cheaper than the
+            # round trips it replaces
+            queue_numbers = {}
+            ks = []
             for progress_id in unique_progress_ids:
-                GameProgress.redis_lock(progress_id)
-
-            # determine which queues are valid
-            valid_progress_ids = {}
-            for progress_id in unique_progress_ids:
-                queue_sessions_id = 'notification_session_queue_offset:' + str(progress_id)
-                valid_progress_ids[progress_id] = (rd.zcard(queue_sessions_id) > 0)
-
-            # deliver the messages, if the queues exist
-            # NOTE: we wait until the very last moment to
-            # JSON-serialize so that, if we determine a
-            # message doesn't need to be delivered (because
-            # no clients are listening for them), we can
-            # avoid doing the serialization work
-            pipe = rd.pipeline()
-            execute_pipeline = False
+                queue_numbers[progress_id] = len(queue_numbers) + 1
+                ks.append('notification_session_queue_offset:' + str(progress_id))
+                ks.append('notification_queue:' + str(progress_id))
+            args = []
             for m in message_queue:
-                if valid_progress_ids[m[0].id]:
-                    queue_id = 'notification_queue:' + str(m[0].id)
-                    pipe.rpush(queue_id, json.dumps(m[1]))
-                    execute_pipeline = True
-            if execute_pipeline:
-               pipe.execute()
+                args.append(queue_numbers[m[0].id])
+                args.append(json.dumps(m[1]))
+
+            delivered, dropped = deliver_messages_script(keys = ks, args = args, client = rd)
+            self.__class__.message_report = { 'delivered': delivered, 'dropped': dropped }
+            if settings.ILCLOUD_REDIS_SHADOW_DUMP_REQUESTS:
+                print "[pid:%d]" % os.getpid(), "STATE MESSAGES: %d delivered, %d dropped" % (delivered, dropped)
 
             # unlock everything
-            for progress_id in unique_progress_ids:
-                GameProgress.redis_unlock(progress_id)
+            if use_locks:
+                GameProgress.redis_unlock_many(unique_progress_ids)
+
+        return self.__class__.message_report
 
     def release_all_locks(self):
         lock_tracker = self.__class__.lock_tracker
@@ -1063,12 +2884,14 @@ class RedisShadowMiddleware(object):
         if settings.ILCLOUD_REDIS_SHADOW_DUMP_REQUESTS:
             print "[pid:%d]" % os.getpid(), "RELEASING ALL LOCKS"
         
-        # use keys() instead of iterkeys() because the
-        # latter requires the dict to remain unchanged
-        # throughout, and each call to redis_unlock will
-        # update the dict
+        # release each class's locks in one go
+        # NOTE: we collect the keys up front because each
+        # call to redis_unlock_many will update the dict
+        pks_by_class = {}
         for k in lock_tracker.keys():
-            k[0].redis_unlock(k[1])
+            pks_by_class.setdefault(k[0], []).append(k[1])
+        for cls, pks in pks_by_class.iteritems():
+            cls.redis_unlock_many(pks)
 
         # flush the recorded locks, we're done
         self.__class__.lock_tracker = None
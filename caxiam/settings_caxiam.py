@@ -80,6 +80,28 @@ CAXIAM_S3FILES_CHECK_IMAGES = True          # whether to extract image metadata
 CAXIAM_S3FILES_DIR = None                   # if not None, contains a path fragment where uploads will go
 CAXIAM_S3FILES_REMOTE_URL = '/media/'       # URL base path for remote media
 
+# set this to True to give velocity event records in
+# redis a TTL of their type's expunge_after (plus a day);
+# the hourly velocity_expunge job removes old events and
+# their index entries either way, but it can't find
+# cancelled events
+CAXIAM_VELOCITY_EVENT_TTL = False
+
+# how AuditTrail entries recorded through AuditTrailSink
+# are written (see caxiam.velocity.audit):
+#   "request"   one bulk_create at the end of the request
+#   "async"     spooled to redis at the end of the request,
+#               and written by the audit_trail_drain cron
+#               job in large batches
+#   "sync"      saved right away
+# CAXIAM_AUDIT_MODES overrides the mode per event type,
+# e.g. { 'login': 'sync' }
+CAXIAM_AUDIT_MODE = 'request'
+CAXIAM_AUDIT_MODES = {}
+CAXIAM_AUDIT_SPOOL_POOL = 0         # redis shadow pool holding the async list
+CAXIAM_AUDIT_BATCH_SIZE = 1000      # entries per bulk_create when draining
+CAXIAM_AUDIT_DRAIN_LOCK = 300       # seconds a drain may take over one batch before another can start
+
 # revert to always using the temporary file upload handler
 # as we always need to have the file on disk
 #FILE_UPLOAD_HANDLERS = ( "django.core.files.uploadhandler.TemporaryFileUploadHandler", )
@@ -102,6 +124,11 @@ CAXIAM_DUMP_SQL = False
 # each request
 CAXIAM_DUMP_SESSION = False
 
+# set this to True to report the redis shadow traffic of
+# each request, per model (needs
+# ILCLOUD_REDIS_SHADOW_INSTRUMENT)
+CAXIAM_DUMP_REDIS = False
+
 # set this to True to echo all AJAX requests/responses to
 # the console
 CAXIAM_AJAX_DUMP_INFO = False
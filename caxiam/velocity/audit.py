@@ -0,0 +1,230 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from caxiam.redis_shadow import redis_connection, redis_register_script, unlock_script
+from caxiam.velocity.models import AuditTrail
+import json
+import os
+
+# buffered writing of AuditTrail entries
+#
+# rather than saving an AuditTrail record per event (an
+# INSERT on the request path each time), use
+# AuditTrailSink.record(); depending on the event type's
+# mode, the entry is:
+#
+#   "request"   held until the end of the request, and
+#               then written with all the request's other
+#               entries by a single bulk_create
+#   "async"     held until the end of the request, and
+#               then pushed (with the others) onto a redis
+#               list, which the audit_trail_drain cron job
+#               (or AuditTrailSink.drain()) writes to SQL
+#               in large batches
+#   "sync"      saved right away, as before
+#
+# outside of a request (e.g. in cron jobs) "request"
+# entries are saved right away
+#
+# settings (see settings_caxiam.py):
+#
+#   CAXIAM_AUDIT_MODE           the mode for event types not listed below
+#   CAXIAM_AUDIT_MODES          dict of event type to mode
+#   CAXIAM_AUDIT_SPOOL_POOL     the redis shadow pool holding the async list
+#   CAXIAM_AUDIT_BATCH_SIZE     entries per bulk_create when draining
+#   CAXIAM_AUDIT_DRAIN_LOCK     seconds a drain holds its lock without
+#                               finishing a batch
+#
+# NOTE: AuditTrailMiddleware must be installed for
+# entries to be held until the end of the request
+#
+# NOTE: async entries are written at least once; if the
+# drain dies after its bulk_create but before it confirms
+# the batch, the batch will be written again
+#
+# NOTE: only one drain runs at a time (they share the
+# processing list); a drain that finds another one
+# running just returns
+
+AUDIT_MODES = ( 'request', 'async', 'sync' )
+
+# move up to ARGV[1] of the oldest entries from the spool
+# list (KEYS[1]) to the processing list (KEYS[2]) and
+# return them, oldest first
+lua = '''
+local entries = redis.call("lrange", KEYS[1], -tonumber(ARGV[1]), -1)
+if #entries > 0 then
+    redis.call("ltrim", KEYS[1], 0, -#entries - 1)
+    for i = #entries, 1, -1 do
+        redis.call("lpush", KEYS[2], entries[i])
+    end
+end
+local rv = {}
+for i = #entries, 1, -1 do
+    rv[#rv + 1] = entries[i]
+end
+return rv
+'''
+audit_spool_take_script = redis_register_script(lua)
+
+class AuditTrailSink(object):
+
+    # the current request's entries, or None if we are not
+    # in a request
+    buffer = None
+
+    # which mode does an event type use?
+    @classmethod
+    def mode(cls, event_type):
+        modes = getattr(settings, 'CAXIAM_AUDIT_MODES', {})
+        return modes.get(event_type, getattr(settings, 'CAXIAM_AUDIT_MODE', 'request'))
+
+    # record an audit entry
+    # returns the (possibly not yet saved) AuditTrail
+    @classmethod
+    def record(cls, event_type, unique_id, details, source_ip, user_id = None, date_created = None):
+        entry = AuditTrail(
+                user_id = user_id,
+                source_ip = source_ip,
+                date_created = date_created if date_created != None else timezone.now(),
+                event_type = event_type,
+                unique_id = unique_id,
+                details = details,
+            )
+        mode = cls.mode(event_type)
+        if mode not in AUDIT_MODES:
+            raise ValueError('invalid audit mode %s for %s' % (mode, event_type))
+        if mode == 'sync' or cls.buffer == None:
+            if mode == 'async':
+                cls.spool([ entry ])
+            else:
+                entry.save()
+        else:
+            cls.buffer.append(entry)
+        return entry
+
+    @classmethod
+    def start_request(cls):
+        cls.buffer = []
+
+    # write out everything the request recorded: one
+    # bulk_create for the SQL entries, and one round trip
+    # for the async ones
+    @classmethod
+    def finish_request(cls):
+        entries = cls.buffer
+        cls.buffer = None
+        if not entries:
+            return
+        spooled = []
+        saved = []
+        for entry in entries:
+            if cls.mode(entry.event_type) == 'async':
+                spooled.append(entry)
+            else:
+                saved.append(entry)
+        if len(saved) > 0:
+            AuditTrail.objects.bulk_create(saved)
+        if len(spooled) > 0:
+            cls.spool(spooled)
+
+    @classmethod
+    def spool_key(cls):
+        return 'audit_trail_spool'
+
+    @classmethod
+    def processing_key(cls):
+        return 'audit_trail_spool_processing'
+
+    @classmethod
+    def drain_lock_key(cls):
+        return 'audit_trail_drain_lock'
+
+    @classmethod
+    def connection(cls):
+        return redis_connection(getattr(settings, 'CAXIAM_AUDIT_SPOOL_POOL', 0))
+
+    # push entries onto the async list, in one round trip
+    # NOTE: details are encoded the way JSONField encodes
+    # them (with DjangoJSONEncoder), so datetimes and
+    # decimals spool as they would have saved
+    @classmethod
+    def spool(cls, entries):
+        cls.connection().lpush(cls.spool_key(), *[ json.dumps({
+                'user_id': e.user_id,
+                'source_ip': e.source_ip,
+                'date_created': e.date_created.isoformat(),
+                'event_type': e.event_type,
+                'unique_id': e.unique_id,
+                'details': e.details,
+            }, cls = DjangoJSONEncoder) for e in entries ])
+
+    # write the async list to SQL in batches, until it is
+    # empty
+    # NOTE: a batch left in the processing list (because
+    # an earlier drain died) is written first
+    # returns the number of entries written, or None if
+    # another drain is running
+    @classmethod
+    def drain(cls, batch_size = None):
+        if batch_size == None:
+            batch_size = getattr(settings, 'CAXIAM_AUDIT_BATCH_SIZE', 1000)
+        rd = cls.connection()
+
+        # hold the lock for the whole drain, renewing it
+        # after each batch
+        lock_duration = getattr(settings, 'CAXIAM_AUDIT_DRAIN_LOCK', 300)
+        if not rd.set(cls.drain_lock_key(), os.getpid(), lock_duration, nx = True):
+            print "[pid:%d]" % os.getpid(), "audit trail drain already running"
+            return None
+        try:
+            return cls.drain_locked(rd, batch_size, lock_duration)
+        finally:
+            unlock_script(keys = [ cls.drain_lock_key() ], args = [ os.getpid() ], client = rd)
+
+    @classmethod
+    def drain_locked(cls, rd, batch_size, lock_duration):
+        written_count = 0
+        while True:
+            # stop if our lock expired and someone else
+            # took over
+            if rd.get(cls.drain_lock_key()) != str(os.getpid()):
+                print "[pid:%d]" % os.getpid(), "lost the audit trail drain lock"
+                break
+            rd.expire(cls.drain_lock_key(), lock_duration)
+
+            entries = rd.lrange(cls.processing_key(), 0, -1)
+            if len(entries) > 0:
+                entries.reverse()       # the processing list is newest-first
+            else:
+                entries = audit_spool_take_script(keys = [ cls.spool_key(), cls.processing_key() ], args = [ batch_size ], client = rd)
+                if len(entries) == 0:
+                    break
+
+            records = []
+            for d in entries:
+                v = json.loads(d)     # details as JSONField would load them
+                v['date_created'] = parse_datetime(v['date_created'])
+                records.append(AuditTrail(**v))
+            AuditTrail.objects.bulk_create(records)
+            rd.delete(cls.processing_key())
+            written_count += len(records)
+            print "[pid:%d]" % os.getpid(), "wrote %d audit trail entries" % len(records)
+        return written_count
+
+# hold each request's audit entries until it is finished
+# (see AuditTrailSink)
+# NOTE: entries are written even if the request fails,
+# since that is often when they matter most
+class AuditTrailMiddleware(object):
+
+    def process_request(self, request):
+        AuditTrailSink.start_request()
+
+    def process_response(self, request, response):
+        AuditTrailSink.finish_request()
+        return response
+
+    def process_exception(self, request, exception):
+        AuditTrailSink.finish_request()
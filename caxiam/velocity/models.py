@@ -1,10 +1,12 @@
+from django.conf import settings
 from django.contrib import admin
 from django.db import models
 from django.utils import timezone
 from caxiam.common import Enumeration
 from caxiam.hash_generator import ModelHashGenerator
 from caxiam.model_mixins import AutoHashModel
-from caxiam.redis_shadow import RedisShadow, redis_connection
+from caxiam.redis_shadow import RedisShadow, redis_connection, redis_register_script
+import bisect
 import datetime
 from jsonfield import JSONField
 import os
@@ -18,6 +20,181 @@ class VelocityException(Exception): pass
 class VelocityInvalidTypeException(VelocityException): pass
 class VelocityMissingParameterException(VelocityException): pass
 
+# does a rule fire for a particular weight within its
+# timespan?
+def velocity_rule_fired(r, weight):
+    return ((r['trigger'] == 'equal' and weight == r['limit']) or
+        (r['trigger'] == 'above' and weight > r['limit']))
+
+# the COUNTERS engine keeps a hash per index key (the
+# same combination of type, user, game, gamehistory and
+# unique ID the events are indexed by) mapping each time
+# bucket to the total weight of the events in it; times
+# are in seconds since the Unix epoch
+VELOCITY_COUNTER_EPOCH = datetime.datetime(1970, 1, 1, tzinfo = pytz.utc)
+
+# buckets are a minute long, unless that would mean more
+# than this many buckets in the longest timespan
+VELOCITY_COUNTER_MAX_BUCKETS = 1440
+
+# add an event's weight to its bucket and work out the
+# weight in each rule's window, in one round trip;
+# KEYS[1] is the counter hash and ARGV is:
+#   1   bucket size (seconds)
+#   2   time of the event
+#   3   weight to add (0 to just look)
+#   4   expiry time of the hash (seconds)
+#   5+  the timespan of each rule
+# returns the window sum for each rule
+# NOTE: a window starts at the beginning of the bucket
+# its start falls in, so sums may include up to one
+# bucket's worth of events older than the timespan
+# NOTE: buckets older than the longest timespan are
+# dropped as we go
+lua = '''
+local size = tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local weight = tonumber(ARGV[3])
+local bucket = math.floor(now / size)
+if weight ~= 0 then
+    redis.call("hincrby", KEYS[1], bucket, weight)
+    redis.call("expire", KEYS[1], ARGV[4])
+end
+local firsts = {}
+local sums = {}
+local oldest = bucket
+for i = 5, #ARGV do
+    firsts[i - 4] = math.floor((now - tonumber(ARGV[i])) / size)
+    sums[i - 4] = 0
+    oldest = math.min(oldest, firsts[i - 4])
+end
+local all = redis.call("hgetall", KEYS[1])
+local expired = {}
+for i = 1, #all, 2 do
+    local b = tonumber(all[i])
+    if b < oldest then
+        expired[#expired + 1] = all[i]
+    elseif b <= bucket then
+        local w = tonumber(all[i + 1])
+        for j = 1, #firsts do
+            if b >= firsts[j] then
+                sums[j] = sums[j] + w
+            end
+        end
+    end
+end
+if #expired > 0 and #ARGV > 4 then
+    redis.call("hdel", KEYS[1], unpack(expired))
+end
+return sums
+'''
+velocity_event_counter_script = redis_register_script(lua)
+
+# the SCRIPT engine keeps the weight of each event in a
+# hash next to the zindex key it is in, so that a script
+# can add up a window without decoding any records
+
+# evaluate the rules for an event against its zindex
+# key; KEYS[1] is the zindex key and KEYS[2] the weight
+# hash, and ARGV is:
+#   1   the event's id, or "" if it is only being tested
+#   2   the event's score (microseconds; see
+#       ZINDEX_DATETIME_EPOCH)
+#   3   the event's weight
+#   4   expiry time of the weight hash (seconds)
+#   5+  timespan (microseconds), limit and trigger
+#       ("equal" or "above") of each rule
+# when saving, the event must already be in the zindex
+# (this is run in the same transaction as redis_set);
+# when testing its weight is added to every window
+# returns the 1-based number and window sum of each rule
+# that fired, flattened into one list
+# NOTE: an event with no weight in the hash (e.g. one
+# recorded before the type switched engines) counts as 1
+lua = '''
+local member = ARGV[1]
+local score = tonumber(ARGV[2])
+local weight = tonumber(ARGV[3])
+if member ~= "" then
+    redis.call("hset", KEYS[2], member, weight)
+    redis.call("expire", KEYS[2], ARGV[4])
+end
+if #ARGV < 5 then
+    return {}
+end
+local longest = 0
+for i = 5, #ARGV, 3 do
+    longest = math.max(longest, tonumber(ARGV[i]))
+end
+local window = redis.call("zrangebyscore", KEYS[1], "(" .. string.format("%.0f", score - longest), string.format("%.0f", score), "WITHSCORES")
+local members = {}
+local scores = {}
+for i = 1, #window, 2 do
+    members[#members + 1] = window[i]
+    scores[#scores + 1] = tonumber(window[i + 1])
+end
+local weights = {}
+for i = 1, #members, 1000 do
+    local chunk = redis.call("hmget", KEYS[2], unpack(members, i, math.min(i + 999, #members)))
+    for j = 1, #chunk do
+        weights[#weights + 1] = tonumber(chunk[j]) or 1
+    end
+end
+local fired = {}
+local n = 0
+for i = 5, #ARGV, 3 do
+    local start = score - tonumber(ARGV[i])
+    local sum = 0
+    if member == "" then
+        sum = weight
+    end
+    for j = 1, #members do
+        if scores[j] > start then
+            sum = sum + weights[j]
+        end
+    end
+    n = n + 1
+    local limit = tonumber(ARGV[i + 1])
+    if (ARGV[i + 2] == "equal" and sum == limit) or (ARGV[i + 2] == "above" and sum > limit) then
+        fired[#fired + 1] = n
+        fired[#fired + 1] = sum
+    end
+end
+return fired
+'''
+velocity_event_rules_script = redis_register_script(lua)
+
+# expunge one batch of old events from a zindex key:
+# delete the records, remove their members (and SCRIPT
+# engine weights) and, once the key is empty, take it out
+# of the slot's key registry; KEYS[1] is the zindex key,
+# KEYS[2] the weight hash and KEYS[3] the registry, and
+# ARGV is:
+#   1   score cutoff (events before this go)
+#   2   batch size
+#   3   record key prefix (see redis_key_prefix)
+# returns the ids that were expunged
+# NOTE: members are removed by id (rather than with
+# ZREMRANGEBYSCORE) because synced-date events share a
+# score, and a batch may stop part way through them
+lua = '''
+local ids = redis.call("zrangebyscore", KEYS[1], "-inf", "(" .. ARGV[1], "LIMIT", 0, tonumber(ARGV[2]))
+if #ids > 0 then
+    local keys = {}
+    for i = 1, #ids do
+        keys[i] = ARGV[3] .. ids[i]
+    end
+    redis.call("del", unpack(keys))
+    redis.call("zrem", KEYS[1], unpack(ids))
+    redis.call("hdel", KEYS[2], unpack(ids))
+end
+if redis.call("exists", KEYS[1]) == 0 then
+    redis.call("srem", KEYS[3], KEYS[1])
+end
+return ids
+'''
+velocity_event_expunge_script = redis_register_script(lua)
+
 # a velocity type: a kind of event that can occur
 # and be logged
 # NOTE: this is NOT a database model
@@ -28,6 +205,12 @@ class VelocityType(RedisShadow, models.Model):
             (1, 'LOCAL_DAY_SYNCED'),    # events happen at local midnight
         )
 
+    ENGINES = Enumeration(
+            (0, 'EVENTS'),              # rules are evaluated over the events themselves
+            (1, 'COUNTERS'),            # rules are evaluated over bucketed weight sums
+            (2, 'SCRIPT'),              # rules are evaluated by a script, next to the events
+        )
+
     # what type is this?
     tag = models.CharField(max_length = 32, unique = True)
 
@@ -46,6 +229,18 @@ class VelocityType(RedisShadow, models.Model):
     # should event times be synced (e.g. to a day)?
     sync_date = models.IntegerField(default = 0, choices = SYNC_TYPES.choices)
 
+    # how are rules evaluated?
+    # EVENTS fetches every event in the longest timespan
+    # and adds up their weights; COUNTERS keeps per-bucket
+    # weight sums in redis as events are created, and
+    # evaluates every rule with one script call, at the
+    # cost of window starts being rounded down to a bucket
+    # (see velocity_event_counter_script); SCRIPT saves the
+    # event and evaluates every rule exactly in one
+    # transaction (see velocity_event_rules_script); events
+    # are still recorded either way, for audits
+    engine = models.IntegerField(default = 0, choices = ENGINES.choices)
+
     # how long (in seconds) should records of this
     # type be kept? helpful numbers:
     #    3600 = 1 hour
@@ -77,6 +272,15 @@ class VelocityType(RedisShadow, models.Model):
         # use %s for id instead of %d because id may be None
         return u'[%s:%s] %s: %ds' % (self.__class__.__name__, unicode(self.id), self.tag, self.expunge_after)
 
+    # the engine rules are evaluated with; types shadowed
+    # in redis before the engine field existed decode with
+    # None, which means EVENTS
+    @property
+    def rule_engine(self):
+        if self.engine == None:
+            return self.ENGINES.EVENTS
+        return self.engine
+
     # property to determine the longest timespan (this is
     # the timespan of the entire type)
     @property
@@ -94,44 +298,39 @@ class VelocityType(RedisShadow, models.Model):
     # equal triggers can be reliably used
     # NOT TRUE FOR REDIS: NOTE: you MUST use this in isolation level READ_COMMITTED
     @classmethod
-    def create_event(cls, type_tag, weight = 1, user = None, game = None, gamehistory = None, unique_id = None, date_created = None, date_ending = None, test = False, test_and_save = False, timezone_offset = 0):
-
-        # validate parameters
-        #vt = cls.objects.get(tag = type_tag)   # raises exception if missing
-        if isinstance(type_tag, cls):
-            # already have the object, don't re-fetch it
-            vt = type_tag
-        else:
-            vt = cls.redis_get_by_index(0, [ type_tag ])
-            if vt == None:
-                raise VelocityInvalidTypeException('invalid velocity type tag ' + type_tag)
-        vt.validate_params(user, game, gamehistory, unique_id)
+    def create_event(cls, type_tag, weight = 1, user = None, game = None, gamehistory = None, unique_id = None, date_created = None, date_ending = None, test = False, test_and_save = False, timezone_offset = 0, lock = True):
 
-        # fix the time being used
-        if date_created == None:
-            date_created = timezone.now()
-        if date_ending == None:
-            date_ending = date_created
-
-        # if the time is synced, deal with that
-        if vt.sync_date == cls.SYNC_TYPES.LOCAL_DAY_SYNCED:
-            local_midnight = datetime.datetime(date_created.year, date_created.month, date_created.day, tzinfo = pytz.utc) + datetime.timedelta(seconds = timezone_offset*60)
-            date_created = local_midnight
+        # validate parameters and build the new event
+        vt, ve = cls.prepare_event(type_tag, weight, user, game, gamehistory, unique_id, date_created, timezone_offset)
+        date_created = ve.date_created
 
         # lock the required record
-        vt.lock_related(user, game, gamehistory, unique_id)
-
-        # create the new event and, if this is not just
-        # a test, save it
-        ve = VelocityEvent(
-                velocity_type = vt,
-                user = user,
-                game = game,
-                gamehistory = gamehistory,
-                unique_id = unique_id,
-                weight = weight,
-                date_created = date_created,
-            )
+        # NOTE: the COUNTERS and SCRIPT engines add the weight
+        # and read the sums atomically, so each event sees its
+        # own total and equal triggers work without the lock;
+        # test_and_save still needs it, because the test and
+        # the save are separate steps
+        # NOTE: lock = False is for callers that have already
+        # locked the records (see create_events)
+        if lock and (vt.rule_engine == cls.ENGINES.EVENTS or test_and_save):
+            vt.lock_related(user, game, gamehistory, unique_id)
+
+        # the COUNTERS and SCRIPT engines save the event and
+        # evaluate the rules in one go
+        if vt.rule_engine == cls.ENGINES.COUNTERS:
+            failure_data = vt.apply_counters(ve, test = test or test_and_save)
+            if test_and_save and failure_data == None:
+                print "[pid:%d]" % os.getpid(), "SAVING SUCCESSFUL VELOCITY EVENT %s" % str(ve)
+                vt.apply_counters(ve, do_rules = False)
+            return ve, failure_data
+        if vt.rule_engine == cls.ENGINES.SCRIPT:
+            failure_data = vt.apply_script(ve, test = test or test_and_save)
+            if test_and_save and failure_data == None:
+                print "[pid:%d]" % os.getpid(), "SAVING SUCCESSFUL VELOCITY EVENT %s" % str(ve)
+                vt.apply_script(ve, do_rules = False)
+            return ve, failure_data
+
+        # if this is not just a test, save the new event
         if not (test or test_and_save):
             # save the record in Redis
             # NOTE: we use redis_set rather than redis_save
@@ -162,6 +361,135 @@ class VelocityType(RedisShadow, models.Model):
         
         return ve, failure_data
 
+    # look up the type and build a new (unsaved) event for
+    # create_event() or create_events()
+    # returns ( type, event )
+    @classmethod
+    def prepare_event(cls, type_tag, weight = 1, user = None, game = None, gamehistory = None, unique_id = None, date_created = None, timezone_offset = 0):
+
+        # validate parameters
+        #vt = cls.objects.get(tag = type_tag)   # raises exception if missing
+        if isinstance(type_tag, cls):
+            # already have the object, don't re-fetch it
+            vt = type_tag
+        else:
+            vt = cls.redis_get_by_index(0, [ type_tag ])
+            if vt == None:
+                raise VelocityInvalidTypeException('invalid velocity type tag ' + type_tag)
+        vt.validate_params(user, game, gamehistory, unique_id)
+
+        # fix the time being used
+        if date_created == None:
+            date_created = timezone.now()
+
+        # if the time is synced, deal with that
+        if vt.sync_date == cls.SYNC_TYPES.LOCAL_DAY_SYNCED:
+            local_midnight = datetime.datetime(date_created.year, date_created.month, date_created.day, tzinfo = pytz.utc) + datetime.timedelta(seconds = timezone_offset*60)
+            date_created = local_midnight
+
+        ve = VelocityEvent(
+                velocity_type = vt,
+                user = user,
+                game = game,
+                gamehistory = gamehistory,
+                unique_id = unique_id,
+                weight = weight,
+                date_created = date_created,
+            )
+        return vt, ve
+
+    # create a batch of events at once; batch is a list of
+    # dicts of create_event() arguments (type_tag, weight,
+    # user, game, gamehistory, unique_id, date_created,
+    # timezone_offset) and test/test_and_save apply to the
+    # whole batch
+    # events are grouped by index key; everything that
+    # needs locking is locked up front, each group's window
+    # is fetched once and its events are evaluated in time
+    # order (each seeing the ones before it), and all the
+    # events that are kept are written in one pipeline
+    # returns a list of ( event, failure data ), in the
+    # same order as the batch
+    # NOTE: when testing, each event sees the earlier
+    # events of the batch as if they had been saved; with
+    # test_and_save, only the ones that passed
+    # NOTE: events of COUNTERS and SCRIPT types don't
+    # fetch windows, so they go through create_event()
+    # once everything is locked
+    @classmethod
+    def create_events(cls, batch, test = False, test_and_save = False):
+        rv = [ None ] * len(batch)
+        types = {}
+        groups = {}
+        others = []
+        for i in range(len(batch)):
+            kwargs = dict(batch[i])
+            type_tag = kwargs.pop('type_tag')
+            vt, ve = cls.prepare_event(types.get(type_tag, type_tag), **kwargs)
+            types[type_tag] = vt        # don't fetch the same type twice
+            if vt.rule_engine != cls.ENGINES.EVENTS:
+                others.append(( i, vt, ve, kwargs ))
+                continue
+
+            k = ( vt.id, ve.user_id, ve.game_id, ve.gamehistory_id, ve.unique_id )
+            if k not in groups:
+                groups[k] = ( vt, [] )
+            groups[k][1].append(( i, ve ))
+
+        # lock everything the batch needs, all at once, so
+        # the app-wide locking order holds across the batch
+        # NOTE: COUNTERS and SCRIPT events only need locking
+        # for test_and_save (see create_event)
+        gamehistories = {}
+        users = {}
+        needs_lock = [ ( vt, items[0][1] ) for vt, items in groups.values() ]
+        if test_and_save:
+            needs_lock += [ ( vt, ve ) for i, vt, ve, kwargs in others ]
+        for vt, ve in needs_lock:
+            if vt.requires_gamehistory:
+                gamehistories[ve.gamehistory_id] = ve.gamehistory
+            if vt.requires_user:
+                users[ve.user_id] = ve.user
+        cls.lock_records(gamehistories.values(), users.values())
+
+        for i, vt, ve, kwargs in others:
+            rv[i] = cls.create_event(vt, test = test, test_and_save = test_and_save, lock = False, **kwargs)
+        if len(groups) == 0:
+            return rv
+
+        # fetch each group's window before anything is
+        # written, so the batch isn't counted twice
+        windows = {}
+        for k, ( vt, items ) in groups.iteritems():
+            items.sort(key = lambda item: item[1].date_created)
+            first = items[0][1]
+            windows[k] = vt.get_events(user = first.user, game = first.game, gamehistory = first.gamehistory, unique_id = first.unique_id,
+                date_starting = first.date_created - datetime.timedelta(0, vt.timespan), date_ending = items[-1][1].date_created)
+
+        # unless we're testing, every event is recorded
+        # (before acting on it, as in create_event())
+        if not (test or test_and_save):
+            events = [ ve for vt, items in groups.values() for i, ve in items ]
+            print "[pid:%d]" % os.getpid(), "SAVING %d NEW VELOCITY EVENTS" % len(events)
+            VelocityEvent.redis_set_many(events)
+
+        saved = []
+        for k, ( vt, items ) in groups.iteritems():
+            window = windows[k]
+            for i, ve in items:
+                failure_data = vt.apply_rules(ve, window + [ ve ], do_actions = not (test or test_and_save))
+                rv[i] = ( ve, failure_data )
+                if test_and_save and failure_data != None:
+                    continue        # won't be saved, so later events don't see it
+                window.append(ve)
+                if test_and_save:
+                    saved.append(ve)
+
+        if len(saved) > 0:
+            print "[pid:%d]" % os.getpid(), "SAVING %d SUCCESSFUL VELOCITY EVENTS" % len(saved)
+            VelocityEvent.redis_set_many(saved)
+        return rv
+
     # validate parameters for a particular velocity type
     def validate_params(self, user, game, gamehistory, unique_id):
         if self.requires_user and user == None:
@@ -177,12 +505,23 @@ class VelocityType(RedisShadow, models.Model):
     # NOTE: make sure you follow the app-wide locking order
     # NOTE: these functions already use Redis
     def lock_related(self, user, game, gamehistory, unique_id):
-        if self.requires_gamehistory:
+        VelocityType.lock_records(
+            [ gamehistory ] if self.requires_gamehistory else [],
+            [ user ] if self.requires_user else [])
+
+    # lock several gamehistory and user records at once
+    # NOTE: gamehistories are locked before users, and
+    # each in id order, so two batches can't deadlock
+    @classmethod
+    def lock_records(cls, gamehistories, users):
+        if len(gamehistories) > 0:
             from ilarcade.ilgames.models import SATEGameTurnLock
-            SATEGameTurnLock.lock_gamehistory(gamehistory)
-        if self.requires_user:
+            for gamehistory in sorted(gamehistories, key = lambda r: r.id):
+                SATEGameTurnLock.lock_gamehistory(gamehistory)
+        if len(users) > 0:
             from ilarcade.notifications.models import NotificationLock
-            NotificationLock.lock_user_queue(user)
+            for user in sorted(users, key = lambda r: r.id):
+                NotificationLock.lock_user_queue(user)
 
     # fetch any existing events related to a type
     # NOT TRUE FOR REDIS: NOTE: this actually returns a query set with the
@@ -247,39 +586,242 @@ class VelocityType(RedisShadow, models.Model):
         if date_ending == None:
             date_ending = velocity_event.date_created
 
-        rv = None
+        weights = self.rule_weights(events, date_ending)
+        return self.fire_rules(velocity_event, weights, do_actions)
+
+    # sum the weight of all the events within each rule's
+    # timespan (which is in seconds) up to date_ending,
+    # in the same order as the rules
+    # NOTE: the events are put in time order once, in a
+    # list of times and a list of running weight totals,
+    # so each rule only takes a binary search however many
+    # events there are
+    # NOTE: the times are left as datetimes; comparing them
+    # is cheap, but converting 10k of them to numbers costs
+    # more than the scan this replaces
+    def rule_weights(self, events, date_ending):
+        dates = [ ve.date_created for ve in events ]
+        if sorted(dates) != dates:
+            # get_events() hands them over in order, so this
+            # is rare (and the check above is cheap)
+            events = sorted(events, key = lambda ve: ve.date_created)
+            dates = [ ve.date_created for ve in events ]
+        totals = [ 0 ] * (len(events) + 1)
+        total = 0
+        for i in xrange(len(events)):
+            total += events[i].weight
+            totals[i + 1] = total
+
+        last = bisect.bisect_right(dates, date_ending)
+        weights = []
         for r in self.rules:
-            # sum the weight of all the events within timespan
-            date_starting = date_ending - datetime.timedelta(r['timespan'])
-            weight = sum([ ve.weight for ve in events if ve.date_created > date_starting and ve.date_created <= date_ending ])
-            
+            first = bisect.bisect_right(dates, date_ending - datetime.timedelta(0, r['timespan']))
+            weights.append(totals[last] - totals[first] if last > first else 0)
+        return weights
+
+    # as above, but checking every event against every rule
+    # (kept for comparison; see velocity_benchmark)
+    def rule_weights_generic(self, events, date_ending):
+        weights = []
+        for r in self.rules:
+            date_starting = date_ending - datetime.timedelta(0, r['timespan'])
+            weights.append(sum([ ve.weight for ve in events if ve.date_created > date_starting and ve.date_created <= date_ending ]))
+        return weights
+
+    # given the weight within each rule's timespan (in the
+    # same order as the rules), check the rules for
+    # violations
+    # NOTE: returns the params of the LAST violated rule
+    # that had no action
+    def fire_rules(self, velocity_event, weights, do_actions = True):
+        fired = []
+        for r, weight in zip(self.rules, weights):
             # see if this violates the constraint
-            if ((r['trigger'] == 'equal' and weight == r['limit']) or
-                (r['trigger'] == 'above' and weight > r['limit'])):
-                
-                # do the action
-                if r['action'] == None:
-                    # this is a straight test
-                    rv = r['params']
-                    
-                elif do_actions:
-                    # this is some other action, and we're allowed to do it
-                    action = getattr(self, 'action_' + r['action'])
-                    if not callable(action):
-                        raise Exception('found action attribute but it is not callable')
-                    action(velocity_event, weight, **r['params'])
+            if velocity_rule_fired(r, weight):
+                fired.append(( r, weight ))
+
+        return self.run_actions(velocity_event, fired, do_actions)
+
+    # act on the rules that fired, given as a list of
+    # (rule, weight) pairs in rule order
+    # NOTE: returns the params of the LAST violated rule
+    # that had no action
+    def run_actions(self, velocity_event, fired, do_actions = True):
+        rv = None
+        for r, weight in fired:
+            # do the action
+            if r['action'] == None:
+                # this is a straight test
+                rv = r['params']
+
+            elif do_actions:
+                # this is some other action, and we're allowed to do it
+                action = getattr(self, 'action_' + r['action'])
+                if not callable(action):
+                    raise Exception('found action attribute but it is not callable')
+                action(velocity_event, weight, **r['params'])
 
         return rv
-    
+
+    # the length (in seconds) of the COUNTERS engine's
+    # buckets for this type
+    @property
+    def counter_bucket_size(self):
+        minutes = -(-self.timespan // (60 * VELOCITY_COUNTER_MAX_BUCKETS))      # rounding up
+        return 60 * max(minutes, 1)
+
+    # the redis key of the COUNTERS engine's hash for an
+    # event (one per index key, like the events' zindex)
+    def counter_key(self, velocity_event):
+        return 'velocity_counter:%s:%s:%s:%s:%s' % (self.id,
+            velocity_event.user_id, velocity_event.game_id, velocity_event.gamehistory_id,
+            velocity_event.unique_id)
+
+    # add a weight (which may be negative, or 0 to just
+    # look) to the bucket an event falls in, and return
+    # the weight within each rule's timespan (in the same
+    # order as the rules)
+    # NOTE: the hash lives in the events' first pool; if
+    # client is a pipeline of that pool the script is just
+    # queued on it
+    def counter_update(self, velocity_event, weight, client = None, do_rules = True):
+        size = self.counter_bucket_size
+        when = int((velocity_event.date_created - VELOCITY_COUNTER_EPOCH).total_seconds())
+        args = [ size, when, weight, self.timespan + size ]
+        if do_rules:
+            args += [ r['timespan'] for r in self.rules ]
+        if client == None:
+            client = VelocityEvent.redis_connection()
+        return velocity_event_counter_script(keys = [ self.counter_key(velocity_event) ], args = args, client = client)
+
+    # the COUNTERS engine's version of create_event()'s
+    # work: record the event, count its weight and apply
+    # the rules, without fetching any events
+    # NOTE: when testing nothing is written; the event's
+    # weight is added to the sums locally
+    # NOTE: with do_rules False the event is just recorded
+    # and counted (and None returned)
+    def apply_counters(self, velocity_event, test = False, do_rules = True):
+        if test:
+            weights = self.counter_update(velocity_event, 0)
+            weights = [ w + velocity_event.weight for w in weights ]
+            return self.fire_rules(velocity_event, weights, do_actions = False)
+
+        # save the record and count it in one round trip,
+        # unless the events are sharded (and the record may
+        # live somewhere other than the counters)
+        # NOTE: as in create_event(), the event is recorded
+        # right away
+        print "[pid:%d]" % os.getpid(), "SAVING NEW VELOCITY EVENT %s" % str(velocity_event)
+        if VelocityEvent.redis_is_sharded():
+            velocity_event.redis_set()
+            weights = self.counter_update(velocity_event, velocity_event.weight, do_rules = do_rules)
+        else:
+            pipe = velocity_event.redis_set(VelocityEvent.redis_connection().pipeline())
+            self.counter_update(velocity_event, velocity_event.weight, pipe, do_rules)
+            weights = pipe.execute()[-1]
+        if not do_rules:
+            return None
+        return self.fire_rules(velocity_event, weights)
+
+    # find the zindex key (and score) an event belongs at,
+    # and the SCRIPT engine's weight hash that goes with it
+    # returns (zindex key, weight hash key, score)
+    def script_keys(self, velocity_event):
+        entries = velocity_event.redis_indexer().entries(velocity_event, [ ( 'zindex', 0 ) ])
+        for e in entries:
+            return e[2], 'velocity_weights:' + e[2], e[3]
+
+    # the SCRIPT engine's version of create_event()'s work:
+    # save the event and evaluate every rule in one
+    # transaction, leaving only the actions to us
+    # NOTE: when testing nothing is written
+    # NOTE: with do_rules False the event is just recorded
+    # (and None returned)
+    # NOTE: the event's zindex key must live in one pool,
+    # so if the events are sharded they need a
+    # REDIS_SHADOW_SHARD_KEY that keeps each index key on
+    # one shard
+    def apply_script(self, velocity_event, test = False, do_rules = True):
+        if VelocityEvent.redis_is_sharded() and getattr(VelocityEvent, 'REDIS_SHADOW_SHARD_KEY', None) == None:
+            raise VelocityException('the SCRIPT engine needs events sharded by index key')
+
+        zindex_key, weights_key, score = self.script_keys(velocity_event)
+        args = [ '', score, velocity_event.weight, self.timespan ]
+        if do_rules:
+            for r in self.rules:
+                args += [ r['timespan'] * 1000000, r['limit'], r['trigger'] ]
+
+        if test:
+            rv = velocity_event_rules_script(keys = [ zindex_key, weights_key ], args = args,
+                client = velocity_event.redis_connection(velocity_event.redis_record_pool_index()))
+        else:
+            # NOTE: as in create_event(), the event is recorded
+            # right away
+            print "[pid:%d]" % os.getpid(), "SAVING NEW VELOCITY EVENT %s" % str(velocity_event)
+            velocity_event.redis_assign_id()
+            args[0] = velocity_event.id
+            pipe = velocity_event.redis_connection(velocity_event.redis_record_pool_index()).pipeline()
+            velocity_event.redis_set(pipe)
+            velocity_event_rules_script(keys = [ zindex_key, weights_key ], args = args, client = pipe)
+            rv = pipe.execute()[-1]
+        if not do_rules:
+            return None
+
+        fired = [ ( self.rules[rv[i] - 1], rv[i + 1] ) for i in range(0, len(rv), 2) ]
+        return self.run_actions(velocity_event, fired, do_actions = not test)
+
     # utility to expunge all old records
     # NOTE: we delete the records and their index
     # entries in batch
-    def expunge(self):
+    # returns the number of events expunged
+    def expunge(self, batch_size = 1000):
+        return VelocityType.expunge_types([ self ], batch_size)
+
+    # expunge the old events of several types in one walk
+    # over the events' zindex keys (using the slot's key
+    # registry, or an incremental SCAN; never KEYS), without
+    # having to fetch and parse the records
+    # NOTE: types without expunge_after are skipped
+    # NOTE: cancelled events are no longer in the zindex,
+    # so they are left alone (see CAXIAM_VELOCITY_EVENT_TTL)
+    # returns the number of events expunged
+    @classmethod
+    def expunge_types(cls, types, batch_size = 1000):
         now = timezone.now()
-        then = now - datetime.timedelta(0, self.expunge_after)
-        #**** TODO: find all the indices and expunge them,
-        # without having to fetch and parse the records
-        #qs = self.events.filter(date_created__lt = then).delete()   # batch delete!
+        cutoffs = {}
+        for vt in types:
+            if vt.expunge_after != None:
+                vals = [ now - datetime.timedelta(0, vt.expunge_after) ]
+                VelocityEvent.redis_fix_index_types(None, vals)
+                cutoffs[unicode(vt.id)] = vals[0]
+        if len(cutoffs) == 0:
+            return 0
+
+        # the type id is the first value in each key
+        base = VelocityEvent.redis_zindex_key(0, None) + ':'
+        rk = VelocityEvent.redis_index_registry_key('zindex', 0)
+        prefix = VelocityEvent.redis_key_prefix()
+        expunged_count = 0
+        for pool_index in VelocityEvent.redis_pool_indices():
+            rd = VelocityEvent.redis_connection(pool_index)
+            for k in VelocityEvent.redis_iter_index_keys('zindex', 0, batch_size, pool_index):
+                cutoff = cutoffs.get(k[len(base):].split(':', 1)[0])
+                if cutoff == None:
+                    continue
+                while True:
+                    ids = velocity_event_expunge_script(keys = [ k, 'velocity_weights:' + k, rk ], args = [ cutoff, batch_size, prefix ], client = rd)
+                    if len(ids) > 0 and VelocityEvent.redis_cache() != None:
+                        # one round trip for the whole batch's
+                        # invalidations
+                        pipe = rd.pipeline(transaction = False)
+                        for pk in ids:
+                            VelocityEvent.redis_cache_invalidate(int(pk), pipe)
+                        pipe.execute()
+                    expunged_count += len(ids)
+                    if len(ids) < batch_size:
+                        break
+        return expunged_count
 
 admin.site.register(VelocityType)
 
@@ -311,6 +853,21 @@ class VelocityEvent(RedisShadow, models.Model):
 
     # other redis settings
     
+    # records can be given a TTL of their type's
+    # expunge_after (plus a day, so that the expunge job
+    # normally gets to them first and removes their index
+    # entries too); this also takes care of cancelled
+    # events, which the expunge job can't find
+    def redis_ttl(self):
+        if not getattr(settings, 'CAXIAM_VELOCITY_EVENT_TTL', False):
+            return None
+        vt = getattr(self, '_velocity_type_cache', None)    # don't hit SQL for the type
+        if vt == None:
+            vt = VelocityType.redis_get(self.velocity_type_id)
+        if vt == None or vt.expunge_after == None:
+            return None
+        return vt.expunge_after + 86400
+
     # a debugging string-cast
     def __unicode__(self):
         # use %s for id instead of %d because id may be None
@@ -343,6 +900,14 @@ class VelocityEvent(RedisShadow, models.Model):
         self.date_removed = date_removed
         self.redis_set(update_indices = False)
 
+        # take it back out of the counters too
+        vt = VelocityType.redis_get(self.velocity_type_id)
+        if vt != None and vt.rule_engine == VelocityType.ENGINES.COUNTERS:
+            vt.counter_update(self, -self.weight, do_rules = False)
+        elif vt != None and vt.rule_engine == VelocityType.ENGINES.SCRIPT:
+            zindex_key, weights_key, score = vt.script_keys(self)
+            self.redis_connection(self.redis_record_pool_index()).hdel(weights_key, self.id)
+
 class VelocityEventAdmin(admin.ModelAdmin):
 
     # foreign key fields which should NOT be shown as drop-downs